@@ -1,29 +1,41 @@
 import os
 import uuid
+import time
+import atexit
 import logging
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, flash
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, flash, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
-import qrcode
-from io import BytesIO
+from io import BytesIO, StringIO
 import base64
+# qrcode, PIL, reportlab.pdfgen and sendgrid are imported where they are used, so workers that never
+# render a ticket or send an email do not pay for them at startup
 from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
 from reportlab.lib.units import inch
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
 import requests
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from types import SimpleNamespace
 import json
 import random
 import string
+import hashlib
+import hmac
+import zipfile
+import csv
+import click
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 
 load_dotenv()
 
@@ -42,6 +54,115 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 }
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Run `flask schema upgrade` on deploy, or set this to create tables and migrate in create_app()
+app.config['SCHEMA_AUTO_UPGRADE'] = os.getenv('SCHEMA_AUTO_UPGRADE', '0') == '1'
+
+# Ticket fulfillment queue: set FULFILLMENT_WORKERS=0 to run `python worker.py` separately
+app.config['FULFILLMENT_WORKERS'] = int(os.getenv('FULFILLMENT_WORKERS', '2'))
+app.config['FULFILLMENT_MAX_ATTEMPTS'] = int(os.getenv('FULFILLMENT_MAX_ATTEMPTS', '5'))
+app.config['FULFILLMENT_RETRY_SECONDS'] = float(os.getenv('FULFILLMENT_RETRY_SECONDS', '30'))
+app.config['FULFILLMENT_POLL_SECONDS'] = float(os.getenv('FULFILLMENT_POLL_SECONDS', '1'))
+app.config['FULFILLMENT_LOCK_TIMEOUT'] = int(os.getenv('FULFILLMENT_LOCK_TIMEOUT', '300'))
+
+# Inventory holds placed at checkout are released if the payment has not succeeded within this window
+app.config['RESERVATION_TTL'] = int(os.getenv('RESERVATION_TTL', '600'))
+app.config['RESERVATION_SWEEP_SECONDS'] = int(os.getenv('RESERVATION_SWEEP_SECONDS', '30'))
+
+# 'on_demand' keeps only the ticket id and serves QR images from /ticket/<id>/qr.png; 'inline' stores base64 PNGs
+app.config['QR_STORAGE'] = os.getenv('QR_STORAGE', 'on_demand')
+
+# PayHero client: pooled connections, short timeouts; 'async' returns from /purchase before the STK push completes
+app.config['PAYHERO_BASE_URL'] = os.getenv('PAYHERO_BASE_URL', 'https://backend.payhero.co.ke')
+app.config['PAYHERO_CONNECT_TIMEOUT'] = float(os.getenv('PAYHERO_CONNECT_TIMEOUT', '3'))
+app.config['PAYHERO_READ_TIMEOUT'] = float(os.getenv('PAYHERO_READ_TIMEOUT', '10'))
+app.config['PAYHERO_RETRIES'] = int(os.getenv('PAYHERO_RETRIES', '2'))
+app.config['PAYHERO_POOL_SIZE'] = int(os.getenv('PAYHERO_POOL_SIZE', '10'))
+app.config['PAYHERO_PUSH_MODE'] = os.getenv('PAYHERO_PUSH_MODE', 'async')
+app.config['PAYHERO_RECONCILE_AFTER'] = int(os.getenv('PAYHERO_RECONCILE_AFTER', '120'))
+app.config['PAYHERO_RECONCILE_SECONDS'] = int(os.getenv('PAYHERO_RECONCILE_SECONDS', '60'))
+
+# Ticket emails: 'combined' (one multi-page PDF), 'zip' or 'separate' PDFs, and tickets per email. A ticket PDF is
+# about 6 KB (8 KB base64), so the default part stays near 4 MB, well under provider attachment limits
+app.config['TICKET_ATTACHMENT_MODE'] = os.getenv('TICKET_ATTACHMENT_MODE', 'combined')
+app.config['EMAIL_TICKETS_PER_PART'] = int(os.getenv('EMAIL_TICKETS_PER_PART', '500'))
+
+# PIN hashing: werkzeug method string (cost), run on PIN_HASH_WORKERS threads with at most PIN_HASH_QUEUE waiting
+app.config['PIN_HASH_METHOD'] = os.getenv('PIN_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PIN_HASH_WORKERS'] = int(os.getenv('PIN_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+app.config['PIN_HASH_QUEUE'] = int(os.getenv('PIN_HASH_QUEUE', '64'))
+app.config['PIN_HASH_TIMEOUT'] = float(os.getenv('PIN_HASH_TIMEOUT', '10'))
+# Login throttling: token buckets per email and per client IP, kept in 'memory' (per process) or the shared 'database'
+app.config['LOGIN_THROTTLE_BACKEND'] = os.getenv('LOGIN_THROTTLE_BACKEND', 'memory')
+app.config['LOGIN_EMAIL_BURST'] = int(os.getenv('LOGIN_EMAIL_BURST', '5'))
+app.config['LOGIN_EMAIL_PER_MINUTE'] = float(os.getenv('LOGIN_EMAIL_PER_MINUTE', '5'))
+app.config['LOGIN_IP_BURST'] = int(os.getenv('LOGIN_IP_BURST', '20'))
+app.config['LOGIN_IP_PER_MINUTE'] = float(os.getenv('LOGIN_IP_PER_MINUTE', '30'))
+# Proxies in front of the app that append to X-Forwarded-For (Replit has one); 0 uses the socket address
+app.config['TRUSTED_PROXY_HOPS'] = int(os.getenv('TRUSTED_PROXY_HOPS', '1'))
+
+# Waiting room for sale openings: buyers queue for admission tokens, at most WAITING_ROOM_ACTIVE unspent across workers,
+# and at most CHECKOUT_CONCURRENCY /purchase requests run at once per process (others wait CHECKOUT_WAIT seconds, then get a 503)
+app.config['WAITING_ROOM_ENABLED'] = os.getenv('WAITING_ROOM_ENABLED', '0') == '1'
+app.config['WAITING_ROOM_ACTIVE'] = int(os.getenv('WAITING_ROOM_ACTIVE', '20'))
+app.config['WAITING_ROOM_MAX'] = int(os.getenv('WAITING_ROOM_MAX', '10000'))
+app.config['WAITING_ROOM_POLL_SECONDS'] = float(os.getenv('WAITING_ROOM_POLL_SECONDS', '2'))
+app.config['WAITING_ROOM_IDLE_SECONDS'] = float(os.getenv('WAITING_ROOM_IDLE_SECONDS', '30'))
+app.config['WAITING_ROOM_TOKEN_TTL'] = int(os.getenv('WAITING_ROOM_TOKEN_TTL', '7200'))
+app.config['ADMISSION_TTL'] = int(os.getenv('ADMISSION_TTL', '300'))
+app.config['CHECKOUT_CONCURRENCY'] = int(os.getenv('CHECKOUT_CONCURRENCY', '4'))
+app.config['CHECKOUT_WAIT'] = float(os.getenv('CHECKOUT_WAIT', '2'))
+
+# Rendered ticket PDFs are kept in a content-addressed artifact store ('local' directory)
+app.config['ARTIFACT_STORE'] = os.getenv('ARTIFACT_STORE', 'local')
+app.config['ARTIFACT_DIR'] = os.getenv('ARTIFACT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artifacts'))
+
+# Email outbox: 'sendgrid', or 'fake' to record messages locally (written to EMAIL_FAKE_DIR when set)
+app.config['EMAIL_TRANSPORT'] = os.getenv('EMAIL_TRANSPORT', 'sendgrid')
+app.config['EMAIL_FAKE_DIR'] = os.getenv('EMAIL_FAKE_DIR')
+# SendGrid API base URL; point it at bench/sendgrid_stub.py for load tests
+app.config['SENDGRID_API_HOST'] = os.getenv('SENDGRID_API_HOST', 'https://api.sendgrid.com')
+# Delivery threads run with the fulfillment workers; the send rate, in messages per second, is shared by every process
+app.config['EMAIL_WORKERS'] = int(os.getenv('EMAIL_WORKERS', '1'))
+app.config['EMAIL_SEND_RATE'] = float(os.getenv('EMAIL_SEND_RATE', '5'))
+app.config['EMAIL_BATCH_SIZE'] = int(os.getenv('EMAIL_BATCH_SIZE', '20'))
+app.config['EMAIL_MAX_ATTEMPTS'] = int(os.getenv('EMAIL_MAX_ATTEMPTS', '6'))
+app.config['EMAIL_RETRY_SECONDS'] = float(os.getenv('EMAIL_RETRY_SECONDS', '30'))
+app.config['EMAIL_POLL_SECONDS'] = float(os.getenv('EMAIL_POLL_SECONDS', '1'))
+app.config['EMAIL_LOCK_TIMEOUT'] = int(os.getenv('EMAIL_LOCK_TIMEOUT', '300'))
+
+# Seconds other workers may serve a cached ticket catalog after an admin change (the changing worker reloads at once)
+app.config['CATALOG_TTL'] = int(os.getenv('CATALOG_TTL', '30'))
+
+# Tickets per page on My Tickets and /api/my-tickets
+app.config['MY_TICKETS_PAGE_SIZE'] = int(os.getenv('MY_TICKETS_PAGE_SIZE', '20'))
+
+# Admin dashboard: how long one snapshot is shared by every open screen in a process, and how often the page polls it
+app.config['DASHBOARD_CACHE_SECONDS'] = float(os.getenv('DASHBOARD_CACHE_SECONDS', '2'))
+app.config['DASHBOARD_POLL_SECONDS'] = float(os.getenv('DASHBOARD_POLL_SECONDS', '5'))
+app.config['DASHBOARD_SCAN_MINUTES'] = int(os.getenv('DASHBOARD_SCAN_MINUTES', '30'))
+
+# Admin comp batches: QR codes and PDFs are rendered in a process pool, BULK_ISSUE_CHUNK tickets per task (0 processes renders inline)
+app.config['BULK_ISSUE_MAX'] = int(os.getenv('BULK_ISSUE_MAX', '5000'))
+app.config['BULK_ISSUE_PROCESSES'] = int(os.getenv('BULK_ISSUE_PROCESSES', str(min(4, os.cpu_count() or 1))))
+app.config['BULK_ISSUE_CHUNK'] = int(os.getenv('BULK_ISSUE_CHUNK', '100'))
+
+# Admin exports stream rows in batches of this size from a server-side cursor
+app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# Entrance scanner: seconds before the in-memory index of issued tickets is reloaded
+app.config['SCAN_INDEX_TTL'] = int(os.getenv('SCAN_INDEX_TTL', '300'))
+# Scan logs are buffered and written in batches; identical repeats inside the debounce window are dropped
+app.config['SCAN_LOG_BATCH_SIZE'] = int(os.getenv('SCAN_LOG_BATCH_SIZE', '50'))
+app.config['SCAN_LOG_FLUSH_SECONDS'] = float(os.getenv('SCAN_LOG_FLUSH_SECONDS', '2'))
+app.config['SCAN_LOG_DEBOUNCE_SECONDS'] = float(os.getenv('SCAN_LOG_DEBOUNCE_SECONDS', '3'))
+app.config['SCAN_LOG_MAX_BUFFER'] = int(os.getenv('SCAN_LOG_MAX_BUFFER', '10000'))
+
+# Instrumentation: request, SQL and span timings served at /metrics (bearer METRICS_TOKEN, or an admin session)
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+# Requests slower than this are logged with their query count and slowest statements
+app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+app.config['SLOW_REQUEST_QUERIES'] = int(os.getenv('SLOW_REQUEST_QUERIES', '5'))
 
 db = SQLAlchemy(app)
 
@@ -71,6 +192,11 @@ class TicketInstance(db.Model):
 
 class Ticket(db.Model):
     __tablename__ = 'tickets'
+    __table_args__ = (
+        db.Index('ix_tickets_client_created', 'client_id', 'created_at', 'id'),  # My Tickets keyset pages
+        db.Index('ix_tickets_payment', 'payment_id'),
+        db.Index('ix_tickets_instance_tier', 'ticket_instance_id', 'tier'),
+    )
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     client_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     ticket_instance_id = db.Column(
@@ -80,14 +206,19 @@ class Ticket(db.Model):
 )
 
     tier = db.Column(db.String(20), nullable=False)
-    qr_code_url = db.Column(db.Text, nullable=False)
-    qr_code_base64 = db.Column(db.Text, nullable=False)
+    qr_code_url = db.Column(db.Text, nullable=True)
+    qr_code_base64 = db.Column(db.Text, nullable=True)  # Only populated when QR_STORAGE is 'inline'
     scanned_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    pdf_path = db.Column(db.String(500), nullable=True)
+    pdf_path = db.Column(db.String(500), nullable=True)  # Artifact store key of the rendered PDF
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=True)
 
 class Payment(db.Model):
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_status_created', 'status', 'created_at'),  # Pending-payment reconciliation
+        db.Index('ix_payments_client', 'client_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     external_reference = db.Column(db.String(100), unique=True, nullable=False)
@@ -96,132 +227,2531 @@ class Payment(db.Model):
     payment_metadata = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     callback_received_at = db.Column(db.DateTime, nullable=True)
+    provider_reference = db.Column(db.String(100), nullable=True)  # PayHero's reference, used for status polling
+
+class ScanLog(db.Model):
+    __tablename__ = 'scan_logs'
+    __table_args__ = (
+        db.Index('ix_scan_logs_ticket_scanned', 'ticket_id', 'scanned_at'),
+        db.Index('ix_scan_logs_scanned', 'scanned_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    ticket_id = db.Column(db.String(36), nullable=True)
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
+    details = db.Column(db.Text, nullable=True)
+    result = db.Column(db.String(50), nullable=False)
+
+TICKET_TIERS = ('regular', 'vip', 'vvip')
+
+class Inventory(db.Model):
+    __tablename__ = 'inventory'
+    __table_args__ = (db.UniqueConstraint('ticket_instance_id', 'tier'),)
+    id = db.Column(db.Integer, primary_key=True)
+    ticket_instance_id = db.Column(db.Integer, db.ForeignKey('ticket_instances.id', ondelete='CASCADE'), nullable=False)
+    tier = db.Column(db.String(20), nullable=False)
+    stock = db.Column(db.Integer, nullable=True)  # None means unlimited
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    reserved = db.Column(db.Integer, nullable=False, default=0)
+
+class Reservation(db.Model):
+    __tablename__ = 'reservations'
+    __table_args__ = (
+        db.Index('ix_reservations_payment_status', 'payment_id', 'status'),
+        db.Index('ix_reservations_status_expires', 'status', 'expires_at'),  # Expired-hold sweep
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=False)
+    ticket_instance_id = db.Column(db.Integer, db.ForeignKey('ticket_instances.id', ondelete='SET NULL'), nullable=True)
+    tier = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='held')  # held, confirmed, released
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ProcessedCallback(db.Model):
+    __tablename__ = 'processed_callbacks'
+    id = db.Column(db.Integer, primary_key=True)
+    callback_key = db.Column(db.String(200), unique=True, nullable=False)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=False)
+    result_code = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(50), nullable=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FulfillmentJob(db.Model):
+    __tablename__ = 'fulfillment_jobs'
+    __table_args__ = (
+        db.Index('ix_fulfillment_jobs_status_run_after', 'status', 'run_after'),  # Job claiming
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), unique=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    stage = db.Column(db.String(20), nullable=False, default='issue')  # issue, render, email, done
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        db.UniqueConstraint('payment_id', 'kind'),  # One ticket email per payment
+        db.Index('ix_email_outbox_status_run_after', 'status', 'run_after'),  # Delivery claiming
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # tickets, pin_reset
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=True)  # Stored HTML for non-ticket mail; cleared once sent
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    provider_message_id = db.Column(db.Text, nullable=True)  # Space-separated, one per part of a split ticket email
+    parts_sent = db.Column(db.Integer, nullable=True)  # Parts of a split ticket email already delivered
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+class LoginThrottle(db.Model):
+    # Token buckets for LOGIN_THROTTLE_BACKEND='database' and the email send rate, shared by every worker process
+    __tablename__ = 'login_throttles'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(200), unique=True, nullable=False)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class WaitingRoomEntry(db.Model):
+    # A buyer queued for checkout; one table for every worker process, so there is a single line
+    __tablename__ = 'waiting_room_entries'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    joined_at = db.Column(db.Float, nullable=False, index=True)  # Epoch seconds, as signed into the queue token
+    last_seen = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class Admission(db.Model):
+    # admitted -> checkout (a /purchase is running) -> spent, or expired after ADMISSION_TTL
+    __tablename__ = 'admissions'
+    __table_args__ = (db.Index('ix_admissions_status_expires', 'status', 'expires_at'),)
+    id = db.Column(db.String(32), primary_key=True)  # The queue entry's id when admitted from the queue
+    user_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='admitted')
+    admitted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class WaitingRoomState(db.Model):
+    # A single row counting admissions that hold a slot, claimed with a conditional UPDATE so workers never over-admit
+    __tablename__ = 'waiting_room_state'
+    id = db.Column(db.Integer, primary_key=True)
+    active = db.Column(db.Integer, nullable=False, default=0)
+
+class SalesSummary(db.Model):
+    # Running totals per instance and tier, kept current by the callback and the scanner (see record_sales)
+    __tablename__ = 'sales_summary'
+    __table_args__ = (db.UniqueConstraint('ticket_instance_id', 'tier'),)
+    id = db.Column(db.Integer, primary_key=True)
+    ticket_instance_id = db.Column(db.Integer, nullable=True)  # No FK: sales of a deleted instance still count
+    tier = db.Column(db.String(20), nullable=False)
+    tickets_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    checked_in = db.Column(db.Integer, nullable=False, default=0)
+
+class ScanMinute(db.Model):
+    __tablename__ = 'scan_minutes'
+    __table_args__ = (db.UniqueConstraint('minute', 'result'),)
+    id = db.Column(db.Integer, primary_key=True)
+    minute = db.Column(db.DateTime, nullable=False)
+    result = db.Column(db.String(50), nullable=False)
+    scans = db.Column(db.Integer, nullable=False, default=0)
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Schema Migrations
+# Versioned, forward-only steps recorded in schema_migrations. db.create_all() builds missing tables (with their
+# indexes) and each migration brings existing databases up to date, so every step must be safe to re-run.
+MIGRATIONS = []
+MIGRATION_LOCK_KEY = 7254013  # Postgres advisory lock held while migrating, so concurrent workers take turns
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda step: step[0])
+        return fn
+    return register
+
+def create_indexes(*indexes):
+    postgres = db.engine.dialect.name == 'postgresql'
+    # CONCURRENTLY keeps Postgres tables writable during the build but cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for index in indexes:
+            columns = ', '.join(column.name for column in index.columns)
+            concurrently = 'CONCURRENTLY ' if postgres else ''
+            conn.execute(db.text(f'CREATE INDEX {concurrently}IF NOT EXISTS {index.name} ON {index.table.name} ({columns})'))
+            logger.info(f"Index {index.name} ready on {index.table.name} ({columns})")
+
+def model_index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+@migration(1, 'add nullable model columns and relax NOT NULL')
+def upgrade_schema():
+    # db.create_all() never alters existing tables, so add new nullable columns and relax NOT NULL by hand
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name']: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if not column.nullable:
+                continue
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logger.info(f"Added column {table.name}.{column.name}")
+            elif not existing[column.name]['nullable'] and db.engine.dialect.name == 'postgresql':
+                db.session.execute(db.text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL'))
+                logger.info(f"Dropped NOT NULL on {table.name}.{column.name}")
+    db.session.commit()
+
+@migration(2, 'indexes for ticket, payment, scan log, reservation and job lookups')
+def add_lookup_indexes():
+    create_indexes(
+        model_index(Ticket, 'ix_tickets_client_created'),
+        model_index(Ticket, 'ix_tickets_payment'),
+        model_index(Ticket, 'ix_tickets_instance_tier'),
+        model_index(Payment, 'ix_payments_status_created'),
+        model_index(Payment, 'ix_payments_client'),
+        model_index(ScanLog, 'ix_scan_logs_ticket_scanned'),
+        model_index(ScanLog, 'ix_scan_logs_scanned'),
+        model_index(Reservation, 'ix_reservations_payment_status'),
+        model_index(Reservation, 'ix_reservations_status_expires'),
+        model_index(FulfillmentJob, 'ix_fulfillment_jobs_status_run_after'),
+    )
+
+@migration(3, 'backfill dashboard summary tables')
+def backfill_dashboard_summaries():
+    rebuild_dashboard_summaries()
+
+@migration(4, 'relax NOT NULL on SQLite by rebuilding tables')
+def rebuild_sqlite_tables():
+    # SQLite cannot ALTER a column's NOT NULL, so migration 1 only relaxed Postgres. Copy each affected table into
+    # a reflected twin with the model's nullability, then swap it in and rebuild its indexes.
+    if db.engine.dialect.name != 'sqlite':
+        return
+    db.session.commit()
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name']: column for column in inspector.get_columns(table.name)}
+        relaxed = [column.name for column in table.columns
+                   if column.nullable and column.name in existing and not existing[column.name]['nullable']]
+        if not relaxed:
+            continue
+        staging = f'_rebuild_{table.name}'
+        with db.engine.begin() as conn:
+            reflected = db.Table(table.name, db.MetaData(), autoload_with=conn)
+            indexes = list(reflected.indexes)
+            rebuilt = db.Table(staging, reflected.metadata, *[column._copy() for column in reflected.columns],
+                               *[constraint._copy() for constraint in reflected.constraints
+                                 if not isinstance(constraint, db.PrimaryKeyConstraint)])
+            for name in relaxed:
+                rebuilt.columns[name].nullable = True
+            columns = ', '.join(column.name for column in reflected.columns)
+            conn.execute(db.text(f'DROP TABLE IF EXISTS {staging}'))
+            rebuilt.create(conn)
+            conn.execute(db.text(f'INSERT INTO {staging} ({columns}) SELECT {columns} FROM {table.name}'))
+            conn.execute(db.text(f'DROP TABLE {table.name}'))
+            conn.execute(db.text(f'ALTER TABLE {staging} RENAME TO {table.name}'))
+            for index in indexes:
+                index.create(conn)
+        logger.info(f"Rebuilt {table.name} to drop NOT NULL on {', '.join(relaxed)}")
+
+@migration(5, 'track delivered parts of split ticket emails')
+def track_email_parts():
+    upgrade_schema()  # Adds email_outbox.parts_sent
+    if db.engine.dialect.name == 'postgresql':
+        # Room for one provider id per part; SQLite does not enforce VARCHAR lengths
+        db.session.execute(db.text('ALTER TABLE email_outbox ALTER COLUMN provider_message_id TYPE TEXT'))
+        db.session.commit()
+
+def applied_migrations():
+    return {row.version: row for row in SchemaMigration.query.all()}
+
+def run_migrations():
+    """Apply pending migrations in version order; returns the versions applied."""
+    postgres = db.engine.dialect.name == 'postgresql'
+    applied_now = []
+    with db.engine.connect() as lock_conn:
+        if postgres:
+            lock_conn.execute(db.text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            applied = applied_migrations()
+            for version, name, fn in MIGRATIONS:
+                if version in applied:
+                    continue
+                started = time.perf_counter()
+                fn()
+                db.session.add(SchemaMigration(version=version, name=name))
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # Another process without the advisory lock (SQLite) recorded it first
+                    db.session.rollback()
+                    continue
+                applied_now.append(version)
+                logger.info(f"Applied migration {version}: {name} ({time.perf_counter() - started:.2f}s)")
+        finally:
+            if postgres:
+                lock_conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+    return applied_now
+
+def init_database():
+    """Create missing tables and apply pending migrations (flask schema upgrade)."""
+    db.create_all()
+    applied = run_migrations()
+    logger.info("Database tables created successfully")
+    return applied
+
+# Instrumentation
+# Per-process counters and histograms in Prometheus text format. Under gunicorn each worker keeps its own,
+# so a scrape sees whichever worker answered it.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+METRICS = {
+    'ticketing_http_requests_total': ('counter', 'Requests handled, by route and status', None),
+    'ticketing_http_request_duration_seconds': ('histogram', 'Time to build the response, by route', LATENCY_BUCKETS),
+    'ticketing_db_queries_per_request': ('histogram', 'SQL statements issued per request, by route', QUERY_COUNT_BUCKETS),
+    'ticketing_db_query_duration_seconds': ('histogram', 'SQL statement time, by route (background outside requests)',
+                                            LATENCY_BUCKETS),
+    'ticketing_span_duration_seconds': ('histogram', 'Time in QR, PDF, email and PayHero calls', LATENCY_BUCKETS),
+}
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # Per-bucket counts, then sum and count; made cumulative when rendered
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self, gauges=()):
+        """Prometheus text exposition; gauges are (name, help, [(labels dict, value)]) computed by the caller."""
+        with self.lock:
+            snapshot = sorted((key, list(value) if isinstance(value, list) else value)
+                              for key, value in self.series.items())
+        lines = []
+        for name, (kind, text, buckets) in METRICS.items():
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} {kind}']
+            for (series_name, labels), value in snapshot:
+                if series_name != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f'{name}{metric_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{metric_labels(labels + (("le", repr(float(bound))),))} {cumulative}')
+                lines.append(f'{name}_bucket{metric_labels(labels + (("le", "+Inf"),))} {value[-1]}')
+                lines.append(f'{name}_sum{metric_labels(labels)} {round(value[-2], 6)}')
+                lines.append(f'{name}_count{metric_labels(labels)} {value[-1]}')
+        for name, text, samples in gauges:
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} gauge']
+            lines += [f'{name}{metric_labels(tuple(sorted(labels.items())))} {value}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+def request_route():
+    # The URL rule, not the path, so ticket IDs and references do not each become a series
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+@contextmanager
+def span(name):
+    """Time a block into the span histogram and, inside a request, its slow-request breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if app.config['METRICS_ENABLED']:
+            elapsed = time.perf_counter() - started
+            metrics.observe('ticketing_span_duration_seconds', {'span': name}, elapsed)
+            if has_request_context() and 'metrics_spans' in g:
+                g.metrics_spans[name] = g.metrics_spans.get(name, 0) + elapsed
+
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None or not app.config['METRICS_ENABLED']:
+        return
+    elapsed = time.perf_counter() - started
+    route = 'background'
+    if has_request_context() and 'metrics_queries' in g:
+        g.metrics_queries.append((elapsed, statement))
+        route = request_route()
+    metrics.observe('ticketing_db_query_duration_seconds', {'route': route}, elapsed)
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = []
+        g.metrics_spans = {}
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metrics_started' not in g:
+        return response
+    # Streamed bodies (exports, zips) are timed to their first byte, not to the end of the download
+    elapsed = time.perf_counter() - g.metrics_started
+    route = request_route()
+    queries = g.metrics_queries
+    metrics.inc('ticketing_http_requests_total', {'method': request.method, 'route': route,
+                                                   'status': str(response.status_code)})
+    metrics.observe('ticketing_http_request_duration_seconds', {'method': request.method, 'route': route}, elapsed)
+    metrics.observe('ticketing_db_queries_per_request', {'method': request.method, 'route': route}, len(queries))
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        slowest = sorted(queries, key=lambda query: query[0], reverse=True)[:app.config['SLOW_REQUEST_QUERIES']]
+        spans = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in g.metrics_spans.items()) or 'none'
+        statements = ' | '.join(f"{seconds * 1000:.1f}ms {' '.join(statement.split())[:200]}"
+                                for seconds, statement in slowest) or 'none'
+        logger.warning(f"Slow request {request.method} {route} -> {response.status_code} in {elapsed * 1000:.0f}ms: "
+                       f"{len(queries)} queries taking {sum(query[0] for query in queries) * 1000:.0f}ms; "
+                       f"spans: {spans}; slowest: {statements}")
+    return response
+
+# Helper Functions
+def ticket_signing_key():
+    # Shared with admin scanners through the manifest, so never hand out SECRET_KEY itself
+    key = os.getenv('TICKET_SIGNING_KEY')
+    if key:
+        return key.encode()
+    return hmac.new((app.config['SECRET_KEY'] or '').encode(), b'ticket-signing', hashlib.sha256).digest()
+
+def sign_ticket(ticket_id, instance_id, tier):
+    message = f"{ticket_id}.{instance_id}.{tier}".encode()
+    digest = hmac.new(ticket_signing_key(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip('=')
+
+def ticket_verify_url(ticket_id, instance_id, tier):
+    # The QR payload carries instance, tier and an HMAC so scanners can validate it offline
+    base_url = os.getenv('REPLIT_DEV_DOMAIN', 'localhost:5000')
+    if not base_url.startswith('http'):
+        base_url = f'https://{base_url}'
+    signature = sign_ticket(ticket_id, instance_id, tier)
+    return f"{base_url}/ticket/verify/{ticket_id}?i={instance_id}&t={tier}&s={signature}"
+
+QR_BOX_SIZE = 10
+QR_BORDER = 5
+
+@lru_cache(maxsize=4096)
+def qr_matrix(qr_url):
+    import qrcode
+    # Module grid including the quiet-zone border; building it (mask selection) is the slow part of a QR
+    qr = qrcode.QRCode(version=1, box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(qr_url)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+@lru_cache(maxsize=4096)
+def render_qr_png(qr_url):
+    from PIL import Image
+    matrix = qr_matrix(qr_url)
+    img = Image.new('1', (len(matrix), len(matrix)), 1)
+    img.putdata([0 if module else 1 for row in matrix for module in row])
+    img = img.resize((len(matrix) * QR_BOX_SIZE, len(matrix) * QR_BOX_SIZE), Image.NEAREST)
+    
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@timed('generate_qr_code')
+def generate_qr_code(ticket_id, instance_id, tier):
+    qr_url = ticket_verify_url(ticket_id, instance_id, tier)
+    img_base64 = base64.b64encode(render_qr_png(qr_url)).decode()
+    return img_base64, qr_url
+
+def ticket_qr_matrix(ticket):
+    # Tickets issued in 'inline' mode carry their PNG, so sample it instead of re-encoding the QR
+    if ticket.qr_code_base64:
+        from PIL import Image
+        img = Image.open(BytesIO(base64.b64decode(ticket.qr_code_base64))).convert('1')
+        modules = img.width // QR_BOX_SIZE
+        img = img.resize((modules, modules), Image.NEAREST)
+        pixels = list(img.getdata())
+        return tuple(tuple(pixels[r * modules + c] == 0 for c in range(modules)) for r in range(modules))
+    return qr_matrix(ticket_verify_url(ticket.id, ticket.ticket_instance_id, ticket.tier))
+
+def draw_qr(c, matrix, x, y, size):
+    # Vector modules (one rect per horizontal run) print crisper and skip PDF image encoding
+    module = size / len(matrix)
+    path = c.beginPath()
+    for r, row in enumerate(matrix):
+        top = y + size - (r + 1) * module
+        col = 0
+        while col < len(row):
+            if not row[col]:
+                col += 1
+                continue
+            start = col
+            while col < len(row) and row[col]:
+                col += 1
+            path.rect(x + start * module, top, (col - start) * module, module)
+    c.saveState()
+    c.setFillColorRGB(1, 1, 1)
+    c.rect(x, y, size, size, stroke=0, fill=1)
+    c.setFillColorRGB(0, 0, 0)
+    c.drawPath(path, stroke=0, fill=1)
+    c.restoreState()
+
+def draw_ticket_template(c, instance):
+    # Everything that is the same for every ticket of an instance, recorded once per document as a form XObject.
+    # A form cannot be shared across documents, so single-ticket PDFs still draw it; only multi-page ones reuse it
+    width, height = letter
+    c.beginForm(f'ticket-template-{instance.id}')
+    
+    # Red/Black Halloween theme
+    c.setFillColorRGB(0.1, 0, 0)
+    c.rect(0, 0, width, height, fill=True)
+    
+    c.setFillColorRGB(0.8, 0, 0)
+    c.rect(0.5*inch, height - 2*inch, width - 1*inch, 1.5*inch, fill=True)
+    
+    c.setFillColorRGB(1, 1, 1)
+    c.setFont("Helvetica-Bold", 36)
+    c.drawCentredString(width/2, height - 1.2*inch, "THE DARK ORDER")
+    
+    c.setFont("Helvetica-Bold", 24)
+    c.drawCentredString(width/2, height - 1.6*inch, "HALLOWEEN PLAY & PARTY")
+    
+    c.setFillColorRGB(0.9, 0.9, 0.9)
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(1*inch, height - 3*inch, f"Ticket Instance: {instance.name}")
+    capacity_text = f"Covers: {instance.capacity} {'person' if instance.capacity == 1 else 'people'}"
+    c.drawString(1*inch, height - 4*inch, capacity_text)
+    
+    c.setFillColorRGB(0.8, 0, 0)
+    c.setFont("Helvetica-Bold", 14)
+    c.drawCentredString(width/2, height - 9*inch, "SCAN QR CODE AT ENTRANCE")
+    
+    c.endForm()
+
+def draw_ticket_page(c, ticket, user_email, templates, generated_at):
+    width, height = letter
+    instance = ticket.ticket_instance
+    if instance.id not in templates:
+        draw_ticket_template(c, instance)
+        templates.add(instance.id)
+    c.doForm(f'ticket-template-{instance.id}')
+    
+    # Per-ticket stamp: tier, id, owner and the stored (or cached) QR
+    c.setFillColorRGB(0.9, 0.9, 0.9)
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(1*inch, height - 3.5*inch, f"Tier: {ticket.tier.upper()}")
+    c.drawString(1*inch, height - 4.5*inch, f"Ticket ID: {ticket.id}")
+    c.drawString(1*inch, height - 5*inch, f"Email: {user_email}")
+    
+    draw_qr(c, ticket_qr_matrix(ticket), width/2 - 1.5*inch, height - 8.5*inch, 3*inch)
+    
+    c.setFillColorRGB(0.6, 0.6, 0.6)
+    c.setFont("Helvetica", 10)
+    c.drawCentredString(width/2, 1*inch, f"Generated: {generated_at}")
+    c.showPage()
+
+@timed('generate_pdf_ticket')
+def generate_pdf_ticket(ticket, user_email):
+    from reportlab.pdfgen import canvas
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    generated_at = f"{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"
+    draw_ticket_page(c, ticket, user_email, set(), generated_at)
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+def generate_pdf_tickets(tickets, user_email):
+    # One page per ticket; pages of the same instance share a single template form
+    from reportlab.pdfgen import canvas
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    generated_at = f"{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"
+    templates = set()
+    for ticket in tickets:
+        draw_ticket_page(c, ticket, user_email, templates, generated_at)
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+def generate_ticket_zip(tickets, user_email):
+    buffer = BytesIO()
+    # PDFs are already compressed, so store them rather than deflating again
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for ticket in tickets:
+            archive.writestr(f"ticket_{ticket.id}.pdf", ticket_pdf_bytes(ticket, user_email))
+    buffer.seek(0)
+    return buffer
+
+# Ticket Artifacts
+# Bump when draw_ticket_template or draw_ticket_page change; PDFs stored under an older version are re-rendered
+TICKET_TEMPLATE_VERSION = 1
+
+class LocalArtifactStore:
+    """Files under a directory, keyed by namespace and the SHA-256 of their bytes, so a key never changes meaning."""
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, namespace, content, extension):
+        digest = hashlib.sha256(content).hexdigest()
+        key = f"{namespace}/{digest[:2]}/{digest}.{extension}"
+        path = self.local_path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as handle:
+                handle.write(content)
+            os.replace(temp_path, path)
+        return key
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def read(self, key):
+        with open(self.local_path(key), 'rb') as handle:
+            return handle.read()
+
+ARTIFACT_STORES = {'local': lambda: LocalArtifactStore(app.config['ARTIFACT_DIR'])}
+artifact_store = None
+
+def get_artifact_store():
+    global artifact_store
+    if artifact_store is None:
+        artifact_store = ARTIFACT_STORES[app.config['ARTIFACT_STORE']]()
+    return artifact_store
+
+class ArtifactStats:
+    # Per-process counts of stored-PDF lookups, for /admin/artifact-stats
+    def __init__(self):
+        self.counts = {'hits': 0, 'misses': 0, 'stale': 0}
+        self.lock = threading.Lock()
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = counts['hits'] + counts['misses'] + counts['stale']
+        counts['hit_rate'] = round(counts['hits'] / lookups, 4) if lookups else 0
+        return counts
+
+artifact_stats = ArtifactStats()
+
+def ticket_artifact_namespace():
+    return f"tickets/v{TICKET_TEMPLATE_VERSION}"
+
+def stored_ticket_pdf(ticket, user_email):
+    """Artifact key of the ticket's PDF, rendering and recording it in pdf_path when missing or stale (caller commits)."""
+    store = get_artifact_store()
+    namespace = ticket_artifact_namespace()
+    if ticket.pdf_path and ticket.pdf_path.startswith(namespace + '/') and store.exists(ticket.pdf_path):
+        artifact_stats.record('hits')
+        return ticket.pdf_path
+    artifact_stats.record('stale' if ticket.pdf_path else 'misses')
+    ticket.pdf_path = store.put(namespace, generate_pdf_ticket(ticket, user_email).getvalue(), 'pdf')
+    return ticket.pdf_path
+
+def ticket_pdf_bytes(ticket, user_email):
+    return get_artifact_store().read(stored_ticket_pdf(ticket, user_email))
+
+def send_artifact(key, download_name, mimetype):
+    # The key's digest is a strong ETag; send_file answers If-None-Match with 304 and Range with 206
+    store = get_artifact_store()
+    etag = key.rsplit('/', 1)[-1].split('.')[0]
+    if hasattr(store, 'local_path'):
+        source = store.local_path(key)
+    else:
+        source = BytesIO(store.read(key))
+    response = send_file(source, as_attachment=True, download_name=download_name, mimetype=mimetype,
+                         conditional=True, etag=etag)
+    response.cache_control.private = True
+    return response
+
+def build_ticket_attachments(tickets, user_email, part=1, parts=1):
+    mode = app.config['TICKET_ATTACHMENT_MODE']
+    if mode == 'separate':
+        return [(f"ticket_{ticket.id}.pdf", 'application/pdf', ticket_pdf_bytes(ticket, user_email))
+                for ticket in tickets]
+
+    if mode == 'zip':
+        content, extension, mime_type = generate_ticket_zip(tickets, user_email), 'zip', 'application/zip'
+    else:
+        content, extension, mime_type = generate_pdf_tickets(tickets, user_email), 'pdf', 'application/pdf'
+    filename = f"tickets.{extension}" if parts == 1 else f"tickets_{part}_of_{parts}.{extension}"
+    return [(filename, mime_type, content.getvalue())]
+
+@timed('send_email_with_tickets')
+def send_email_with_tickets(to_email, tickets, user, parts_sent=0, on_part_sent=None, before_send=None):
+    """Send the tickets through the mail transport; raises on failure so the outbox can retry.
+
+    Tickets go out EMAIL_TICKETS_PER_PART to an email, in the order given, so a part always holds the same tickets.
+    Parts up to parts_sent went out on an earlier attempt and are neither rendered nor sent again;
+    on_part_sent(part, message_id) runs after each part so a later failure does not resend it. before_send() runs
+    just before each part is handed to the transport and may raise to stop the send.
+    """
+    parts = chunked(tickets, max(1, app.config['EMAIL_TICKETS_PER_PART']))
+    transport = get_mail_transport()
+
+    for part, part_tickets in enumerate(parts, 1):
+        if part <= parts_sent:
+            continue
+        attachments = build_ticket_attachments(part_tickets, to_email, part, len(parts))
+        part_note = f" (part {part} of {len(parts)})" if len(parts) > 1 else ""
+        body = f"""
+        <html>
+        <body style="background-color: #1a0000; color: #ffffff; font-family: Arial, sans-serif; padding: 20px;">
+            <h1 style="color: #cc0000;">THE DARK ORDER HALLOWEEN PLAY & PARTY</h1>
+            <p>Dear Guest,</p>
+            <p>Your tickets have been confirmed! Please find your ticket(s) attached{part_note}.</p>
+            <p>Each ticket contains a unique QR code. Please present this QR code at the entrance.</p>
+            <p style="color: #cc0000;"><strong>Total Tickets: {len(tickets)}</strong></p>
+            <p>We look forward to seeing you at the event!</p>
+            <p style="color: #666;">This is an automated email. Please do not reply.</p>
+        </body>
+        </html>
+        """
+        email_rate_limiter.acquire()  # Per part: each one is a separate send
+        if before_send:
+            before_send()
+        message_id = transport.send(to_email, f"Your Dark Order Halloween Tickets{part_note}", body, attachments)
+        if on_part_sent:
+            on_part_sent(part, message_id)
+
+    logger.info(f"Email sent successfully to {to_email} with {len(tickets)} tickets in {len(parts)} message(s) "
+                f"via {app.config['EMAIL_TRANSPORT']}")
+
+# Ticket Catalog
+class InstanceCatalog:
+    # TicketInstance rows only change through the admin pages, so buyers read a cached copy
+    def __init__(self):
+        self.instances = []
+        self.etag = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        rows = db.session.query(
+            TicketInstance.id, TicketInstance.name, TicketInstance.capacity,
+            TicketInstance.regular_price, TicketInstance.vip_price, TicketInstance.vvip_price
+        ).order_by(TicketInstance.id).all()
+        instances = [{
+            'id': row.id,
+            'name': row.name,
+            'capacity': row.capacity,
+            'regular_price': row.regular_price,
+            'vip_price': row.vip_price,
+            'vvip_price': row.vvip_price
+        } for row in rows]
+        etag = hashlib.sha1(json.dumps(instances, sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            self.instances, self.etag, self.loaded_at = instances, etag, time.monotonic()
+        return instances
+
+    def get(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= app.config['CATALOG_TTL']:
+            return self.load()
+        return self.instances
+
+    def invalidate(self):
+        self.loaded_at = None
+
+instance_catalog = InstanceCatalog()
+
+# Inventory
+def ensure_inventory(instance_id, tier, stock=None):
+    if Inventory.query.filter_by(ticket_instance_id=instance_id, tier=tier).first():
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Inventory(ticket_instance_id=instance_id, tier=tier, stock=stock, sold=0, reserved=0))
+    except IntegrityError:
+        pass  # Created by a concurrent checkout
+
+def valid_stock(stock):
+    # None is unlimited; bool is an int subclass, so rule it out explicitly
+    return stock is None or (isinstance(stock, int) and not isinstance(stock, bool) and stock >= 0)
+
+def hold_stock(instance_id, tier, quantity):
+    return Inventory.query.filter(
+        Inventory.ticket_instance_id == instance_id,
+        Inventory.tier == tier,
+        db.or_(Inventory.stock.is_(None), Inventory.sold + Inventory.reserved + quantity <= Inventory.stock)
+    ).update({'reserved': Inventory.reserved + quantity}, synchronize_session=False)
+
+def sell_stock(instance_id, tier, quantity):
+    # Comp batches skip the hold and go straight to sold, within the same stock limit
+    return Inventory.query.filter(
+        Inventory.ticket_instance_id == instance_id,
+        Inventory.tier == tier,
+        db.or_(Inventory.stock.is_(None), Inventory.sold + Inventory.reserved + quantity <= Inventory.stock)
+    ).update({'sold': Inventory.sold + quantity}, synchronize_session=False)
+
+def reserve_cart(payment, cart):
+    """Hold stock for every cart line (caller commits or rolls back).
+
+    Returns None on success, or the (instance_id, tier) that is sold out.
+    """
+    quantities = {}
+    for item in cart:
+        key = (item['instance_id'], item['tier'])
+        quantities[key] = quantities.get(key, 0) + item['quantity']
+
+    expires_at = datetime.utcnow() + timedelta(seconds=app.config['RESERVATION_TTL'])
+    # Fixed lock order so two carts touching the same rows cannot deadlock
+    for (instance_id, tier), quantity in sorted(quantities.items()):
+        held = hold_stock(instance_id, tier, quantity)
+        if not held and not Inventory.query.filter_by(ticket_instance_id=instance_id, tier=tier).first():
+            # Instances created before inventory existed get an unlimited row on first sale
+            ensure_inventory(instance_id, tier)
+            held = hold_stock(instance_id, tier, quantity)
+        if not held:
+            return instance_id, tier
+        db.session.add(Reservation(payment_id=payment.id, ticket_instance_id=instance_id, tier=tier,
+                                   quantity=quantity, status='held', expires_at=expires_at))
+    return None
+
+def release_reservations(payment_id):
+    # Caller commits; only holds still in 'held' give their stock back
+    released = 0
+    for reservation in Reservation.query.filter_by(payment_id=payment_id, status='held').all():
+        moved = Reservation.query.filter_by(id=reservation.id, status='held').update(
+            {'status': 'released'}, synchronize_session=False)
+        if moved:
+            Inventory.query.filter_by(ticket_instance_id=reservation.ticket_instance_id, tier=reservation.tier).update(
+                {'reserved': Inventory.reserved - reservation.quantity}, synchronize_session=False)
+            released += reservation.quantity
+    return released
+
+def confirm_reservations(payment_id):
+    # Caller commits; a hold that already expired is still sold because the buyer has paid
+    for reservation in Reservation.query.filter(Reservation.payment_id == payment_id,
+                                                Reservation.status != 'confirmed').all():
+        moved = Reservation.query.filter_by(id=reservation.id, status=reservation.status).update(
+            {'status': 'confirmed'}, synchronize_session=False)
+        if not moved:
+            continue
+        changes = {'sold': Inventory.sold + reservation.quantity}
+        if reservation.status == 'held':
+            changes['reserved'] = Inventory.reserved - reservation.quantity
+        else:
+            logger.warning(f"Payment {payment_id} succeeded after its hold expired; selling {reservation.quantity} past the hold")
+        Inventory.query.filter_by(ticket_instance_id=reservation.ticket_instance_id, tier=reservation.tier).update(
+            changes, synchronize_session=False)
+
+def release_expired_reservations():
+    payment_ids = [row.payment_id for row in db.session.query(Reservation.payment_id).filter(
+        Reservation.status == 'held', Reservation.expires_at < datetime.utcnow()
+    ).distinct()]
+    released = 0
+    for payment_id in payment_ids:
+        released += release_reservations(payment_id)
+    db.session.commit()
+    if released:
+        logger.info(f"Released {released} expired ticket holds from {len(payment_ids)} payments")
+    return released
+
+# Dashboard Summaries
+def bump_counters(model, key, **deltas):
+    """Add deltas to the summary row for key, creating the row on first use (caller commits)."""
+    changes = {getattr(model, name): getattr(model, name) + delta for name, delta in deltas.items()}
+    if model.query.filter_by(**key).update(changes, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**key, **deltas))
+    except IntegrityError:
+        # A concurrent transaction created the row first
+        model.query.filter_by(**key).update(changes, synchronize_session=False)
+
+def cart_sales(payment):
+    """Quantity and revenue per (instance, tier) in a payment's cart."""
+    sales = {}
+    for item in json.loads(payment.payment_metadata or '[]'):
+        price = item.get('unit_price')
+        if price is None:
+            # Carts from before the charged price was recorded use the current price
+            instance = db.session.get(TicketInstance, item['instance_id'])
+            price = (getattr(instance, f"{item['tier']}_price", None) if instance else None) or 0
+        quantity, revenue = sales.get((item['instance_id'], item['tier']), (0, 0))
+        sales[(item['instance_id'], item['tier'])] = (quantity + item['quantity'], revenue + price * item['quantity'])
+    return sales
+
+def record_sales(payment):
+    # Sorted so concurrent callbacks touch summary rows in the same order
+    for (instance_id, tier), (quantity, revenue) in sorted(cart_sales(payment).items()):
+        bump_counters(SalesSummary, {'ticket_instance_id': instance_id, 'tier': tier},
+                      tickets_sold=quantity, revenue=revenue)
+
+def record_check_in(entry):
+    bump_counters(SalesSummary, {'ticket_instance_id': entry['instance_id'], 'tier': entry['tier']}, checked_in=1)
+
+def record_scan_minutes(scans):
+    counts = {}
+    for scanned_at, result in scans:
+        key = (scanned_at.replace(second=0, microsecond=0), result)
+        counts[key] = counts.get(key, 0) + 1
+    for (minute, result), count in sorted(counts.items()):
+        bump_counters(ScanMinute, {'minute': minute, 'result': result}, scans=count)
+
+def rebuild_dashboard_summaries():
+    """Recompute the summary tables from payments, tickets and scan logs; full scans, so run it offline."""
+    totals = {}
+    # Comp batches count as issued tickets with no revenue
+    for payment in Payment.query.filter(Payment.status.in_(['success', 'comp'])).yield_per(500):
+        for key, (quantity, revenue) in cart_sales(payment).items():
+            row = totals.setdefault(key, {'tickets_sold': 0, 'revenue': 0, 'checked_in': 0})
+            row['tickets_sold'] += quantity
+            row['revenue'] += revenue
+    checked_in = db.session.query(Ticket.ticket_instance_id, Ticket.tier, db.func.count(Ticket.id)) \
+        .filter(Ticket.scanned_at.isnot(None)).group_by(Ticket.ticket_instance_id, Ticket.tier)
+    for instance_id, tier, count in checked_in:
+        totals.setdefault((instance_id, tier), {'tickets_sold': 0, 'revenue': 0, 'checked_in': 0})['checked_in'] = count
+
+    minutes = {}
+    for scanned_at, result in db.session.query(ScanLog.scanned_at, ScanLog.result).yield_per(5000):
+        if scanned_at:
+            key = (scanned_at.replace(second=0, microsecond=0), result)
+            minutes[key] = minutes.get(key, 0) + 1
+
+    SalesSummary.query.delete()
+    ScanMinute.query.delete()
+    if totals:
+        db.session.execute(db.insert(SalesSummary), [
+            {'ticket_instance_id': instance_id, 'tier': tier, **row} for (instance_id, tier), row in totals.items()])
+    if minutes:
+        db.session.execute(db.insert(ScanMinute), [
+            {'minute': minute, 'result': result, 'scans': count} for (minute, result), count in minutes.items()])
+    db.session.commit()
+    logger.info(f"Rebuilt dashboard summaries: {len(totals)} instance tiers, {len(minutes)} scan minutes")
+    return len(totals), len(minutes)
+
+def dashboard_snapshot():
+    """Sales, revenue, check-ins and recent scan rate, read only from the summary tables."""
+    names = {instance['id']: instance['name'] for instance in instance_catalog.get()}
+    instances = {}
+    totals = {'tickets_sold': 0, 'revenue': 0, 'checked_in': 0}
+    for row in SalesSummary.query.order_by(SalesSummary.ticket_instance_id, SalesSummary.tier).all():
+        instance = instances.setdefault(row.ticket_instance_id, {
+            'id': row.ticket_instance_id,
+            'name': names.get(row.ticket_instance_id, 'Removed event'),
+            'tiers': {},
+            'tickets_sold': 0, 'revenue': 0, 'checked_in': 0
+        })
+        tier = instance['tiers'].setdefault(row.tier, {'tickets_sold': 0, 'revenue': 0, 'checked_in': 0})
+        for name in totals:
+            value = getattr(row, name)
+            tier[name] += value
+            instance[name] += value
+            totals[name] += value
+    for summary in [totals, *instances.values()]:
+        summary['check_in_rate'] = round(summary['checked_in'] / summary['tickets_sold'], 4) if summary['tickets_sold'] else 0
+
+    window = app.config['DASHBOARD_SCAN_MINUTES']
+    current = datetime.utcnow().replace(second=0, microsecond=0)
+    since = current - timedelta(minutes=window - 1)
+    per_minute = {since + timedelta(minutes=i): {'valid': 0, 'already_scanned': 0, 'invalid': 0} for i in range(window)}
+    for row in ScanMinute.query.filter(ScanMinute.minute >= since).all():
+        if row.minute in per_minute:
+            per_minute[row.minute][row.result] = per_minute[row.minute].get(row.result, 0) + row.scans
+    return {
+        'totals': totals,
+        'instances': sorted(instances.values(), key=lambda instance: (instance['id'] is None, instance['id'] or 0)),
+        'scans_per_minute': [{'minute': minute.strftime('%Y-%m-%dT%H:%M:00Z'), **counts, 'total': sum(counts.values())}
+                             for minute, counts in sorted(per_minute.items())]
+    }
+
+class DashboardFeed:
+    # One snapshot per cache interval per process, however many admin screens are polling
+    def __init__(self):
+        self.snapshot = None
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= app.config['DASHBOARD_CACHE_SECONDS']:
+                snapshot = dashboard_snapshot()
+                self.version = hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+                self.snapshot = dict(snapshot, version=self.version)
+                self.loaded_at = time.monotonic()
+            return self.snapshot
+
+dashboard_feed = DashboardFeed()
+
+# Payment Settlement
+def settle_payment(payment, is_success):
+    """Move a payment to its final state once (caller commits); returns whether this call did it."""
+    now = datetime.utcnow()
+    if is_success:
+        # Only the call that flips the status enqueues; a late success may still override a failed STK push
+        transitioned = Payment.query.filter(
+            Payment.id == payment.id,
+            Payment.status.in_(['pending', 'failed'])
+        ).update({'status': 'success', 'callback_received_at': now}, synchronize_session=False)
+        if transitioned:
+            confirm_reservations(payment.id)
+            record_sales(payment)
+            # Tickets, PDFs and email are produced by the fulfillment workers
+            enqueue_fulfillment(payment)
+    else:
+        transitioned = Payment.query.filter(
+            Payment.id == payment.id,
+            Payment.status == 'pending'
+        ).update({'status': 'failed', 'callback_received_at': now}, synchronize_session=False)
+        if transitioned:
+            release_reservations(payment.id)
+    return transitioned
+
+# PayHero Client
+class PayHeroClient:
+    def __init__(self):
+        self.session = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    session = requests.Session()
+                    # POSTs are only retried when the connection failed, so an STK push is never sent twice
+                    retry = Retry(
+                        total=app.config['PAYHERO_RETRIES'],
+                        connect=app.config['PAYHERO_RETRIES'],
+                        read=0,
+                        status=app.config['PAYHERO_RETRIES'],
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset(['GET']),
+                        backoff_factor=0.5
+                    )
+                    adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+                                          pool_maxsize=app.config['PAYHERO_POOL_SIZE'])
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({
+                        'Authorization': f'Basic {os.getenv("PAYHERO_BASIC_AUTH_TOKEN")}',
+                        'Content-Type': 'application/json'
+                    })
+                    self.session = session
+        return self.session
+
+    def timeout(self):
+        return (app.config['PAYHERO_CONNECT_TIMEOUT'], app.config['PAYHERO_READ_TIMEOUT'])
+
+    @timed('payhero_stk_push')
+    def stk_push(self, payload):
+        response = self.get_session().post(f"{app.config['PAYHERO_BASE_URL']}/api/v2/payments",
+                                           json=payload, timeout=self.timeout())
+        return response.status_code, response.json()
+
+    @timed('payhero_transaction_status')
+    def transaction_status(self, provider_reference):
+        response = self.get_session().get(f"{app.config['PAYHERO_BASE_URL']}/api/v2/transaction-status",
+                                          params={'reference': provider_reference}, timeout=self.timeout())
+        response.raise_for_status()
+        return response.json()
+
+    def submit(self, fn, *args):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=app.config['PAYHERO_POOL_SIZE'],
+                                                       thread_name_prefix='payhero')
+        return self.executor.submit(fn, *args)
+
+payhero_client = PayHeroClient()
+
+def initiate_stk_push(payment_id, payload):
+    """Send the STK push for a pending payment; returns (ok, response data or error message)."""
+    try:
+        status_code, response_data = payhero_client.stk_push(payload)
+        logger.info(f"PayHero Response: {response_data}")
+    except Exception as e:
+        status_code, response_data = None, {'message': f'Payment system error: {str(e)}'}
+        logger.error(f"STK Push failed: {str(e)}")
+
+    payment = db.session.get(Payment, payment_id)
+    if status_code in (200, 201):
+        payment.provider_reference = response_data.get('reference')
+        db.session.commit()
+        logger.info(f"STK Push initiated for {payload['phone_number']}, amount: {payload['amount']}, ref: {payment.external_reference}")
+        return True, response_data
+
+    if status_code is not None:
+        logger.error(f"PayHero error: {response_data}")
+    settle_payment(payment, False)
+    db.session.commit()
+    return False, response_data.get('message', 'Payment initiation failed')
+
+def run_stk_push_in_background(payment_id, payload):
+    with app.app_context():
+        try:
+            initiate_stk_push(payment_id, payload)
+        except Exception as e:
+            logger.error(f"Background STK push for payment {payment_id} crashed: {str(e)}")
+
+reconcile_cursor = None  # (created_at, id) of the last payment checked, so passes page on past ones PayHero still holds
+
+def reconcile_pending_payments():
+    # Payments whose callback never arrived: ask PayHero directly
+    global reconcile_cursor
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['PAYHERO_RECONCILE_AFTER'])
+    expired = datetime.utcnow() - timedelta(seconds=app.config['RESERVATION_TTL'])
+    query = Payment.query.filter(
+        Payment.status == 'pending', Payment.created_at < cutoff,
+        # A push not yet accepted has nothing to ask PayHero about until its hold expires
+        db.or_(Payment.provider_reference.isnot(None), Payment.created_at < expired))
+    if reconcile_cursor:
+        query = query.filter(db.tuple_(Payment.created_at, Payment.id) > reconcile_cursor)
+    payments = query.order_by(Payment.created_at, Payment.id).limit(100).all()
+    # Oldest first; a full page means more behind it, so the next pass continues there, else starts over
+    reconcile_cursor = (payments[-1].created_at, payments[-1].id) if len(payments) == 100 else None
+    settled = 0
+    for payment in payments:
+        if not payment.provider_reference:
+            # The push was never accepted, so no callback can come for it
+            if payment.created_at < expired:
+                settled += settle_payment(payment, False)
+            continue
+        try:
+            result = payhero_client.transaction_status(payment.provider_reference)
+        except Exception as e:
+            logger.warning(f"Status check for payment {payment.external_reference} failed: {str(e)}")
+            continue
+        status = str(result.get('status', '')).upper()
+        if status == 'SUCCESS':
+            settled += settle_payment(payment, True)
+        elif status == 'FAILED':
+            settled += settle_payment(payment, False)
+        elif payment.created_at < expired:
+            logger.info(f"Payment {payment.external_reference} still {status or 'unknown'} at PayHero")
+    db.session.commit()
+    if settled:
+        logger.info(f"Reconciled {settled} pending payments with PayHero")
+    return settled
+
+# Ticket Fulfillment Queue
+def enqueue_fulfillment(payment):
+    # Caller commits; the unique payment_id keeps a payment to a single job
+    job = FulfillmentJob.query.filter_by(payment_id=payment.id).first()
+    if job:
+        return job
+    job = FulfillmentJob(payment_id=payment.id, status='queued', stage='issue', run_after=datetime.utcnow())
+    db.session.add(job)
+    return job
+
+def issue_tickets_for_payment(payment):
+    cart = json.loads(payment.payment_metadata)
+    tickets = []
+    for item in cart:
+        for _ in range(item['quantity']):
+            ticket_id = str(uuid.uuid4())
+            qr_data, qr_url = None, None
+            if app.config['QR_STORAGE'] == 'inline':
+                qr_data, qr_url = generate_qr_code(ticket_id, item['instance_id'], item['tier'])
+
+            ticket = Ticket(
+                id=ticket_id,
+                client_id=payment.client_id,
+                ticket_instance_id=item['instance_id'],
+                tier=item['tier'],
+                qr_code_url=qr_url,
+                qr_code_base64=qr_data,
+                payment_id=payment.id
+            )
+            db.session.add(ticket)
+            tickets.append(ticket)
+    return tickets
+
+def claim_fulfillment_job():
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=app.config['FULFILLMENT_LOCK_TIMEOUT'])
+    candidate = FulfillmentJob.query.filter(db.or_(
+        db.and_(FulfillmentJob.status == 'queued', FulfillmentJob.run_after <= now),
+        db.and_(FulfillmentJob.status == 'running', FulfillmentJob.locked_at < stale_before)
+    )).order_by(FulfillmentJob.run_after).first()
+    if not candidate:
+        return None
+
+    # Conditional update: only one worker can move the job out of the state it was read in
+    claimed = FulfillmentJob.query.filter(
+        FulfillmentJob.id == candidate.id,
+        FulfillmentJob.status == candidate.status,
+        FulfillmentJob.attempts == candidate.attempts
+    ).update({
+        'status': 'running',
+        'locked_at': now,
+        'attempts': FulfillmentJob.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return db.session.get(FulfillmentJob, candidate.id, populate_existing=True)
+
+def run_fulfillment_job(job):
+    job_id = job.id
+    try:
+        payment = db.session.get(Payment, job.payment_id)
+
+        # Each stage commits together with the job's progress, so a retry never re-issues tickets
+        if job.stage == 'issue':
+            tickets = issue_tickets_for_payment(payment)
+            job.stage = 'render'
+            db.session.commit()
+            logger.info(f"Generated {len(tickets)} tickets for payment {payment.external_reference}")
+
+        if job.stage == 'render':
+            # Separate and zip emails attach the stored PDFs, so they are rendered once here. A combined email draws
+            # its own multi-page document, so there each ticket's PDF waits for its first download instead
+            if app.config['TICKET_ATTACHMENT_MODE'] != 'combined':
+                user = db.session.get(User, payment.client_id)
+                for ticket in Ticket.query.filter_by(payment_id=payment.id).all():
+                    stored_ticket_pdf(ticket, user.email)
+            job.stage = 'email'
+            db.session.commit()
+
+        if job.stage == 'email':
+            # Delivery (rate limiting, retries) is the outbox's job from here on
+            user = db.session.get(User, payment.client_id)
+            enqueue_ticket_email(payment, user.email)
+
+        job.stage = 'done'
+        job.status = 'done'
+        job.locked_at = None
+        job.last_error = None
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        return True
+
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(FulfillmentJob, job_id)
+        job.last_error = str(e)
+        job.locked_at = None
+        if job.attempts >= app.config['FULFILLMENT_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            logger.error(f"Fulfillment job {job_id} failed permanently: {str(e)}")
+        else:
+            delay = app.config['FULFILLMENT_RETRY_SECONDS'] * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Fulfillment job {job_id} attempt {job.attempts} failed, retrying in {delay:.0f}s: {str(e)}")
+        db.session.commit()
+        return False
+
+def process_next_fulfillment_job():
+    job = claim_fulfillment_job()
+    if not job:
+        return False
+    run_fulfillment_job(job)
+    return True
+
+class FulfillmentWorker(threading.Thread):
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        last_sweep = last_reconcile = 0
+        while not self.stop_event.is_set():
+            with app.app_context():
+                try:
+                    processed = process_next_fulfillment_job()
+                    # Housekeeping only runs when the queue is idle
+                    if not processed and time.monotonic() - last_sweep > app.config['RESERVATION_SWEEP_SECONDS']:
+                        last_sweep = time.monotonic()
+                        release_expired_reservations()
+                        prune_login_throttles()
+                    if not processed and time.monotonic() - last_reconcile > app.config['PAYHERO_RECONCILE_SECONDS']:
+                        last_reconcile = time.monotonic()
+                        reconcile_pending_payments()
+                except Exception as e:
+                    logger.error(f"Fulfillment worker {self.name} error: {str(e)}")
+                    db.session.rollback()
+                    processed = False
+            if not processed:
+                self.stop_event.wait(app.config['FULFILLMENT_POLL_SECONDS'])
+
+    def stop(self):
+        self.stop_event.set()
+
+fulfillment_workers = []
+fulfillment_workers_lock = threading.Lock()
+
+def start_fulfillment_workers(count=None):
+    # Started on first request rather than at import so gunicorn's forked workers each get live threads
+    count = app.config['FULFILLMENT_WORKERS'] if count is None else count
+    with fulfillment_workers_lock:
+        if fulfillment_workers or count <= 0:
+            return fulfillment_workers
+        for i in range(count):
+            worker = FulfillmentWorker(name=f'fulfillment-{os.getpid()}-{i}')
+            worker.start()
+            fulfillment_workers.append(worker)
+        # Email delivery threads live and stop alongside the fulfillment threads
+        for i in range(app.config['EMAIL_WORKERS']):
+            worker = EmailDeliveryWorker(name=f'email-{os.getpid()}-{i}')
+            worker.start()
+            fulfillment_workers.append(worker)
+        logger.info(f"Started {count} fulfillment and {app.config['EMAIL_WORKERS']} email delivery worker threads")
+    return fulfillment_workers
+
+def stop_fulfillment_workers():
+    with fulfillment_workers_lock:
+        for worker in fulfillment_workers:
+            worker.stop()
+        for worker in fulfillment_workers:
+            worker.join()
+        fulfillment_workers.clear()
+
+@app.before_request
+def ensure_fulfillment_workers():
+    if not fulfillment_workers:
+        start_fulfillment_workers()
+
+# Email Outbox
+# Every email is a row in email_outbox, sent by delivery threads through one transport per process at
+# EMAIL_SEND_RATE across all processes, with exponential backoff on failure. Ticket emails render their PDFs at send time.
+class SendGridTransport:
+    # One API client per process instead of one per email
+    def __init__(self):
+        self.client = None
+        self.lock = threading.Lock()
+
+    def send(self, to_email, subject, html, attachments):
+        from sendgrid import SendGridAPIClient
+        from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
+        with self.lock:
+            if self.client is None:
+                self.client = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'), host=app.config['SENDGRID_API_HOST'])
+        message = Mail(
+            from_email=os.getenv('EMAIL_ADDRESS'),
+            to_emails=to_email,
+            subject=subject,
+            html_content=html
+        )
+        if attachments:
+            message.attachment = [
+                Attachment(
+                    FileContent(base64.b64encode(content).decode()),
+                    FileName(filename),
+                    FileType(mime_type),
+                    Disposition("attachment")
+                )
+                for filename, mime_type, content in attachments
+            ]
+        # Error responses raise python_http_client exceptions, which the outbox records and retries
+        response = self.client.send(message)
+        return response.headers.get('X-Message-Id') if getattr(response, 'headers', None) else None
+
+class FakeMailTransport:
+    """Local stand-in for SendGrid: keeps sent messages in memory and, given a directory, writes them to disk.
+
+    fail_rate and latency simulate a flaky or slow provider.
+    """
+    def __init__(self, directory=None, fail_rate=0.0, latency=0.0):
+        self.directory = directory
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.sent = []
+        self.attempts = 0
+        self.lock = threading.Lock()
+
+    def send(self, to_email, subject, html, attachments):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.attempts += 1
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise RuntimeError('Fake transport rejected the message')
+
+        message_id = uuid.uuid4().hex
+        record = {
+            'id': message_id,
+            'to': to_email,
+            'subject': subject,
+            'html': html,
+            'attachments': [{'filename': filename, 'type': mime_type, 'bytes': len(content)}
+                            for filename, mime_type, content in attachments],
+            'sent_at': datetime.utcnow().isoformat()
+        }
+        with self.lock:
+            self.sent.append(record)
+        if self.directory:
+            folder = os.path.join(self.directory, message_id)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, 'message.json'), 'w') as handle:
+                json.dump(record, handle, indent=2)
+            for filename, mime_type, content in attachments:
+                with open(os.path.join(folder, filename), 'wb') as handle:
+                    handle.write(content)
+        return message_id
+
+mail_transport = None
+mail_transport_lock = threading.Lock()
+
+def get_mail_transport():
+    global mail_transport
+    with mail_transport_lock:
+        if mail_transport is None:
+            if app.config['EMAIL_TRANSPORT'] == 'fake':
+                mail_transport = FakeMailTransport(app.config['EMAIL_FAKE_DIR'])
+            else:
+                mail_transport = SendGridTransport()
+        return mail_transport
+
+class EmailRateLimiter:
+    # Token bucket in login_throttles, so EMAIL_SEND_RATE per second holds across every process's delivery threads,
+    # bursting up to one second's worth. take() commits, so callers must not hold uncommitted changes they may roll back
+    key = 'outbox:send'
+
+    def acquire(self):
+        store = DatabaseThrottleStore()
+        while True:
+            rate = app.config['EMAIL_SEND_RATE']
+            if rate <= 0:
+                return
+            wait = store.take(self.key, max(1.0, rate), rate)
+            if not wait:
+                return
+            time.sleep(wait)
+
+email_rate_limiter = EmailRateLimiter()
+
+def enqueue_email(kind, to_email, subject, body=None, payment=None):
+    # Caller commits
+    message = EmailOutbox(kind=kind, to_email=to_email, subject=subject, body=body,
+                          payment_id=payment.id if payment else None, status='queued', run_after=datetime.utcnow())
+    db.session.add(message)
+    return message
+
+def enqueue_ticket_email(payment, to_email):
+    # Caller commits; the (payment_id, kind) constraint keeps it to one email per payment
+    message = EmailOutbox.query.filter_by(payment_id=payment.id, kind='tickets').first()
+    if message:
+        return message
+    return enqueue_email('tickets', to_email, 'Your Dark Order Halloween Tickets', payment=payment)
+
+def claim_outbox_batch():
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=app.config['EMAIL_LOCK_TIMEOUT'])
+    candidates = EmailOutbox.query.filter(db.or_(
+        db.and_(EmailOutbox.status == 'queued', EmailOutbox.run_after <= now),
+        db.and_(EmailOutbox.status == 'sending', EmailOutbox.locked_at < stale_before)
+    )).order_by(EmailOutbox.run_after).limit(app.config['EMAIL_BATCH_SIZE']).all()
+
+    # Same conditional claim as fulfillment jobs, so two delivery threads never send one message. A stale claim is
+    # re-checked as stale, since its owner may have renewed locked_at since the candidates were read
+    claimed = []
+    for candidate in candidates:
+        if EmailOutbox.query.filter(
+            EmailOutbox.id == candidate.id,
+            EmailOutbox.status == candidate.status,
+            EmailOutbox.attempts == candidate.attempts,
+            db.or_(EmailOutbox.status == 'queued', EmailOutbox.locked_at < stale_before)
+        ).update({
+            'status': 'sending',
+            'locked_at': now,
+            'attempts': EmailOutbox.attempts + 1
+        }, synchronize_session=False):
+            claimed.append((candidate.id, candidate.attempts + 1))
+    db.session.commit()
+    return claimed
+
+class OutboxClaimLost(Exception):
+    pass
+
+def update_claimed_email(message_id, attempts, **values):
+    """Apply values and renew locked_at (unless values set it) while this attempt still owns the message, then commit.
+
+    A message held past EMAIL_LOCK_TIMEOUT can be reclaimed by another thread; raises OutboxClaimLost once it has been.
+    """
+    updated = EmailOutbox.query.filter(
+        EmailOutbox.id == message_id,
+        EmailOutbox.status == 'sending',
+        EmailOutbox.attempts == attempts
+    ).update({'locked_at': datetime.utcnow(), **values}, synchronize_session=False)
+    db.session.commit()
+    if not updated:
+        raise OutboxClaimLost(f"Email {message_id} was reclaimed by another delivery thread")
+
+def deliver_email(message_id, attempts):
+    # attempts is the count this thread's claim set; it identifies the claim if the message is later reclaimed
+    message = db.session.get(EmailOutbox, message_id, populate_existing=True)
+    try:
+        # The batch was claimed together; this message's lock runs from when its own sending starts
+        update_claimed_email(message_id, attempts)
+        if message.kind == 'tickets':
+            # A stable order keeps each part's tickets the same on every attempt, which parts_sent relies on
+            tickets = Ticket.query.filter_by(payment_id=message.payment_id).order_by(Ticket.created_at, Ticket.id).all()
+            user = User.query.filter_by(email=message.to_email).first()
+
+            provider_ids = message.provider_message_id
+
+            def record_part(part, provider_message_id):
+                # Committed per part: a retry after a later part fails starts from the next one
+                nonlocal provider_ids
+                provider_ids = ' '.join(filter(None, (provider_ids, provider_message_id)))
+                update_claimed_email(message_id, attempts, parts_sent=part, provider_message_id=provider_ids)
+
+            # Each part renews the lock after rendering and rate limiting, so a long email is not reclaimed mid-send
+            send_email_with_tickets(message.to_email, tickets, user, message.parts_sent or 0, record_part,
+                                    lambda: update_claimed_email(message_id, attempts))
+            sent = {}
+        else:
+            email_rate_limiter.acquire()
+            update_claimed_email(message_id, attempts)
+            sent = {'provider_message_id': get_mail_transport().send(message.to_email, message.subject, message.body, [])}
+
+        update_claimed_email(message_id, attempts, status='sent', sent_at=datetime.utcnow(), body=None, locked_at=None,
+                             last_error=None, **sent)
+        return True
+
+    except OutboxClaimLost as e:
+        # The thread that reclaimed the message owns its status now
+        db.session.rollback()
+        logger.warning(str(e))
+        return False
+
+    except Exception as e:
+        db.session.rollback()
+        message = db.session.get(EmailOutbox, message_id)
+        if message.status != 'sending' or message.attempts != attempts:
+            logger.warning(f"Email {message_id} attempt {attempts} failed after it was reclaimed: {str(e)}")
+            return False
+        message.last_error = str(e)
+        message.locked_at = None
+        if message.attempts >= app.config['EMAIL_MAX_ATTEMPTS']:
+            message.status = 'failed'
+            logger.error(f"Email {message_id} ({message.kind}) to {message.to_email} failed permanently: {str(e)}")
+        else:
+            delay = app.config['EMAIL_RETRY_SECONDS'] * 2 ** (message.attempts - 1)
+            message.status = 'queued'
+            message.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Email {message_id} attempt {message.attempts} failed, retrying in {delay:.0f}s: {str(e)}")
+        db.session.commit()
+        return False
+
+def deliver_pending_emails():
+    """Claim up to EMAIL_BATCH_SIZE due emails and send them; returns how many were attempted."""
+    claimed = claim_outbox_batch()
+    for message_id, attempts in claimed:
+        deliver_email(message_id, attempts)
+    return len(claimed)
+
+class EmailDeliveryWorker(threading.Thread):
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with app.app_context():
+                try:
+                    attempted = deliver_pending_emails()
+                except Exception as e:
+                    logger.error(f"Email worker {self.name} error: {str(e)}")
+                    db.session.rollback()
+                    attempted = 0
+            if not attempted:
+                self.stop_event.wait(app.config['EMAIL_POLL_SECONDS'])
+
+    def stop(self):
+        self.stop_event.set()
+
+# Comp Tickets
+# An admin comp or sponsor batch is a zero-amount payment with status 'comp', so its tickets, stock and
+# dashboard counts follow the same paths as a paid cart and /download-tickets?payment= works for the recipient
+bulk_pool = None
+bulk_pool_lock = threading.Lock()
+
+def configure_bulk_worker(secret_key):
+    # Spawned workers import the app afresh; QR signatures must use the parent's key
+    app.config['SECRET_KEY'] = secret_key
+
+def get_bulk_pool():
+    global bulk_pool
+    with bulk_pool_lock:
+        if bulk_pool is None:
+            # Created on first use, and spawned rather than forked: the parent has threads and open connections
+            bulk_pool = ProcessPoolExecutor(max_workers=app.config['BULK_ISSUE_PROCESSES'],
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=configure_bulk_worker, initargs=(app.config['SECRET_KEY'],))
+        return bulk_pool
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def bulk_map(fn, items):
+    """Apply fn to BULK_ISSUE_CHUNK-sized slices of items in the process pool, yielding results in order."""
+    chunks = chunked(items, app.config['BULK_ISSUE_CHUNK'])
+    if app.config['BULK_ISSUE_PROCESSES'] <= 0 or len(chunks) <= 1:
+        return map(fn, chunks)
+    return get_bulk_pool().map(fn, chunks)
+
+def render_qr_chunk(qr_urls):
+    return [base64.b64encode(render_qr_png(qr_url)).decode() for qr_url in qr_urls]
+
+def render_pdf_chunk(rows):
+    # Rows are plain dicts so they pickle; the namespaces stand in for Ticket and TicketInstance
+    files = []
+    for row in rows:
+        instance = SimpleNamespace(id=row['instance_id'], name=row['instance_name'], capacity=row['capacity'])
+        ticket = SimpleNamespace(id=row['id'], tier=row['tier'], ticket_instance=instance,
+                                 ticket_instance_id=row['instance_id'], qr_code_base64=row['qr_code_base64'])
+        files.append((f"ticket_{row['id']}.pdf", generate_pdf_ticket(ticket, row['email']).getvalue()))
+    return files
+
+def issue_comp_tickets(instance_id, tier, quantity, user):
+    """Issue quantity free tickets to user in one batch (caller commits).
+
+    Returns the comp payment, or None when the tier's stock cannot cover the batch.
+    """
+    held = sell_stock(instance_id, tier, quantity)
+    if not held and not Inventory.query.filter_by(ticket_instance_id=instance_id, tier=tier).first():
+        ensure_inventory(instance_id, tier)
+        held = sell_stock(instance_id, tier, quantity)
+    if not held:
+        return None
+
+    payment = Payment(
+        client_id=user.id,
+        external_reference=f'comp-{uuid.uuid4()}',
+        amount=0,
+        status='comp',
+        payment_metadata=json.dumps([{'instance_id': instance_id, 'tier': tier, 'quantity': quantity, 'unit_price': 0}])
+    )
+    db.session.add(payment)
+    db.session.flush()
+
+    ticket_ids = [str(uuid.uuid4()) for _ in range(quantity)]
+    qr_urls, qr_codes = [None] * quantity, [None] * quantity
+    if app.config['QR_STORAGE'] == 'inline':
+        qr_urls = [ticket_verify_url(ticket_id, instance_id, tier) for ticket_id in ticket_ids]
+        qr_codes = [qr_data for chunk in bulk_map(render_qr_chunk, qr_urls) for qr_data in chunk]
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Ticket), [{
+        'id': ticket_id,
+        'client_id': user.id,
+        'ticket_instance_id': instance_id,
+        'tier': tier,
+        'qr_code_url': qr_url,
+        'qr_code_base64': qr_data,
+        'payment_id': payment.id,
+        'created_at': now
+    } for ticket_id, qr_url, qr_data in zip(ticket_ids, qr_urls, qr_codes)])
+    record_sales(payment)
+    return payment
+
+def comp_batch_rows(payment):
+    user = db.session.get(User, payment.client_id)
+    rows = db.session.query(
+        Ticket.id, Ticket.tier, Ticket.ticket_instance_id, Ticket.qr_code_base64,
+        TicketInstance.name, TicketInstance.capacity
+    ).join(TicketInstance, TicketInstance.id == Ticket.ticket_instance_id) \
+        .filter(Ticket.payment_id == payment.id).order_by(Ticket.id)
+    return [{'id': row.id, 'tier': row.tier, 'instance_id': row.ticket_instance_id, 'qr_code_base64': row.qr_code_base64,
+             'instance_name': row.name, 'capacity': row.capacity, 'email': user.email} for row in rows]
+
+class ZipStream:
+    # Write-only sink for zipfile; without tell() it writes data descriptors, so entries stream as they are added
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_ticket_zip(rows):
+    """Yield a zip of one PDF per ticket, rendering chunks in the process pool while earlier ones are sent."""
+    sink = ZipStream()
+    # PDFs are already compressed, so store them rather than deflating again
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for files in bulk_map(render_pdf_chunk, rows):
+            for filename, content in files:
+                archive.writestr(filename, content)
+            yield sink.drain()
+    yield sink.drain()
+
+# Scan Gate
+class ScanGateIndex:
+    # Compact per-process copy of every issued ticket so a scan needs no lookups or lazy loads
+    def __init__(self):
+        self.entries = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()  # Held by the one thread (re)loading
+
+    def is_stale(self):
+        return self.loaded_at is None or \
+            (datetime.utcnow() - self.loaded_at).total_seconds() > app.config['SCAN_INDEX_TTL']
+
+    def query(self):
+        return db.session.query(
+            Ticket.id, Ticket.tier, Ticket.scanned_at, Ticket.ticket_instance_id,
+            TicketInstance.name, TicketInstance.capacity, User.email
+        ).outerjoin(TicketInstance, Ticket.ticket_instance_id == TicketInstance.id
+        ).join(User, Ticket.client_id == User.id)
+
+    def entry(self, row):
+        return {
+            'instance_id': row.ticket_instance_id,
+            'instance': row.name,
+            'tier': row.tier,
+            'capacity': row.capacity,
+            'email': row.email,
+            'scanned_at': row.scanned_at
+        }
+
+    def load(self):
+        entries = {row.id: self.entry(row) for row in self.query()}
+        with self.lock:
+            self.entries = entries
+            self.loaded_at = datetime.utcnow()
+        logger.info(f"Scan index loaded with {len(entries)} tickets")
+        return len(entries)
+
+    def refresh(self):
+        # Past SCAN_INDEX_TTL one background thread reloads while scans keep using the current entries
+        if not self.load_lock.acquire(blocking=False):
+            return
+        def run():
+            try:
+                with app.app_context():
+                    self.load()
+            except Exception as e:
+                logger.error(f"Scan index reload failed: {str(e)}")
+            finally:
+                self.load_lock.release()
+        threading.Thread(target=run, name='scan-index-refresh', daemon=True).start()
+
+    def get(self, ticket_id):
+        if self.loaded_at is None:
+            # Nothing to serve yet: the first scans wait for a single load
+            with self.load_lock:
+                if self.loaded_at is None:
+                    self.load()
+        elif self.is_stale():
+            self.refresh()
+        entry = self.entries.get(ticket_id)
+        if entry is None:
+            # Issued after the last load: one joined lookup, cached for the next scan
+            row = self.query().filter(Ticket.id == ticket_id).first()
+            if row:
+                entry = self.entry(row)
+                self.entries[ticket_id] = entry
+        return entry
+
+    def mark_scanned(self, ticket_id, scanned_at):
+        entry = self.entries.get(ticket_id)
+        if entry is not None:
+            entry['scanned_at'] = scanned_at
+
+    def manifest(self):
+        # Compact snapshot for offline scanners: instances once, then one short row per ticket
+        self.load()
+        instances = {}
+        tickets = []
+        for ticket_id, entry in list(self.entries.items()):
+            if entry['instance_id'] is not None:
+                instances[entry['instance_id']] = {'name': entry['instance'], 'capacity': entry['capacity']}
+            scanned_at = entry['scanned_at'].isoformat() + 'Z' if entry['scanned_at'] else None
+            tickets.append([ticket_id, entry['instance_id'], entry['tier'], scanned_at])
+        return {'instances': instances, 'tickets': tickets}
+
+scan_index = ScanGateIndex()
+
+class ScanLogWriter:
+    # Append-only buffer for ScanLog rows, written with one multi-row INSERT per flush
+    def __init__(self):
+        self.rows = []
+        self.last_seen = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.stats = {'buffered': 0, 'flushed': 0, 'flushes': 0, 'debounced': 0, 'dropped': 0, 'failed_flushes': 0,
+                      'rejected': 0}
+
+    def append(self, ticket_id, result, details):
+        # Invalid scans carry whatever the QR held; keep it within the column so one row cannot fail a batch
+        ticket_id = str(ticket_id)[:ScanLog.ticket_id.type.length] if ticket_id is not None else None
+        now = time.monotonic()
+        key = (ticket_id, result)
+        with self.lock:
+            # A QR stuck in front of the camera produces the same result over and over
+            if now - self.last_seen.get(key, float('-inf')) < app.config['SCAN_LOG_DEBOUNCE_SECONDS']:
+                self.last_seen[key] = now
+                self.stats['debounced'] += 1
+                return False
+            self.last_seen[key] = now
+            self.rows.append({'ticket_id': ticket_id, 'result': result, 'details': details,
+                              'scanned_at': datetime.utcnow()})
+            overflow = len(self.rows) - app.config['SCAN_LOG_MAX_BUFFER']
+            if overflow > 0:
+                del self.rows[:overflow]
+                self.stats['dropped'] += overflow
+            self.stats['buffered'] = len(self.rows)
+            full = len(self.rows) >= app.config['SCAN_LOG_BATCH_SIZE']
+        self.start()
+        if full:
+            self.wake.set()
+        return True
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            cutoff = time.monotonic() - app.config['SCAN_LOG_DEBOUNCE_SECONDS']
+            self.last_seen = {key: seen for key, seen in self.last_seen.items() if seen >= cutoff}
+        if not rows:
+            return 0
+        with app.app_context():
+            try:
+                self.insert(rows)
+                flushed = len(rows)
+            except OperationalError as e:
+                # Connection lost or database busy: keep the batch for the next flush
+                logger.error(f"Scan log flush of {len(rows)} rows failed: {str(e)}")
+                db.session.rollback()
+                self.requeue(rows)
+                return 0
+            except Exception as e:
+                # A row the database refuses: insert one at a time so only that row is lost
+                logger.error(f"Scan log flush of {len(rows)} rows failed, retrying row by row: {str(e)}")
+                db.session.rollback()
+                flushed = self.insert_each(rows)
+        with self.lock:
+            self.stats['flushed'] += flushed
+            self.stats['flushes'] += 1
+            self.stats['buffered'] = len(self.rows)
+        return flushed
+
+    def insert(self, rows):
+        db.session.execute(db.insert(ScanLog), rows)
+        record_scan_minutes((row['scanned_at'], row['result']) for row in rows)
+        db.session.commit()
+
+    def insert_each(self, rows):
+        flushed = 0
+        for i, row in enumerate(rows):
+            try:
+                self.insert([row])
+                flushed += 1
+            except OperationalError as e:
+                logger.error(f"Scan log flush failed: {str(e)}")
+                db.session.rollback()
+                self.requeue(rows[i:])
+                break
+            except Exception as e:
+                logger.error(f"Dropping scan log row for ticket {row['ticket_id']!r}: {str(e)}")
+                db.session.rollback()
+                with self.lock:
+                    self.stats['rejected'] += 1
+        return flushed
+
+    def requeue(self, rows):
+        with self.lock:
+            # Put them back in front so ordering survives the retry
+            self.rows = rows + self.rows
+            self.stats['failed_flushes'] += 1
+            self.stats['buffered'] = len(self.rows)
+
+    def run(self):
+        while True:
+            self.wake.wait(app.config['SCAN_LOG_FLUSH_SECONDS'])
+            self.wake.clear()
+            self.flush()
+
+    def start(self):
+        # Started lazily so each forked gunicorn worker runs its own flusher
+        if self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='scan-log-writer', daemon=True)
+            self.thread.start()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+scan_log_writer = ScanLogWriter()
+atexit.register(scan_log_writer.flush)
+
+def scan_ticket(ticket_id):
+    """Check in one ticket; returns (result, entry) where result is 'valid', 'already_scanned' or 'invalid'."""
+    entry = scan_index.get(ticket_id) if ticket_id else None
+    if entry is None:
+        return 'invalid', None
+    
+    # Scans are never undone, so a locally known scan needs no round trip
+    if entry['scanned_at']:
+        return 'already_scanned', entry
+    
+    # Conditional update: of any concurrent scans (other doors, other workers) exactly one wins
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        db.update(Ticket)
+        .where(Ticket.id == ticket_id, Ticket.scanned_at.is_(None))
+        .values(scanned_at=now)
+        .returning(Ticket.id)
+    ).first()
+    if claimed:
+        scan_index.mark_scanned(ticket_id, now)
+        record_check_in(entry)
+        return 'valid', entry
+    
+    scanned_at = db.session.query(Ticket.scanned_at).filter(Ticket.id == ticket_id).scalar()
+    scan_index.mark_scanned(ticket_id, scanned_at)
+    return 'already_scanned', entry
+
+def parse_scan_time(value):
+    scanned_at = datetime.fromisoformat(value)
+    if scanned_at.tzinfo:
+        scanned_at = scanned_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return scanned_at
+
+def sync_offline_scans(scans, device_id):
+    """Apply queued offline scans in one transaction (caller commits).
+
+    The earliest scan of a ticket wins no matter which device syncs first, so
+    replaying the same queues in any order ends in the same state.
+    """
+    results = []
+    ordered = sorted((parse_scan_time(scan['scanned_at']), str(scan['ticket_id'])) for scan in scans)
+    for scanned_at, ticket_id in ordered:
+        entry = scan_index.get(ticket_id)
+        if entry is None:
+            db.session.add(ScanLog(ticket_id=ticket_id, result='invalid', scanned_at=scanned_at,
+                                   details=f'Offline scan from {device_id}: ticket not found'))
+            results.append({'ticket_id': ticket_id, 'status': 'invalid'})
+            continue
+
+        update = db.update(Ticket).values(scanned_at=scanned_at).returning(Ticket.id)
+        # A first check-in counts towards the dashboard; an earlier offline scan only moves the time back
+        checked_in = db.session.execute(
+            update.where(Ticket.id == ticket_id, Ticket.scanned_at.is_(None))).first()
+        won = checked_in or db.session.execute(
+            update.where(Ticket.id == ticket_id, Ticket.scanned_at > scanned_at)).first()
+        if checked_in:
+            record_check_in(entry)
+        first_scan = scanned_at
+        if not won:
+            first_scan = db.session.query(Ticket.scanned_at).filter(Ticket.id == ticket_id).scalar()
+        scan_index.mark_scanned(ticket_id, first_scan)
+
+        if first_scan == scanned_at:
+            db.session.add(ScanLog(ticket_id=ticket_id, result='valid', scanned_at=scanned_at,
+                                   details=f'Offline scan from {device_id}: {entry["instance"]}, Tier: {entry["tier"]}'))
+            results.append({'ticket_id': ticket_id, 'status': 'valid'})
+        else:
+            db.session.add(ScanLog(ticket_id=ticket_id, result='already_scanned', scanned_at=scanned_at,
+                                   details=f'Offline scan from {device_id}: first scanned at {first_scan}'))
+            results.append({'ticket_id': ticket_id, 'status': 'already_scanned',
+                            'scanned_at': first_scan.strftime('%Y-%m-%d %H:%M:%S')})
+    record_scan_minutes((scanned_at, result['status']) for (scanned_at, _), result in zip(ordered, results))
+    return results
+
+# Exports
+def parse_export_filters(args):
+    """Instance, tier and date range (since inclusive, until exclusive) from the query string; raises ValueError."""
+    filters = {'instance': None, 'tier': None, 'since': None, 'until': None}
+    if args.get('instance'):
+        filters['instance'] = int(args['instance'])
+    if args.get('tier'):
+        if args['tier'] not in TICKET_TIERS:
+            raise ValueError(f"Unknown tier {args['tier']}")
+        filters['tier'] = args['tier']
+    for name in ('since', 'until'):
+        if args.get(name):
+            filters[name] = parse_scan_time(args[name])
+    return filters
+
+def filter_export(query, filters, instance_column, tier_column, date_column):
+    if filters['instance'] is not None:
+        query = query.where(instance_column == filters['instance'])
+    if filters['tier']:
+        query = query.where(tier_column == filters['tier'])
+    if filters['since']:
+        query = query.where(date_column >= filters['since'])
+    if filters['until']:
+        query = query.where(date_column < filters['until'])
+    return query
+
+def ticket_export(filters):
+    # Projection only: the base64 QR column never leaves the database
+    query = db.select(
+        Ticket.id.label('ticket_id'), Ticket.ticket_instance_id.label('instance_id'),
+        TicketInstance.name.label('instance_name'), Ticket.tier, User.email,
+        Payment.external_reference.label('payment_reference'), Ticket.created_at, Ticket.scanned_at
+    ).join(User, User.id == Ticket.client_id) \
+        .outerjoin(TicketInstance, TicketInstance.id == Ticket.ticket_instance_id) \
+        .outerjoin(Payment, Payment.id == Ticket.payment_id)
+    return filter_export(query, filters, Ticket.ticket_instance_id, Ticket.tier, Ticket.created_at)
+
+def payment_export(filters):
+    query = db.select(
+        Payment.external_reference.label('reference'), User.email, Payment.amount, Payment.status,
+        Payment.provider_reference, Payment.created_at, Payment.callback_received_at,
+        Payment.payment_metadata.label('cart')
+    ).join(User, User.id == Payment.client_id)
+    query = filter_export(query, {**filters, 'instance': None, 'tier': None}, None, None, Payment.created_at)
+    if filters['instance'] is not None or filters['tier']:
+        # A payment's cart is JSON, so match it through the tickets it issued or the stock it held
+        ticket_match = filter_export(db.select(Ticket.id).where(Ticket.payment_id == Payment.id),
+                                     {**filters, 'since': None, 'until': None}, Ticket.ticket_instance_id, Ticket.tier, None)
+        hold_match = filter_export(db.select(Reservation.id).where(Reservation.payment_id == Payment.id),
+                                   {**filters, 'since': None, 'until': None}, Reservation.ticket_instance_id, Reservation.tier, None)
+        query = query.where(db.or_(ticket_match.exists(), hold_match.exists()))
+    return query
+
+def scan_log_export(filters):
+    query = db.select(
+        ScanLog.id, ScanLog.ticket_id, ScanLog.result, ScanLog.scanned_at,
+        Ticket.ticket_instance_id.label('instance_id'), Ticket.tier, ScanLog.details
+    ).outerjoin(Ticket, Ticket.id == ScanLog.ticket_id)
+    return filter_export(query, filters, Ticket.ticket_instance_id, Ticket.tier, ScanLog.scanned_at)
+
+EXPORTS = {'tickets': ticket_export, 'payments': payment_export, 'scan-logs': scan_log_export}
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def stream_export(query, export_format):
+    """Yield the query's rows as CSV or NDJSON, one chunk per EXPORT_BATCH_SIZE rows."""
+    # Runs after the view returns, so it holds its own app context (and session) until the last row
+    with app.app_context():
+        # yield_per streams from a server-side cursor on Postgres instead of buffering the result
+        result = db.session.execute(query.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']))
+        columns = list(result.keys())
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+        for rows in result.partitions():
+            for row in rows:
+                if export_format == 'csv':
+                    writer.writerow(['' if value is None else export_value(value) for value in row])
+                else:
+                    buffer.write(json.dumps({column: export_value(value) for column, value in zip(columns, row)}))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+# My Tickets
+def encode_ticket_cursor(row):
+    return base64.urlsafe_b64encode(f"{row.created_at.isoformat()}|{row.id}".encode()).decode().rstrip('=')
+
+def decode_ticket_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    created_at, ticket_id = raw.split('|', 1)
+    return datetime.fromisoformat(created_at), ticket_id
+
+def my_tickets_page(client_id, before=None, limit=None):
+    """One keyset page of a buyer's tickets, newest first; returns (rows, next cursor or None)."""
+    limit = limit or app.config['MY_TICKETS_PAGE_SIZE']
+    # Only the columns the list shows: the instance comes from the join and the QR blob is never read
+    query = db.session.query(
+        Ticket.id, Ticket.tier, Ticket.created_at, Ticket.scanned_at,
+        TicketInstance.name.label('instance_name'), TicketInstance.capacity
+    ).outerjoin(TicketInstance, Ticket.ticket_instance_id == TicketInstance.id) \
+        .filter(Ticket.client_id == client_id)
+    if before:
+        created_at, ticket_id = decode_ticket_cursor(before)
+        query = query.filter(db.or_(
+            Ticket.created_at < created_at,
+            db.and_(Ticket.created_at == created_at, Ticket.id < ticket_id)
+        ))
+    rows = query.order_by(Ticket.created_at.desc(), Ticket.id.desc()).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], encode_ticket_cursor(rows[limit - 1])
+    return rows, None
+
+# PIN Hashing
+class PinHashBusy(Exception):
+    pass
+
+class PinHasher:
+    """Runs werkzeug's PIN hashing on a bounded thread pool (hashlib's KDFs release the GIL).
+
+    At most PIN_HASH_WORKERS hashes run at once; past PIN_HASH_QUEUE outstanding requests, or after
+    PIN_HASH_TIMEOUT seconds waiting, callers get PinHashBusy instead of piling up. PIN_HASH_WORKERS=0
+    hashes on the calling thread.
+    """
+    def __init__(self):
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        if app.config['PIN_HASH_WORKERS'] <= 0:
+            return fn(*args)
+        with self.lock:
+            # Created on first use so gunicorn's forked workers each get their own threads
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=app.config['PIN_HASH_WORKERS'], thread_name_prefix='pin-hash')
+                self.slots = threading.BoundedSemaphore(app.config['PIN_HASH_QUEUE'])
+        if not self.slots.acquire(blocking=False):
+            raise PinHashBusy('PIN hashing queue is full')
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=app.config['PIN_HASH_TIMEOUT'])
+        except TimeoutError:
+            raise PinHashBusy('PIN hashing timed out')
+
+    def hash(self, pin):
+        return self.run(generate_password_hash, pin, app.config['PIN_HASH_METHOD'])
+
+    def check(self, pin_hash, pin):
+        return self.run(check_password_hash, pin_hash, pin)
+
+    def needs_rehash(self, pin_hash):
+        return not pin_hash.startswith(app.config['PIN_HASH_METHOD'] + '$')
+
+pin_hasher = PinHasher()
+
+# Login Throttle
+class MemoryThrottleStore:
+    # Buckets for this process only: each worker process allows its own burst
+    MAX_BUCKETS = 50000
+
+    def __init__(self):
+        self.buckets = OrderedDict()  # Least recently used first
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, per_second):
+        """Take one token from key's bucket; returns 0 if allowed, else the seconds until a token is free."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * per_second)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            # Web processes without fulfillment threads never get the periodic prune
+            while len(self.buckets) > self.MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+            return 0 if allowed else (1 - tokens) / per_second
+
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+    def prune(self, idle_seconds):
+        # Buckets idle this long have refilled, so dropping them changes nothing
+        cutoff = time.monotonic() - idle_seconds
+        with self.lock:
+            while self.buckets and next(iter(self.buckets.values()))[1] < cutoff:
+                self.buckets.popitem(last=False)
+
+class DatabaseThrottleStore:
+    # Buckets in login_throttles, so the limits hold across worker processes; each take commits
+    def take(self, key, capacity, per_second):
+        now = datetime.utcnow()
+        row = LoginThrottle.query.filter_by(key=key).with_for_update().first()
+        if not row:
+            try:
+                with db.session.begin_nested():
+                    row = LoginThrottle(key=key, tokens=capacity, updated_at=now)
+                    db.session.add(row)
+            except IntegrityError:
+                row = LoginThrottle.query.filter_by(key=key).with_for_update().first()
+        tokens = min(capacity, row.tokens + max(0.0, (now - row.updated_at).total_seconds()) * per_second)
+        wait = 0 if tokens >= 1 else (1 - tokens) / per_second
+        row.tokens = tokens - 1 if tokens >= 1 else tokens
+        row.updated_at = now
+        db.session.commit()
+        return wait
+
+    def reset(self, key):
+        LoginThrottle.query.filter_by(key=key).delete(synchronize_session=False)
+        db.session.commit()
+
+    def prune(self, idle_seconds):
+        LoginThrottle.query.filter(
+            LoginThrottle.updated_at < datetime.utcnow() - timedelta(seconds=idle_seconds)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+THROTTLE_STORES = {'memory': MemoryThrottleStore, 'database': DatabaseThrottleStore}
+throttle_store = None
+
+def get_throttle_store():
+    global throttle_store
+    if throttle_store is None:
+        throttle_store = THROTTLE_STORES[app.config['LOGIN_THROTTLE_BACKEND']]()
+    return throttle_store
+
+def client_ip():
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    # The entry our own proxies appended; anything left of it is client-supplied and could be forged
+    route = request.access_route
+    if hops and request.headers.get('X-Forwarded-For') and len(route) >= hops:
+        return route[-hops]
+    return request.remote_addr or 'unknown'
+
+def throttle_login(email=None):
+    """Take a token for the client IP and, when given, the email; returns seconds to wait, or 0 if allowed."""
+    store = get_throttle_store()
+    wait = store.take(f"ip:{client_ip()}", app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE'] / 60)
+    if email and not wait:
+        # A throttled address spends none of the account's tokens, so it cannot lock the owner out
+        wait = store.take(f"email:{email.strip().lower()}", app.config['LOGIN_EMAIL_BURST'],
+                          app.config['LOGIN_EMAIL_PER_MINUTE'] / 60)
+    return wait
+
+def prune_login_throttles():
+    slowest = min(app.config['LOGIN_EMAIL_PER_MINUTE'], app.config['LOGIN_IP_PER_MINUTE']) / 60
+    largest = max(app.config['LOGIN_EMAIL_BURST'], app.config['LOGIN_IP_BURST'])
+    get_throttle_store().prune(largest / slowest if slowest > 0 else 3600)
+
+def throttled_response(wait):
+    retry_after = max(1, int(wait + 0.999))
+    response = jsonify({'success': False, 'error': f'Too many attempts. Try again in {retry_after} seconds.'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def busy_response():
+    response = jsonify({'success': False, 'error': 'Sign-in is busy, please try again.'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Waiting Room
+# Queue and admission tokens are HMAC-signed (kind, user, id, issue time), so forged or stale tokens are turned away
+# without the database. The queue, the admissions and the slot count live in the database, shared by every worker
+# process; each process reloads a snapshot of the queue once a second on a background thread, so a status poll reads
+# only memory until the poll that admits it.
+def waiting_room_key():
+    return hmac.new((app.config['SECRET_KEY'] or '').encode(), b'waiting-room', hashlib.sha256).digest()
+
+def waiting_token_signature(payload):
+    digest = hmac.new(waiting_room_key(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip('=')
+
+def sign_waiting_token(kind, user_id, token_id, issued):
+    payload = f"{kind}.{user_id}.{token_id}.{issued:.6f}"
+    return f"{payload}.{waiting_token_signature(payload)}"
+
+def read_waiting_token(token, kind, user_id, max_age):
+    """(token id, issue time) of a valid unexpired token of this kind for this user, else None."""
+    try:
+        payload, signature = (token or '').rsplit('.', 1)
+        token_kind, token_user, token_id, issued = payload.split('.', 3)
+        issued = float(issued)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, waiting_token_signature(payload)) or token_kind != kind or token_user != str(user_id):
+        return None
+    if not 0 <= time.time() - issued <= max_age:
+        return None
+    return token_id, issued
+
+class WaitingRoom:
+    def __init__(self):
+        self.waiting = []       # (joined_at, waiter id) as of the last reload, oldest first
+        self.active = 0         # Admissions holding a slot as of the last reload
+        self.recent = 0         # Admissions in the minute before the last reload, for the wait estimate
+        self.seen = set()       # Waiter ids polled here since the last reload, written back as last_seen
+        self.loaded_at = 0      # Epoch time of the last reload
+        self.refresher = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def start(self):
+        # Started on first use rather than at import so gunicorn's forked workers each get a live thread
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = WaitingRoomRefresher(self)
+                self.refresher.start()
+        if not self.loaded_at:
+            self.refresh()
+
+    def stop(self):
+        if self.refresher:
+            self.refresher.stop()
+
+    def refresh(self):
+        with self.refresh_lock:
+            with self.lock:
+                seen, self.seen = self.seen, set()
+            loaded_at, now = time.time(), datetime.utcnow()
+            try:
+                if seen:
+                    WaitingRoomEntry.query.filter(WaitingRoomEntry.id.in_(seen)).update(
+                        {'last_seen': now}, synchronize_session=False)
+                # Waiters who stopped polling give up their place; if they come back they rejoin by join time
+                idle = now - timedelta(seconds=app.config['WAITING_ROOM_IDLE_SECONDS'])
+                WaitingRoomEntry.query.filter(WaitingRoomEntry.last_seen < idle).delete(synchronize_session=False)
+                expired = Admission.query.filter(Admission.status.in_(('admitted', 'checkout')),
+                                                 Admission.expires_at <= now).update(
+                    {'status': 'expired'}, synchronize_session=False)
+                if expired:
+                    self.release_slots(expired)
+                Admission.query.filter(Admission.status.in_(('spent', 'expired')),
+                                       Admission.expires_at < now - timedelta(hours=1)).delete(synchronize_session=False)
+                if db.session.get(WaitingRoomState, 1) is None:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.add(WaitingRoomState(id=1, active=0))
+                    except IntegrityError:
+                        pass  # Created by another worker
+                db.session.commit()
+                waiting = db.session.query(WaitingRoomEntry.joined_at, WaitingRoomEntry.id).order_by(
+                    WaitingRoomEntry.joined_at, WaitingRoomEntry.id).all()
+                active = db.session.query(WaitingRoomState.active).filter_by(id=1).scalar()
+                recent = Admission.query.filter(Admission.admitted_at >= now - timedelta(seconds=60)).count()
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Waiting room reload failed: {str(e)}")
+                db.session.rollback()
+                with self.lock:
+                    self.seen |= seen
+                return
+            with self.lock:
+                self.waiting = [tuple(row) for row in waiting]
+                self.active, self.recent, self.loaded_at = active, recent, loaded_at
+
+    def release_slots(self, count):
+        WaitingRoomState.query.filter_by(id=1).update(
+            {'active': WaitingRoomState.active - count}, synchronize_session=False)
+
+    def admit(self, user_id, admission_id, position=0):
+        """Claim a slot and record the admission in one transaction; None unless position + 1 slots are free."""
+        # Counting the waiters ahead keeps first come first served even when another worker's snapshot is fresher
+        claimed = WaitingRoomState.query.filter(
+            WaitingRoomState.id == 1, WaitingRoomState.active + position < app.config['WAITING_ROOM_ACTIVE']
+        ).update({'active': WaitingRoomState.active + 1}, synchronize_session=False)
+        if not claimed:
+            db.session.rollback()
+            return None
+        now = datetime.utcnow()
+        db.session.add(Admission(id=admission_id, user_id=user_id, status='admitted', admitted_at=now,
+                                 expires_at=now + timedelta(seconds=app.config['ADMISSION_TTL'])))
+        WaitingRoomEntry.query.filter_by(id=admission_id).delete(synchronize_session=False)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Admitted by a concurrent poll on another worker; the slot claim rolls back with it
+            db.session.rollback()
+            return self.readmit(user_id, admission_id)
+        with self.lock:
+            self.waiting = [entry for entry in self.waiting if entry[1] != admission_id]
+            self.active += 1
+            self.recent += 1
+        return {'admitted': True, 'token': sign_waiting_token('a', user_id, admission_id, time.time())}
+
+    def readmit(self, user_id, admission_id):
+        # The admitting response was lost or raced: hand out the same unspent admission again
+        admission = db.session.get(Admission, admission_id)
+        if admission is None or admission.user_id != user_id or admission.status != 'admitted':
+            return None
+        return {'admitted': True, 'token': sign_waiting_token('a', user_id, admission_id, time.time())}
+
+    def queued(self, token, position):
+        base = app.config['WAITING_ROOM_POLL_SECONDS']
+        # Buyers far back poll less often, but always inside the idle window
+        poll_after = min(base * (1 + position // 100), app.config['WAITING_ROOM_IDLE_SECONDS'] / 3)
+        rate = self.recent / 60
+        return {'admitted': False, 'token': token, 'position': position + 1, 'waiting': len(self.waiting),
+                'estimated_wait': round(position / rate) if rate else None, 'poll_after': round(poll_after, 1)}
+
+    def join(self, user_id):
+        """Admit at once when nobody is waiting and a slot is free; otherwise queue. None when the queue is full."""
+        self.start()
+        with self.lock:
+            waiting, free = len(self.waiting), app.config['WAITING_ROOM_ACTIVE'] - self.active
+        if not waiting and free > 0:
+            admitted = self.admit(user_id, uuid.uuid4().hex)
+            if admitted:
+                return admitted
+        if waiting >= app.config['WAITING_ROOM_MAX']:
+            return None
+        # Rounded as the token carries it, so a poll finds this entry again
+        waiter_id, joined_at = uuid.uuid4().hex, round(time.time(), 6)
+        db.session.add(WaitingRoomEntry(id=waiter_id, user_id=user_id, joined_at=joined_at, last_seen=datetime.utcnow()))
+        db.session.commit()
+        with self.lock:
+            bisect.insort(self.waiting, (joined_at, waiter_id))
+            position = bisect.bisect_left(self.waiting, (joined_at, waiter_id))
+        return self.queued(sign_waiting_token('q', user_id, waiter_id, joined_at), position)
+
+    def poll(self, user_id, token):
+        """Queue position, or an admission once this waiter is inside the free slots. None for a bad token."""
+        found = read_waiting_token(token, 'q', user_id, app.config['WAITING_ROOM_TOKEN_TTL'])
+        if not found:
+            return None
+        waiter_id, joined_at = found
+        self.start()
+        entry = (joined_at, waiter_id)
+        with self.lock:
+            position = bisect.bisect_left(self.waiting, entry)
+            listed = position < len(self.waiting) and self.waiting[position] == entry
+            if listed:
+                self.seen.add(waiter_id)
+            # Missing from a snapshot loaded after the join: dropped for going idle, or admitted on another worker
+            dropped = not listed and joined_at < self.loaded_at - 1
+            free = app.config['WAITING_ROOM_ACTIVE'] - self.active
+        if position < free:
+            admitted = self.admit(user_id, waiter_id, position)
+            if admitted:
+                return admitted
+        if dropped:
+            return self.rejoin(user_id, waiter_id, joined_at, token, position)
+        return self.queued(token, position)
+
+    def rejoin(self, user_id, waiter_id, joined_at, token, position):
+        if db.session.get(Admission, waiter_id):
+            return self.readmit(user_id, waiter_id)
+        try:
+            with db.session.begin_nested():
+                db.session.add(WaitingRoomEntry(id=waiter_id, user_id=user_id, joined_at=joined_at,
+                                                last_seen=datetime.utcnow()))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Rejoined by a concurrent poll
+        with self.lock:
+            if (joined_at, waiter_id) not in self.waiting:
+                bisect.insort(self.waiting, (joined_at, waiter_id))
+        return self.queued(token, position)
+
+    def begin_checkout(self, user_id, token):
+        """Claim an unspent admission for one /purchase; its id, or None if the token is bad, spent or in use."""
+        found = read_waiting_token(token, 'a', user_id, app.config['ADMISSION_TTL'])
+        if not found:
+            return None
+        claimed = Admission.query.filter(
+            Admission.id == found[0], Admission.user_id == user_id, Admission.status == 'admitted',
+            Admission.expires_at > datetime.utcnow()
+        ).update({'status': 'checkout'}, synchronize_session=False)
+        db.session.commit()
+        return found[0] if claimed else None
 
-class ScanLog(db.Model):
-    __tablename__ = 'scan_logs'
-    id = db.Column(db.Integer, primary_key=True)
-    ticket_id = db.Column(db.String(36), nullable=True)
-    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
-    details = db.Column(db.Text, nullable=True)
-    result = db.Column(db.String(50), nullable=False)
+    def end_checkout(self, admission_id, completed):
+        """Spend the admission and free its slot after a completed purchase; otherwise hand it back for a retry."""
+        db.session.rollback()  # The order may have failed mid-transaction
+        if completed:
+            spent = Admission.query.filter_by(id=admission_id, status='checkout').update(
+                {'status': 'spent'}, synchronize_session=False)
+            if spent:
+                self.release_slots(spent)
+                with self.lock:
+                    self.active -= spent
+        else:
+            Admission.query.filter_by(id=admission_id, status='checkout').update(
+                {'status': 'admitted'}, synchronize_session=False)
+        db.session.commit()
 
-# Initialize database
-with app.app_context():
-    db.create_all()
-    logger.info("Database tables created successfully")
+    def snapshot(self):
+        with self.lock:
+            return {'waiting': len(self.waiting), 'admitted': self.active, 'admissions_last_minute': self.recent}
 
-# Helper Functions
-def generate_qr_code(ticket_id):
-    base_url = os.getenv('REPLIT_DEV_DOMAIN', 'localhost:5000')
-    if not base_url.startswith('http'):
-        base_url = f'https://{base_url}'
-    qr_url = f"{base_url}/ticket/verify/{ticket_id}"
-    
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(qr_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.getvalue()).decode()
-    
-    return img_base64, qr_url
+class WaitingRoomRefresher(threading.Thread):
+    def __init__(self, room):
+        super().__init__(name=f'waiting-room-{os.getpid()}', daemon=True)
+        self.room = room
+        self.stop_event = threading.Event()
 
-def generate_pdf_ticket(ticket, user_email):
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    
-    # Red/Black Halloween theme
-    c.setFillColorRGB(0.1, 0, 0)
-    c.rect(0, 0, width, height, fill=True)
-    
-    c.setFillColorRGB(0.8, 0, 0)
-    c.rect(0.5*inch, height - 2*inch, width - 1*inch, 1.5*inch, fill=True)
-    
-    c.setFillColorRGB(1, 1, 1)
-    c.setFont("Helvetica-Bold", 36)
-    c.drawCentredString(width/2, height - 1.2*inch, "THE DARK ORDER")
-    
-    c.setFont("Helvetica-Bold", 24)
-    c.drawCentredString(width/2, height - 1.6*inch, "HALLOWEEN PLAY & PARTY")
-    
-    c.setFillColorRGB(0.9, 0.9, 0.9)
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(1*inch, height - 3*inch, f"Ticket Instance: {ticket.ticket_instance.name}")
-    c.drawString(1*inch, height - 3.5*inch, f"Tier: {ticket.tier.upper()}")
-    capacity_text = f"Covers: {ticket.ticket_instance.capacity} {'person' if ticket.ticket_instance.capacity == 1 else 'people'}"
-    c.drawString(1*inch, height - 4*inch, capacity_text)
-    c.drawString(1*inch, height - 4.5*inch, f"Ticket ID: {ticket.id}")
-    c.drawString(1*inch, height - 5*inch, f"Email: {user_email}")
-    
-    # QR Code
-    qr_data, _ = generate_qr_code(ticket.id)
-    qr_image = ImageReader(BytesIO(base64.b64decode(qr_data)))
-    c.drawImage(qr_image, width/2 - 1.5*inch, height - 8.5*inch, width=3*inch, height=3*inch)
-    
-    c.setFillColorRGB(0.8, 0, 0)
-    c.setFont("Helvetica-Bold", 14)
-    c.drawCentredString(width/2, height - 9*inch, "SCAN QR CODE AT ENTRANCE")
-    
-    c.setFillColorRGB(0.6, 0.6, 0.6)
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(width/2, 1*inch, f"Generated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
-    
-    c.save()
-    buffer.seek(0)
-    return buffer
+    def run(self):
+        while not self.stop_event.wait(1):
+            if app.config['WAITING_ROOM_ENABLED']:
+                with app.app_context():
+                    self.room.refresh()
 
-def send_email_with_tickets(to_email, tickets, user):
-    try:
-        attachments = []
-        for ticket in tickets:
-            pdf_buffer = generate_pdf_ticket(ticket, to_email)
-            pdf_content = pdf_buffer.read()
-            attachments.append(
-                Attachment(
-                    FileContent(base64.b64encode(pdf_content).decode()),
-                    FileName(f"ticket_{ticket.id}.pdf"),
-                    FileType("application/pdf"),
-                    Disposition("attachment")
-                )
-            )
+    def stop(self):
+        self.stop_event.set()
 
-        body = f"""
-        <html>
-        <body style="background-color: #1a0000; color: #ffffff; font-family: Arial, sans-serif; padding: 20px;">
-            <h1 style="color: #cc0000;">THE DARK ORDER HALLOWEEN PLAY & PARTY</h1>
-            <p>Dear Guest,</p>
-            <p>Your tickets have been confirmed! Please find your ticket(s) attached as PDF files.</p>
-            <p>Each ticket contains a unique QR code. Please present this QR code at the entrance.</p>
-            <p style="color: #cc0000;"><strong>Total Tickets: {len(tickets)}</strong></p>
-            <p>We look forward to seeing you at the event!</p>
-            <p style="color: #666;">This is an automated email. Please do not reply.</p>
-        </body>
-        </html>
-        """
+waiting_room = WaitingRoom()
 
-        message = Mail(
-            from_email=os.getenv('EMAIL_ADDRESS'),
-            to_emails=to_email,
-            subject="Your Dark Order Halloween Tickets",
-            html_content=body
-        )
+class CheckoutGate:
+    # Caps concurrent /purchase requests per process so a rush cannot tie up every worker thread
+    def __init__(self):
+        self.slots = None
+        self.lock = threading.Lock()
 
-        if attachments:
-            message.attachment = attachments
+    def acquire(self):
+        with self.lock:
+            if self.slots is None:
+                self.slots = threading.BoundedSemaphore(app.config['CHECKOUT_CONCURRENCY'])
+        return self.slots.acquire(timeout=app.config['CHECKOUT_WAIT'])
 
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        sg.send(message)
+    def release(self):
+        self.slots.release()
 
-        logger.info(f"Email sent successfully to {to_email} with {len(tickets)} tickets via SendGrid")
-        return True
+checkout_gate = CheckoutGate()
 
-    except Exception as e:
-        logger.error(f"Email sending failed via SendGrid: {str(e)}")
-        return False
+def shed_response(error, retry_after):
+    response = jsonify({'success': False, 'error': error, 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
 
 # Routes - Home
 @app.route('/')
@@ -232,6 +2762,10 @@ def index():
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
+        wait = throttle_login()
+        if wait:
+            logger.warning(f"Admin login throttled for {client_ip()}")
+            return throttled_response(wait)
         pin = request.json.get('pin')
         if pin == os.getenv('ADMIN_PASSWORD'):
             session['admin'] = True
@@ -244,7 +2778,42 @@ def admin_login():
 def admin_dashboard():
     if not session.get('admin'):
         return redirect(url_for('admin_login'))
-    return render_template('admin_dashboard.html')
+    return render_template('admin_dashboard.html', instances=instance_catalog.get(),
+                           poll_ms=int(app.config['DASHBOARD_POLL_SECONDS'] * 1000))
+
+@app.route('/admin/api/dashboard')
+def admin_dashboard_api():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    snapshot = dashboard_feed.get()
+    # Polls revalidate with If-None-Match, so an unchanged dashboard costs a 304 and no body
+    response = jsonify({'success': True, **snapshot})
+    response.set_etag(snapshot['version'])
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/admin/export')
+def admin_export():
+    if not session.get('admin'):
+        return redirect(url_for('admin_login'))
+    
+    kind = request.args.get('type', 'tickets')
+    export_format = request.args.get('format', 'csv')
+    if kind not in EXPORTS or export_format not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'Unknown export type or format'}), 400
+    try:
+        filters = parse_export_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    filename = f"{kind}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    logger.info(f"Admin export of {kind} as {export_format} with filters {filters}")
+    return app.response_class(
+        stream_export(EXPORTS[kind](filters), export_format),
+        mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/admin/create-ticket-instance', methods=['GET', 'POST'])
 def create_ticket_instance():
@@ -253,6 +2822,9 @@ def create_ticket_instance():
     
     if request.method == 'POST':
         data = request.json
+        stocks = {tier: data.get(f'{tier}_stock') for tier in TICKET_TIERS}
+        if not all(valid_stock(stock) for stock in stocks.values()):
+            return jsonify({'success': False, 'error': 'Stock must be blank or a whole number of 0 or more'}), 400
         ticket_instance = TicketInstance(
             name=data['name'],
             capacity=data['capacity'],
@@ -261,7 +2833,11 @@ def create_ticket_instance():
             vvip_price=data.get('vvip_price')
         )
         db.session.add(ticket_instance)
+        db.session.flush()
+        for tier, stock in stocks.items():
+            db.session.add(Inventory(ticket_instance_id=ticket_instance.id, tier=tier, stock=stock, sold=0, reserved=0))
         db.session.commit()
+        instance_catalog.invalidate()
         logger.info(f"Ticket instance created: {ticket_instance.name}")
         return jsonify({'success': True, 'id': ticket_instance.id})
     
@@ -272,7 +2848,88 @@ def manage_instances():
     if not session.get('admin'):
         return redirect(url_for('admin_login'))
     instances = TicketInstance.query.all()
-    return render_template('manage_instances.html', instances=instances)
+    inventory = {(row.ticket_instance_id, row.tier): row for row in Inventory.query.all()}
+    return render_template('manage_instances.html', instances=instances, inventory=inventory)
+
+@app.route('/admin/instance/<int:instance_id>/stock', methods=['POST'])
+def update_instance_stock(instance_id):
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    
+    data = request.json
+    tier = data.get('tier')
+    stock = data.get('stock')
+    if tier not in TICKET_TIERS or not valid_stock(stock):
+        return jsonify({'success': False, 'error': 'Invalid tier or stock'}), 400
+    if not db.session.get(TicketInstance, instance_id):
+        return jsonify({'success': False}), 404
+    
+    ensure_inventory(instance_id, tier)
+    Inventory.query.filter_by(ticket_instance_id=instance_id, tier=tier).update(
+        {'stock': stock}, synchronize_session=False)
+    db.session.commit()
+    logger.info(f"Stock for instance {instance_id} {tier} set to {stock}")
+    return jsonify({'success': True})
+
+@app.route('/admin/instance/<int:instance_id>/comp-tickets', methods=['POST'])
+def comp_tickets(instance_id):
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    
+    data = request.json
+    tier = data.get('tier')
+    quantity = data.get('quantity')
+    email = (data.get('email') or '').strip().lower()
+    if tier not in TICKET_TIERS or not isinstance(quantity, int) or not 1 <= quantity <= app.config['BULK_ISSUE_MAX']:
+        return jsonify({'success': False, 'error': f"Tier and a quantity of 1-{app.config['BULK_ISSUE_MAX']} are required"}), 400
+    if '@' not in email:
+        return jsonify({'success': False, 'error': 'A recipient email is required'}), 400
+    if not db.session.get(TicketInstance, instance_id):
+        return jsonify({'success': False}), 404
+    
+    # Sign-up stores emails as typed, so match any casing of an existing account
+    user = User.query.filter(db.func.lower(User.email) == email).first()
+    if not user:
+        # The recipient can claim the account with Forgot PIN
+        try:
+            pin_hash = pin_hasher.hash(uuid.uuid4().hex)
+        except PinHashBusy:
+            return busy_response()
+        try:
+            with db.session.begin_nested():
+                user = User(email=email, pin_hash=pin_hash)
+                db.session.add(user)
+        except IntegrityError:
+            user = User.query.filter(db.func.lower(User.email) == email).first()
+    
+    started = time.perf_counter()
+    payment = issue_comp_tickets(instance_id, tier, quantity, user)
+    if not payment:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'Not enough {tier} stock for {quantity} tickets'}), 409
+    db.session.commit()
+    logger.info(f"Issued {quantity} comp {tier} tickets for instance {instance_id} to {email} "
+                f"({payment.external_reference}) in {time.perf_counter() - started:.2f}s")
+    return jsonify({
+        'success': True,
+        'reference': payment.external_reference,
+        'issued': quantity,
+        'download_url': url_for('download_comp_batch', reference=payment.external_reference)
+    })
+
+@app.route('/admin/comp-batches/<reference>/tickets.zip')
+def download_comp_batch(reference):
+    if not session.get('admin'):
+        return redirect(url_for('admin_login'))
+    
+    payment = Payment.query.filter_by(external_reference=reference, status='comp').first()
+    if not payment:
+        return "Batch not found", 404
+    rows = comp_batch_rows(payment)
+    if not rows:
+        return "No tickets found", 404
+    return app.response_class(stream_ticket_zip(rows), mimetype='application/zip',
+                              headers={'Content-Disposition': f'attachment; filename=comp_{reference}.zip'})
 
 @app.route('/admin/delete-instance/<int:instance_id>', methods=['POST'])
 def delete_instance(instance_id):
@@ -283,6 +2940,7 @@ def delete_instance(instance_id):
     if instance:
         db.session.delete(instance)
         db.session.commit()
+        instance_catalog.invalidate()
         logger.info(f"Ticket instance deleted: {instance.name} (ID: {instance_id})")
         return jsonify({'success': True})
     return jsonify({'success': False}), 404
@@ -291,6 +2949,8 @@ def delete_instance(instance_id):
 def admin_scan():
     if not session.get('admin'):
         return redirect(url_for('admin_login'))
+    # Warm the scan index before the first guest arrives
+    scan_index.load()
     return render_template('admin_scan.html')
 
 @app.route('/admin/verify-ticket', methods=['POST'])
@@ -299,44 +2959,114 @@ def verify_ticket():
         return jsonify({'success': False}), 401
     
     ticket_id = request.json.get('ticket_id')
-    ticket = Ticket.query.get(ticket_id)
+    result, entry = scan_ticket(ticket_id)
     
-    if not ticket:
-        log = ScanLog(ticket_id=ticket_id, result='invalid', details='Ticket not found in database')
-        db.session.add(log)
-        db.session.commit()
+    if result == 'invalid':
+        scan_log_writer.append(ticket_id, 'invalid', 'Ticket not found in database')
         logger.warning(f"Invalid ticket scanned: {ticket_id}")
         return jsonify({'success': False, 'status': 'invalid', 'message': 'Invalid Ticket'})
     
-    if ticket.scanned_at:
-        log = ScanLog(ticket_id=ticket_id, result='already_scanned', 
-                     details=f'Already scanned at {ticket.scanned_at}')
-        db.session.add(log)
-        db.session.commit()
+    if result == 'already_scanned':
+        scan_log_writer.append(ticket_id, 'already_scanned', f'Already scanned at {entry["scanned_at"]}')
         logger.warning(f"Already scanned ticket: {ticket_id}")
         return jsonify({'success': False, 'status': 'already_scanned', 
                        'message': 'Ticket Already Scanned',
-                       'scanned_at': ticket.scanned_at.strftime('%Y-%m-%d %H:%M:%S')})
+                       'scanned_at': entry['scanned_at'].strftime('%Y-%m-%d %H:%M:%S')})
     
-    ticket.scanned_at = datetime.utcnow()
-    log = ScanLog(ticket_id=ticket_id, result='valid', 
-                 details=f'Ticket: {ticket.ticket_instance.name}, Tier: {ticket.tier}')
-    db.session.add(log)
+    # Only the scanned_at update is committed inline; the log row goes through the buffered writer
     db.session.commit()
+    scan_log_writer.append(ticket_id, 'valid', f'Ticket: {entry["instance"]}, Tier: {entry["tier"]}')
     logger.info(f"Ticket scanned successfully: {ticket_id}")
     
     return jsonify({
         'success': True,
         'status': 'valid',
         'ticket': {
-            'id': ticket.id,
-            'instance': ticket.ticket_instance.name,
-            'tier': ticket.tier,
-            'capacity': f"Covers {ticket.ticket_instance.capacity} {'person' if ticket.ticket_instance.capacity == 1 else 'people'}",
-            'email': ticket.user.email
+            'id': ticket_id,
+            'instance': entry['instance'],
+            'tier': entry['tier'],
+            'capacity': f"Covers {entry['capacity']} {'person' if entry['capacity'] == 1 else 'people'}",
+            'email': entry['email']
         }
     })
 
+@app.route('/admin/scan-manifest')
+def scan_manifest():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    manifest = scan_index.manifest()
+    return jsonify({
+        'success': True,
+        'generated_at': datetime.utcnow().isoformat() + 'Z',
+        'signing_key': base64.b64encode(ticket_signing_key()).decode(),
+        'instances': manifest['instances'],
+        'tickets': manifest['tickets']
+    })
+
+@app.route('/admin/scan-sync', methods=['POST'])
+def scan_sync():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    
+    data = request.json or {}
+    scans = data.get('scans', [])
+    device_id = str(data.get('device_id', 'unknown'))[:64]
+    if len(scans) > 5000:
+        return jsonify({'success': False, 'error': 'Too many scans in one sync'}), 400
+    
+    try:
+        results = sync_offline_scans(scans, device_id)
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'Malformed scan: {str(e)}'}), 400
+    db.session.commit()
+    logger.info(f"Synced {len(results)} offline scans from {device_id}")
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/admin/scan-log-stats')
+def scan_log_stats():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    return jsonify({'success': True, **scan_log_writer.snapshot()})
+
+@app.route('/admin/artifact-stats')
+def artifact_stats_view():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    return jsonify({'success': True, 'template_version': TICKET_TEMPLATE_VERSION, **artifact_stats.snapshot()})
+
+@app.route('/metrics')
+def metrics_view():
+    if not app.config['METRICS_ENABLED']:
+        return "Not found", 404
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            return "Unauthorized", 401
+    elif not session.get('admin'):
+        return "Unauthorized", 401
+    
+    jobs = db.session.query(FulfillmentJob.status, db.func.count(FulfillmentJob.id)).group_by(FulfillmentJob.status)
+    emails = db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id)).group_by(EmailOutbox.status)
+    artifacts = artifact_stats.snapshot()
+    room = waiting_room.snapshot()
+    gauges = [
+        ('ticketing_fulfillment_jobs', 'Fulfillment jobs by status', [({'status': status}, count) for status, count in jobs]),
+        ('ticketing_email_outbox', 'Outbox emails by status', [({'status': status}, count) for status, count in emails]),
+        ('ticketing_artifact_lookups', 'Stored-PDF lookups in this process, by outcome',
+         [({'outcome': outcome}, artifacts[outcome]) for outcome in ('hits', 'misses', 'stale')]),
+        ('ticketing_waiting_room', 'Buyers queued and unspent admissions across workers, as of the last reload',
+         [({'state': state}, room[state]) for state in ('waiting', 'admitted')]),
+    ]
+    db.session.commit()
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/scan-index', methods=['POST'])
+def reload_scan_index():
+    if not session.get('admin'):
+        return jsonify({'success': False}), 401
+    return jsonify({'success': True, 'tickets': scan_index.load()})
+
 @app.route('/admin/logout')
 def admin_logout():
     session.pop('admin', None)
@@ -350,10 +3080,17 @@ def signup():
         email = data['email']
         pin = data['pin']
         
+        wait = throttle_login()
+        if wait:
+            return throttled_response(wait)
         if User.query.filter_by(email=email).first():
             return jsonify({'success': False, 'error': 'Email already exists'}), 400
         
-        user = User(email=email, pin_hash=generate_password_hash(pin))
+        try:
+            pin_hash = pin_hasher.hash(pin)
+        except PinHashBusy:
+            return busy_response()
+        user = User(email=email, pin_hash=pin_hash)
         db.session.add(user)
         db.session.commit()
         
@@ -370,8 +3107,23 @@ def signin():
         email = data['email']
         pin = data['pin']
         
+        # Checked before any hashing, so a flood of guesses costs a dictionary lookup each
+        wait = throttle_login(email)
+        if wait:
+            logger.warning(f"Sign-in throttled for {email} from {client_ip()}")
+            return throttled_response(wait)
+        
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(user.pin_hash, pin):
+        try:
+            valid = bool(user) and pin_hasher.check(user.pin_hash, pin)
+            if valid and pin_hasher.needs_rehash(user.pin_hash):
+                # Hashes from an older PIN_HASH_METHOD are upgraded on the next good sign-in
+                user.pin_hash = pin_hasher.hash(pin)
+                db.session.commit()
+        except PinHashBusy:
+            return busy_response()
+        if valid:
+            get_throttle_store().reset(f"email:{email.strip().lower()}")
             session['user_id'] = user.id
             logger.info(f"User signed in: {email}")
             return jsonify({'success': True})
@@ -384,17 +3136,20 @@ def signin():
 def forgot_pin():
     data = request.json
     email = data['email']
+    wait = throttle_login(email)
+    if wait:
+        return throttled_response(wait)
     user = User.query.filter_by(email=email).first()
     
     if not user:
         return jsonify({'success': False, 'error': 'Email not found'}), 404
     
     new_pin = ''.join(random.choices(string.digits, k=4))
-    user.pin_hash = generate_password_hash(new_pin)
-    db.session.commit()
-    
     try:
-        body = f"""
+        user.pin_hash = pin_hasher.hash(new_pin)
+    except PinHashBusy:
+        return busy_response()
+    body = f"""
         <html>
         <body style="background-color: #1a0000; color: #ffffff; font-family: Arial, sans-serif; padding: 20px;">
             <h1 style="color: #cc0000;">PIN Reset</h1>
@@ -403,45 +3158,79 @@ def forgot_pin():
         </body>
         </html>
         """
-
-        message = Mail(
-            from_email=os.getenv('EMAIL_ADDRESS'),
-            to_emails=email,
-            subject="Your New PIN - Dark Order",
-            html_content=body
-        )
-
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        sg.send(message)
-
-        logger.info(f"PIN reset email sent to {email} via SendGrid {new_pin}")
-        return jsonify({'success': True})
-
-    except Exception as e:
-        logger.error(f"Failed to send PIN reset email via SendGrid: {str(e)}")
-        return jsonify({'success': False, 'error': 'Failed to send email'}), 500
+    # Same transaction as the new PIN: the email is queued if and only if the PIN changed
+    enqueue_email('pin_reset', email, "Your New PIN - Dark Order", body=body)
+    db.session.commit()
+    
+    logger.info(f"PIN reset email queued for {email}")
+    return jsonify({'success': True})
 @app.route('/tickets')
 def ticket_selection():
     if 'user_id' not in session:
         return redirect(url_for('signin'))
     
-    instances = TicketInstance.query.all()
-    instances_data = [{
-        'id': instance.id,
-        'name': instance.name,
-        'capacity': instance.capacity,
-        'regular_price': instance.regular_price,
-        'vip_price': instance.vip_price,
-        'vvip_price': instance.vvip_price
-    } for instance in instances]
+    instances = instance_catalog.get()
+    return render_template('tickets.html', instances=instances, instances_json=instances)
+
+@app.route('/api/instances')
+def api_instances():
+    instances = instance_catalog.get()
+    response = jsonify({'success': True, 'instances': instances})
+    response.set_etag(instance_catalog.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['CATALOG_TTL']
+    return response.make_conditional(request)
+
+@app.route('/api/waiting-room/join', methods=['POST'])
+def waiting_room_join():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Please sign in first'}), 401
+    if not app.config['WAITING_ROOM_ENABLED']:
+        return jsonify({'success': True, 'admitted': True, 'token': None})
+    
+    result = waiting_room.join(session['user_id'])
+    if result is None:
+        return shed_response('The queue is full, please try again shortly.', 30)
+    return jsonify({'success': True, **result})
+
+@app.route('/api/waiting-room/status')
+def waiting_room_status():
+    # Polled by every queued buyer, so it reads only the session cookie and process memory until it admits
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Please sign in first'}), 401
     
-    return render_template('tickets.html', instances=instances, instances_json=instances_data)
+    result = waiting_room.poll(session['user_id'], request.args.get('token'))
+    if result is None:
+        return jsonify({'success': False, 'error': 'Invalid or expired queue token'}), 400
+    response = jsonify({'success': True, **result})
+    if not result['admitted']:
+        response.headers['Retry-After'] = str(max(1, int(result['poll_after'])))
+    return response
 
 @app.route('/purchase', methods=['POST'])
 def purchase():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Please sign in first'}), 401
+    if not app.config['WAITING_ROOM_ENABLED']:
+        return place_order()
     
+    admission_id = waiting_room.begin_checkout(session['user_id'], request.headers.get('X-Admission-Token', ''))
+    if not admission_id:
+        return jsonify({'success': False, 'error': 'Please join the queue to check out', 'waiting_room': True}), 403
+    completed = False
+    try:
+        if not checkout_gate.acquire():
+            return shed_response('Checkout is busy, retrying shortly.', 1)
+        try:
+            response = app.make_response(place_order())
+        finally:
+            checkout_gate.release()
+        completed = response.status_code == 200
+        return response
+    finally:
+        waiting_room.end_checkout(admission_id, completed)
+
+def place_order():
     data = request.json
     phone_number = data.get('phoneNumber', '')
     cart = data.get('cart', [])
@@ -453,18 +3242,28 @@ def purchase():
     if not phone_number.startswith('254') or len(phone_number) != 12:
         return jsonify({'success': False, 'error': 'Invalid phone number format. Use 254XXXXXXXXX'}), 400
     
+    for item in cart:
+        if item.get('tier') not in TICKET_TIERS or not isinstance(item.get('quantity'), int) or item['quantity'] < 1 \
+                or not isinstance(item.get('instance_id'), int):
+            return jsonify({'success': False, 'error': 'Invalid cart item'}), 400
+    
+    # Price the whole cart from one IN query; prices are read from the database, never the cache
+    instance_ids = {item['instance_id'] for item in cart}
+    instances = {instance.id: instance for instance in
+                 TicketInstance.query.filter(TicketInstance.id.in_(instance_ids))}
+    
     total_amount = 0
     for item in cart:
-        instance = db.session.get(TicketInstance, item['instance_id'])
+        instance = instances.get(item['instance_id'])
         if not instance:
             return jsonify({'success': False, 'error': f'Ticket instance {item["instance_id"]} not found'}), 404
-            
-        if item['tier'] == 'regular':
-            total_amount += instance.regular_price * item['quantity']
-        elif item['tier'] == 'vip':
-            total_amount += instance.vip_price * item['quantity']
-        elif item['tier'] == 'vvip':
-            total_amount += instance.vvip_price * item['quantity']
+        
+        price = getattr(instance, f"{item['tier']}_price")
+        if price is None:
+            return jsonify({'success': False, 'error': f'{item["tier"].upper()} is not sold for {instance.name}'}), 400
+        # Kept in payment_metadata so sales figures use the price actually charged
+        item['unit_price'] = price
+        total_amount += price * item['quantity']
     
     external_reference = str(uuid.uuid4())
     
@@ -476,6 +3275,14 @@ def purchase():
         payment_metadata=json.dumps(cart)
     )
     db.session.add(payment)
+    db.session.flush()
+    
+    # Stock is held before the STK push so a sell-out rush cannot oversell
+    sold_out = reserve_cart(payment, cart)
+    if sold_out:
+        db.session.rollback()
+        instance = db.session.get(TicketInstance, sold_out[0])
+        return jsonify({'success': False, 'error': f'{sold_out[1].upper()} tickets for {instance.name} are sold out'}), 409
     db.session.commit()
     
     base_url = os.getenv('REPLIT_DEV_DOMAIN', 'localhost:5000')
@@ -491,37 +3298,19 @@ def purchase():
         "callback_url": f"{base_url}/api/payhero/callback"
     }
     
-    headers = {
-        'Authorization': f'Basic {os.getenv("PAYHERO_BASIC_AUTH_TOKEN")}',
-        'Content-Type': 'application/json'
-    }
+    if app.config['PAYHERO_PUSH_MODE'] == 'async':
+        # The buyer page polls /api/payments/<reference>/status for the outcome
+        payhero_client.submit(run_stk_push_in_background, payment.id, payhero_data)
+        return jsonify({'success': True, 'reference': external_reference, 'queued': True})
     
-    try:
-        response = requests.post('https://backend.payhero.co.ke/api/v2/payments', 
-                               json=payhero_data, headers=headers, timeout=30)
-        response_data = response.json()
-        
-        logger.info(f"PayHero Response: {response_data}")
-        logger.info(f"STK Push initiated for {phone_number}, amount: {total_amount}, ref: {external_reference}")
-        
-        if response.status_code == 200 or response.status_code == 201:
-            return jsonify({'success': True, 'reference': external_reference, 'payhero_response': response_data})
-        else:
-            logger.error(f"PayHero error: {response_data}")
-            payment.status = 'failed'
-            db.session.commit()
-            return jsonify({'success': False, 'error': response_data.get('message', 'Payment initiation failed')}), 500
-            
-    except Exception as e:
-        logger.error(f"STK Push failed: {str(e)}")
-        payment.status = 'failed'
-        db.session.commit()
-        return jsonify({'success': False, 'error': f'Payment system error: {str(e)}'}), 500
+    ok, response_data = initiate_stk_push(payment.id, payhero_data)
+    if ok:
+        return jsonify({'success': True, 'reference': external_reference, 'payhero_response': response_data})
+    return jsonify({'success': False, 'error': response_data}), 500
 
 @app.route('/api/payhero/callback', methods=['POST'])
 def payhero_callback():
     data = request.json
-    logger.info(f"PayHero callback received: {json.dumps(data)}")
     
     # PayHero callback format: data['response'] contains the transaction details
     response_data = data.get('response', {})
@@ -529,61 +3318,114 @@ def payhero_callback():
     result_code = response_data.get('ResultCode')
     result_desc = response_data.get('ResultDesc', '')
     payment_status = response_data.get('Status', '')
+    # Only the outcome is logged; the full payload carries the buyer's phone number
+    logger.info(f"PayHero callback received for {external_reference}: {payment_status} ({result_code})")
     
     if not external_reference:
         logger.error(f"No external reference in callback: {data}")
         return jsonify({'success': False, 'error': 'Missing external reference'}), 400
     
-    payment = Payment.query.filter_by(external_reference=external_reference).first()
+    # Row lock serialises concurrent deliveries for one payment (no-op on SQLite, which locks the database)
+    payment = Payment.query.filter_by(external_reference=external_reference).with_for_update().first()
     if not payment:
         logger.error(f"Payment not found for reference: {external_reference}")
         return jsonify({'success': False}), 404
     
-    # ResultCode 0 means success
-    if result_code == 0 and payment_status == 'Success':
-        payment.status = 'success'
-        payment.callback_received_at = datetime.utcnow()
+    # PayHero retries carry the same CheckoutRequestID, so it keys the ledger of handled callbacks
+    callback_key = response_data.get('CheckoutRequestID') or f"{external_reference}:{result_code}:{payment_status}"
+    if ProcessedCallback.query.filter_by(callback_key=callback_key).first():
         db.session.commit()
-        
-        cart = json.loads(payment.payment_metadata)
-        user = User.query.get(payment.client_id)
-        tickets = []
-        
-        for item in cart:
-            for _ in range(item['quantity']):
-                ticket_id = str(uuid.uuid4())
-                qr_data, qr_url = generate_qr_code(ticket_id)
-                
-                ticket = Ticket(
-                    id=ticket_id,
-                    client_id=payment.client_id,
-                    ticket_instance_id=item['instance_id'],
-                    tier=item['tier'],
-                    qr_code_url=qr_url,
-                    qr_code_base64=qr_data
-                )
-                db.session.add(ticket)
-                tickets.append(ticket)
-        
+        logger.info(f"Duplicate PayHero callback ignored: {callback_key}")
+        return jsonify({'success': True, 'duplicate': True})
+    
+    # ResultCode 0 means success
+    is_success = result_code == 0 and payment_status == 'Success'
+    try:
+        db.session.add(ProcessedCallback(
+            callback_key=callback_key,
+            payment_id=payment.id,
+            result_code=result_code,
+            status=payment_status
+        ))
+        db.session.flush()
+        transitioned = settle_payment(payment, is_success)
         db.session.commit()
-        logger.info(f"Generated {len(tickets)} tickets for payment {external_reference}")
-        
-        send_email_with_tickets(user.email, tickets, user)
+    except IntegrityError:
+        # A concurrent delivery recorded the same callback or job first
+        db.session.rollback()
+        logger.info(f"Duplicate PayHero callback ignored: {callback_key}")
+        return jsonify({'success': True, 'duplicate': True})
+    
+    if not transitioned:
+        logger.info(f"Payment {external_reference} already {payment.status}, callback recorded only")
+    elif is_success:
+        logger.info(f"Queued fulfillment for payment {external_reference}")
     else:
-        payment.status = 'failed'
-        payment.callback_received_at = datetime.utcnow()
-        db.session.commit()
         logger.warning(f"Payment failed: {result_desc} (Code: {result_code})")
     
     return jsonify({'success': True})
 
+@app.route('/api/payments/<reference>/status')
+def payment_status(reference):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Please sign in first'}), 401
+
+    payment = Payment.query.filter_by(external_reference=reference).first()
+    if not payment or payment.client_id != session['user_id']:
+        return jsonify({'success': False, 'error': 'Payment not found'}), 404
+
+    job = FulfillmentJob.query.filter_by(payment_id=payment.id).first()
+    email = EmailOutbox.query.filter_by(payment_id=payment.id, kind='tickets').first()
+    return jsonify({
+        'success': True,
+        'reference': reference,
+        'payment_status': payment.status,
+        'fulfillment_status': job.status if job else None,
+        'fulfillment_stage': job.stage if job else None,
+        'tickets_issued': Ticket.query.filter_by(payment_id=payment.id).count(),
+        'email_status': email.status if email else None,
+        'email_sent_at': email.sent_at.isoformat() if email and email.sent_at else None
+    })
+
 @app.route('/my-tickets')
 def my_tickets():
     if 'user_id' not in session:
         return redirect(url_for('signin'))
     
-    tickets = Ticket.query.filter_by(client_id=session['user_id']).order_by(Ticket.created_at.desc()).all()
-    return render_template('my_tickets.html', tickets=tickets)
+    try:
+        tickets, next_cursor = my_tickets_page(session['user_id'], request.args.get('before'))
+    except ValueError:
+        return "Invalid page cursor", 400
+    return render_template('my_tickets.html', tickets=tickets, next_cursor=next_cursor,
+                           first_page=not request.args.get('before'))
+
+@app.route('/api/my-tickets')
+def my_tickets_api():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Please sign in first'}), 401
+    
+    limit = min(request.args.get('limit', app.config['MY_TICKETS_PAGE_SIZE'], type=int), 100)
+    if limit < 1:
+        return jsonify({'success': False, 'error': 'limit must be at least 1'}), 400
+    try:
+        tickets, next_cursor = my_tickets_page(session['user_id'], request.args.get('before'), limit)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid page cursor'}), 400
+    
+    return jsonify({
+        'success': True,
+        'tickets': [{
+            'id': ticket.id,
+            'instance': ticket.instance_name,
+            'tier': ticket.tier,
+            'capacity': ticket.capacity,
+            'created_at': ticket.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'scanned_at': ticket.scanned_at.strftime('%Y-%m-%d %H:%M:%S') if ticket.scanned_at else None,
+            'qr_url': url_for('ticket_qr', ticket_id=ticket.id),
+            'pdf_url': url_for('download_ticket', ticket_id=ticket.id)
+        } for ticket in tickets],
+        'next': next_cursor
+    })
 
 @app.route('/download-ticket/<ticket_id>')
 def download_ticket(ticket_id):
@@ -595,9 +3437,51 @@ def download_ticket(ticket_id):
         return "Ticket not found", 404
     
     user = User.query.get(session['user_id'])
-    pdf_buffer = generate_pdf_ticket(ticket, user.email)
+    key = stored_ticket_pdf(ticket, user.email)
+    db.session.commit()  # Keeps pdf_path when this request had to render
+    
+    return send_artifact(key, download_name=f'ticket_{ticket_id}.pdf', mimetype='application/pdf')
+
+@app.route('/download-tickets')
+def download_tickets():
+    if 'user_id' not in session:
+        return redirect(url_for('signin'))
+    
+    query = Ticket.query.filter_by(client_id=session['user_id'])
+    reference = request.args.get('payment')
+    if reference:
+        payment = Payment.query.filter_by(external_reference=reference, client_id=session['user_id']).first()
+        if not payment:
+            return "Payment not found", 404
+        query = query.filter_by(payment_id=payment.id)
+    tickets = query.order_by(Ticket.created_at.desc()).all()
+    if not tickets:
+        return "No tickets found", 404
+    
+    user = User.query.get(session['user_id'])
+    if request.args.get('format') == 'zip':
+        archive = generate_ticket_zip(tickets, user.email)
+        db.session.commit()
+        return send_file(archive, as_attachment=True, download_name='dark_order_tickets.zip', mimetype='application/zip')
+    return send_file(generate_pdf_tickets(tickets, user.email), as_attachment=True,
+                     download_name='dark_order_tickets.pdf', mimetype='application/pdf')
+
+@app.route('/ticket/<ticket_id>/qr.png')
+def ticket_qr(ticket_id):
+    if 'user_id' not in session and not session.get('admin'):
+        return redirect(url_for('signin'))
     
-    return send_file(pdf_buffer, as_attachment=True, download_name=f'ticket_{ticket_id}.pdf', mimetype='application/pdf')
+    # Only the columns in the QR payload are read; the image itself never has to leave the database
+    row = db.session.query(Ticket.client_id, Ticket.ticket_instance_id, Ticket.tier).filter_by(id=ticket_id).first()
+    if row is None or (row.client_id != session.get('user_id') and not session.get('admin')):
+        return "Ticket not found", 404
+    
+    qr_url = ticket_verify_url(ticket_id, row.ticket_instance_id, row.tier)
+    response = app.response_class(render_qr_png(qr_url), mimetype='image/png')
+    response.set_etag(hashlib.sha1(qr_url.encode()).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
 
 @app.route('/ticket/verify/<ticket_id>')
 def verify_ticket_page(ticket_id):
@@ -612,5 +3496,99 @@ def logout():
     session.pop('user_id', None)
     return redirect(url_for('index'))
 
+# CLI Commands
+@app.cli.group('schema')
+def schema_cli():
+    """Create tables and apply versioned schema migrations."""
+
+@schema_cli.command('upgrade')
+def schema_upgrade():
+    """Create missing tables and apply pending migrations."""
+    applied = init_database()
+    click.echo(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+@schema_cli.command('status')
+def schema_status():
+    """List migrations and when each was applied."""
+    applied = applied_migrations()
+    for version, name, fn in MIGRATIONS:
+        row = applied.get(version)
+        click.echo(f"{version:>4}  {row.applied_at.strftime('%Y-%m-%d %H:%M:%S') if row else 'pending':<19}  {name}")
+
+@app.cli.group('dashboard')
+def dashboard_cli():
+    """Maintain the admin dashboard summary tables."""
+
+@dashboard_cli.command('rebuild')
+def dashboard_rebuild():
+    """Recompute sales, check-in and scan-rate summaries from the source tables."""
+    instance_tiers, scan_minutes = rebuild_dashboard_summaries()
+    click.echo(f"Rebuilt {instance_tiers} instance/tier rows and {scan_minutes} scan-minute rows")
+
+@app.cli.group('qr-storage')
+def qr_storage_cli():
+    """Migrate stored ticket QR codes between storage modes."""
+
+def measure_ticket_qr_bytes():
+    qr_bytes = db.func.coalesce(db.func.length(Ticket.qr_code_base64), 0) + \
+        db.func.coalesce(db.func.length(Ticket.qr_code_url), 0)
+    count, total = db.session.query(db.func.count(Ticket.id), db.func.sum(qr_bytes)).one()
+    sizes = {'tickets': count, 'qr_bytes': int(total or 0), 'avg_qr_bytes_per_row': int((total or 0) / count) if count else 0}
+    if db.engine.dialect.name == 'postgresql':
+        sizes['table_bytes'] = db.session.execute(db.text("SELECT pg_total_relation_size('tickets')")).scalar()
+        sizes['avg_row_bytes'] = int(db.session.execute(db.text('SELECT avg(pg_column_size(t.*)) FROM tickets t')).scalar() or 0)
+    return sizes
+
+@qr_storage_cli.command('strip')
+@click.option('--batch-size', default=500, show_default=True)
+def qr_storage_strip(batch_size):
+    """Drop stored QR images and URLs; they are rendered on demand from the ticket id."""
+    click.echo(f"Before: {measure_ticket_qr_bytes()}")
+    stripped = 0
+    while True:
+        ids = [row.id for row in db.session.query(Ticket.id).filter(
+            db.or_(Ticket.qr_code_base64.isnot(None), Ticket.qr_code_url.isnot(None))
+        ).limit(batch_size)]
+        if not ids:
+            break
+        Ticket.query.filter(Ticket.id.in_(ids)).update(
+            {'qr_code_base64': None, 'qr_code_url': None}, synchronize_session=False
+        )
+        db.session.commit()
+        stripped += len(ids)
+    click.echo(f"Stripped QR data from {stripped} tickets")
+    if db.engine.dialect.name == 'postgresql':
+        click.echo("Run VACUUM FULL tickets to return the freed space to the OS")
+    click.echo(f"After: {measure_ticket_qr_bytes()}")
+
+@qr_storage_cli.command('backfill')
+@click.option('--batch-size', default=500, show_default=True)
+def qr_storage_backfill(batch_size):
+    """Store base64 QR images on tickets that lack them (for QR_STORAGE=inline)."""
+    click.echo(f"Before: {measure_ticket_qr_bytes()}")
+    filled = 0
+    while True:
+        tickets = Ticket.query.filter(Ticket.qr_code_base64.is_(None)).limit(batch_size).all()
+        if not tickets:
+            break
+        for ticket in tickets:
+            ticket.qr_code_base64, ticket.qr_code_url = generate_qr_code(ticket.id, ticket.ticket_instance_id, ticket.tier)
+        db.session.commit()
+        filled += len(tickets)
+    click.echo(f"Backfilled QR data for {filled} tickets")
+    click.echo(f"After: {measure_ticket_qr_bytes()}")
+
+# Application Entry Point
+def create_app(config=None):
+    """WSGI entry point (gunicorn 'app:create_app()'): apply config overrides and, if enabled, the schema."""
+    if config:
+        app.config.update(config)
+    # Off by default so importing the app never touches the database; with gunicorn --preload this runs once
+    if app.config['SCHEMA_AUTO_UPGRADE']:
+        with app.app_context():
+            init_database()
+    return app
+
 if __name__ == '__main__':
+    create_app({'SCHEMA_AUTO_UPGRADE': True})
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,156 @@
+"""Ticket artifact store: /download-ticket throughput rendering every time versus serving the stored PDF.
+
+Usage:
+    python bench/artifacts.py [--tickets 200] [--downloads 3]
+
+On a throwaway SQLite database (or DATABASE_URL) and artifact directory it
+issues --tickets tickets through the fulfillment queue (which, with
+'separate' email attachments, renders and stores each PDF once), then downloads every ticket --downloads times:
+  render_each_time  the old route: generate_pdf_ticket on every request
+  stored            /download-ticket/<id> served from the artifact store
+  revalidated       the same with If-None-Match, answered 304
+  range             a 4KB Range request, answered 206
+It checks the cache-hit counters, that stored PDFs match what the route
+serves, that bumping TICKET_TEMPLATE_VERSION re-renders each PDF once, and
+that with the default 'combined' email the render stage stores nothing, so
+a purchase's tickets are drawn once (for the email) until downloaded.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'artifacts.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+
+from flask import send_file  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+
+
+def run(label, client, ticket_ids, downloads, headers=None, status=200):
+    total_bytes = 0
+    started = time.perf_counter()
+    for _ in range(downloads):
+        for ticket_id in ticket_ids:
+            response = client.get(f'/download-ticket/{ticket_id}', headers=headers(ticket_id) if headers else None)
+            assert response.status_code == status, (label, response.status_code)
+            total_bytes += len(response.data)
+    elapsed = time.perf_counter() - started
+    requests = downloads * len(ticket_ids)
+    return {'requests_per_sec': round(requests / elapsed, 1), 'mb_per_sec': round(total_bytes / elapsed / 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=200)
+    parser.add_argument('--downloads', type=int, default=3)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, 'TICKET_ATTACHMENT_MODE': 'separate'})
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+
+    with ticketing.app.app_context():
+        instance = ticketing.TicketInstance(name='Artifact Night', capacity=1, regular_price=100)
+        user = ticketing.User(email=f'artifacts-{uuid.uuid4()}@example.com', pin_hash='x')
+        db.session.add_all([instance, user])
+        db.session.flush()
+        for start in range(0, args.tickets, 10):
+            payment = ticketing.Payment(
+                client_id=user.id, external_reference=str(uuid.uuid4()), amount=100, status='success',
+                payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular',
+                                              'quantity': min(10, args.tickets - start)}]))
+            db.session.add(payment)
+            db.session.flush()
+            ticketing.enqueue_fulfillment(payment)
+        db.session.commit()
+        started = time.perf_counter()
+        while ticketing.process_next_fulfillment_job():
+            pass
+        fulfillment_s = time.perf_counter() - started
+        ticket_ids = [row.id for row in db.session.query(ticketing.Ticket.id).filter(ticketing.Ticket.pdf_path.isnot(None))]
+        user_id, email = user.id, user.email
+
+        # The combined email draws its own multi-page PDF, so the render stage must not draw each ticket again
+        ticketing.app.config['TICKET_ATTACHMENT_MODE'] = 'combined'
+        payment = ticketing.Payment(
+            client_id=user.id, external_reference=str(uuid.uuid4()), amount=100, status='success',
+            payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular', 'quantity': 5}]))
+        db.session.add(payment)
+        db.session.flush()
+        ticketing.enqueue_fulfillment(payment)
+        db.session.commit()
+        while ticketing.process_next_fulfillment_job():
+            pass
+        combined_stored = ticketing.Ticket.query.filter(ticketing.Ticket.payment_id == payment.id,
+                                                        ticketing.Ticket.pdf_path.isnot(None)).count()
+        ticketing.app.config['TICKET_ATTACHMENT_MODE'] = 'separate'
+
+    report = {'tickets': args.tickets, 'stored_at_fulfillment': len(ticket_ids), 'stored_in_combined_mode': combined_stored,
+              'fulfillment_s': round(fulfillment_s, 2), 'after_fulfillment': ticketing.artifact_stats.snapshot()}
+
+    client = ticketing.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+
+    # Baseline: the route as it was, rendering on every request
+    baseline = ticketing.app.test_client()
+    with baseline.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+
+    def render_each_time(ticket_id):
+        ticket = db.session.get(ticketing.Ticket, ticket_id)
+        return send_file(ticketing.generate_pdf_ticket(ticket, email), as_attachment=True,
+                         download_name=f'ticket_{ticket_id}.pdf', mimetype='application/pdf')
+    ticketing.app.add_url_rule('/bench/render-ticket/<ticket_id>', 'bench_render_ticket', render_each_time)
+
+    started = time.perf_counter()
+    rendered_bytes = 0
+    for _ in range(args.downloads):
+        for ticket_id in ticket_ids:
+            response = baseline.get(f'/bench/render-ticket/{ticket_id}')
+            rendered_bytes += len(response.data)
+    elapsed = time.perf_counter() - started
+    report['render_each_time'] = {'requests_per_sec': round(args.downloads * len(ticket_ids) / elapsed, 1),
+                                  'mb_per_sec': round(rendered_bytes / elapsed / 1e6, 2)}
+
+    etags = {ticket_id: client.get(f'/download-ticket/{ticket_id}').headers['ETag'] for ticket_id in ticket_ids}
+    report['stored'] = run('stored', client, ticket_ids, args.downloads)
+    report['revalidated'] = run('revalidated', client, ticket_ids, args.downloads,
+                                headers=lambda ticket_id: {'If-None-Match': etags[ticket_id]}, status=304)
+    report['range'] = run('range', client, ticket_ids, args.downloads,
+                          headers=lambda ticket_id: {'Range': 'bytes=0-4095'}, status=206)
+    report['after_downloads'] = ticketing.artifact_stats.snapshot()
+
+    with ticketing.app.app_context():
+        ticket = db.session.get(ticketing.Ticket, ticket_ids[0])
+        served = client.get(f'/download-ticket/{ticket.id}').data
+        matches_store = served == ticketing.get_artifact_store().read(ticket.pdf_path)
+
+    # A template change: every PDF is re-rendered once, then served from the store again
+    ticketing.TICKET_TEMPLATE_VERSION += 1
+    before = ticketing.artifact_stats.snapshot()
+    for ticket_id in ticket_ids:
+        client.get(f'/download-ticket/{ticket_id}')
+        client.get(f'/download-ticket/{ticket_id}')
+    after = ticketing.artifact_stats.snapshot()
+    report['template_bump'] = {'stale': after['stale'] - before['stale'], 'hits': after['hits'] - before['hits']}
+
+    print(json.dumps(report, indent=2))
+    ok = len(ticket_ids) == args.tickets and combined_stored == 0 and report['after_fulfillment']['misses'] == args.tickets \
+        and report['after_downloads']['misses'] == args.tickets and matches_store \
+        and report['template_bump'] == {'stale': args.tickets, 'hits': args.tickets}
+    print('OK: PDFs rendered once and served from the store' if ok else 'FAIL: artifact store re-rendered or mismatched')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
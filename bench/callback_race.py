@@ -0,0 +1,107 @@
+"""Fire N concurrent PayHero callbacks at one payment and check it is fulfilled exactly once.
+
+Usage:
+    python bench/callback_race.py [--callbacks 20] [--quantity 3]
+
+Runs against a throwaway SQLite database unless DATABASE_URL is already set
+(point it at a scratch Postgres database to exercise SELECT ... FOR UPDATE).
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'callback_race.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+
+import app as ticketing  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--callbacks', type=int, default=20)
+    parser.add_argument('--quantity', type=int, default=3)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    emails = []
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: emails.append(len(tickets)) or True
+
+    reference = str(uuid.uuid4())
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'race-{reference}@example.com', pin_hash='x')
+        instance = ticketing.TicketInstance(name='Race Night', capacity=1, regular_price=100)
+        ticketing.db.session.add_all([user, instance])
+        ticketing.db.session.commit()
+        payment = ticketing.Payment(
+            client_id=user.id,
+            external_reference=reference,
+            amount=100 * args.quantity,
+            status='pending',
+            payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular', 'quantity': args.quantity}])
+        )
+        ticketing.db.session.add(payment)
+        ticketing.db.session.commit()
+        payment_id = payment.id
+
+    body = {'status': True, 'response': {
+        'CheckoutRequestID': f'ws_CO_{reference}',
+        'ExternalReference': reference,
+        'ResultCode': 0,
+        'ResultDesc': 'The service request is processed successfully.',
+        'Status': 'Success',
+    }}
+    barrier = threading.Barrier(args.callbacks)
+    responses = []
+
+    def deliver():
+        client = ticketing.app.test_client()
+        barrier.wait()
+        response = client.post('/api/payhero/callback', json=body)
+        responses.append((response.status_code, (response.get_json() or {}).get('duplicate', False)))
+
+    threads = [threading.Thread(target=deliver) for _ in range(args.callbacks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with ticketing.app.app_context():
+        while ticketing.process_next_fulfillment_job():
+            pass
+        while ticketing.deliver_pending_emails():
+            pass
+        jobs = ticketing.FulfillmentJob.query.filter_by(payment_id=payment_id).count()
+        tickets = ticketing.Ticket.query.filter_by(payment_id=payment_id).count()
+        ledger = ticketing.ProcessedCallback.query.filter_by(payment_id=payment_id).count()
+
+    accepted = sum(1 for status, duplicate in responses if status == 200 and not duplicate)
+    duplicates = sum(1 for status, duplicate in responses if status == 200 and duplicate)
+    errors = sum(1 for status, _ in responses if status != 200)
+    print(json.dumps({
+        'callbacks': args.callbacks,
+        'accepted': accepted,
+        'duplicates': duplicates,
+        'errors': errors,
+        'ledger_rows': ledger,
+        'fulfillment_jobs': jobs,
+        'tickets': tickets,
+        'emails': len(emails),
+    }, indent=2))
+
+    assert accepted == 1, f'expected exactly one accepted callback, got {accepted}'
+    assert ledger == 1 and jobs == 1, 'callback was processed more than once'
+    assert tickets == args.quantity, f'expected {args.quantity} tickets, got {tickets}'
+    assert emails == [args.quantity], f'expected one email, got {emails}'
+    print('OK: exactly one fulfillment')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Requests/sec and SQL statements for /tickets and /purchase with and without the catalog cache.
+
+Usage:
+    python bench/catalog.py [--instances 20] [--requests 300] [--cart-lines 10]
+
+"Without cache" sets CATALOG_TTL=0 so every /tickets view reloads the catalog,
+matching the old TicketInstance.query.all() per request. /purchase always
+prices from the database; its statement count shows the single IN query
+versus one lookup per cart line.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'catalog.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['PAYHERO_PUSH_MODE'] = 'sync'
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+
+from sqlalchemy import event  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+statements = threading.local()
+
+
+def count_statement(*args):
+    statements.count = getattr(statements, 'count', 0) + 1
+
+
+def run(client, requests, send):
+    statements.count = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        response = send(client)
+        assert response.status_code in (200, 304), response.status_code
+    elapsed = time.perf_counter() - started
+    return {'requests_per_sec': round(requests / elapsed, 1), 'statements_per_request': round(statements.count / requests, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--cart-lines', type=int, default=10)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    ticketing.payhero_client.stk_push = lambda payload: (201, {'success': True})
+    with ticketing.app.app_context():
+        event.listen(ticketing.db.engine, 'before_cursor_execute', count_statement)
+        user = ticketing.User(email='catalog@example.com', pin_hash='x')
+        instances = [ticketing.TicketInstance(name=f'Instance {i}', capacity=1, regular_price=100, vip_price=200)
+                     for i in range(args.instances)]
+        ticketing.db.session.add_all([user, *instances])
+        ticketing.db.session.commit()
+        user_id = user.id
+        instance_ids = [instance.id for instance in instances]
+
+    client = ticketing.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+
+    results = {}
+    ticketing.app.config['CATALOG_TTL'] = 0
+    results['tickets_without_cache'] = run(client, args.requests, lambda c: c.get('/tickets'))
+    ticketing.app.config['CATALOG_TTL'] = 300
+    results['tickets_with_cache'] = run(client, args.requests, lambda c: c.get('/tickets'))
+
+    etag = client.get('/api/instances').headers['ETag']
+    results['api_instances_with_cache'] = run(client, args.requests, lambda c: c.get('/api/instances'))
+    results['api_instances_not_modified'] = run(
+        client, args.requests, lambda c: c.get('/api/instances', headers={'If-None-Match': etag}))
+
+    cart = [{'instance_id': instance_ids[i % len(instance_ids)], 'tier': 'vip' if i % 2 else 'regular', 'quantity': 1}
+            for i in range(args.cart_lines)]
+    results['purchase'] = run(client, args.requests, lambda c: c.post(
+        '/purchase', json={'phoneNumber': '254700000000', 'cart': cart}))
+    results['purchase']['cart_lines'] = args.cart_lines
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Admin comp batches: tickets issued per second and the streamed zip, inline versus the process pool.
+
+Usage:
+    python bench/comp_issue.py [--tickets 2000] [--processes 4] [--chunk 100]
+
+On a throwaway SQLite database (or DATABASE_URL) with QR_STORAGE='inline' (the
+mode where issuance renders QR codes) it times:
+  per_ticket   issue_tickets_for_payment: uuid4, generate_qr_code and an ORM add per ticket
+  bulk_inline  issue_comp_tickets with BULK_ISSUE_PROCESSES=0 (one bulk INSERT, QRs in this process)
+  bulk_pool    issue_comp_tickets with QRs rendered in --processes worker processes
+and then downloads the batch zip through /admin/comp-batches/<reference>/tickets.zip
+with PDFs rendered inline and in the pool, checking every ticket has its PDF.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'comp_issue.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['QR_STORAGE'] = 'inline'
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+
+
+def per_ticket(instance_id, user_id, quantity):
+    with ticketing.app.app_context():
+        payment = ticketing.Payment(
+            client_id=user_id, external_reference=str(uuid.uuid4()), amount=0, status='success',
+            payment_metadata=json.dumps([{'instance_id': instance_id, 'tier': 'regular', 'quantity': quantity}]))
+        db.session.add(payment)
+        db.session.flush()
+        started = time.perf_counter()
+        ticketing.issue_tickets_for_payment(payment)
+        db.session.commit()
+        return time.perf_counter() - started
+
+
+def bulk(admin, instance_id, quantity, processes):
+    ticketing.app.config['BULK_ISSUE_PROCESSES'] = processes
+    started = time.perf_counter()
+    response = admin.post(f'/admin/instance/{instance_id}/comp-tickets', json={
+        'tier': 'regular', 'quantity': quantity, 'email': 'sponsor@example.com'})
+    elapsed = time.perf_counter() - started
+    data = response.get_json()
+    assert data['success'], data
+    return elapsed, data
+
+
+def download(admin, url, processes, quantity):
+    ticketing.app.config['BULK_ISSUE_PROCESSES'] = processes
+    started = time.perf_counter()
+    response = admin.get(url)
+    first_byte, body = None, BytesIO()
+    for chunk in response.response:
+        if chunk and first_byte is None:
+            first_byte = time.perf_counter() - started
+        body.write(chunk)
+    elapsed = time.perf_counter() - started
+    with zipfile.ZipFile(body) as archive:
+        names = archive.namelist()
+        valid = len(names) == quantity and archive.read(names[-1]).startswith(b'%PDF')
+    return {'first_byte_ms': round(first_byte * 1000, 1), 'total_s': round(elapsed, 2),
+            'pdfs_per_sec': round(quantity / elapsed, 1), 'zip_mb': round(body.tell() / 1e6, 2), 'valid': valid}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--chunk', type=int, default=100)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, 'BULK_ISSUE_CHUNK': args.chunk,
+                          'BULK_ISSUE_PROCESSES': args.processes})
+
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+    instance_id = admin.post('/admin/create-ticket-instance', json={
+        'name': 'Sponsor Night', 'capacity': 1, 'regular_price': 500
+    }).get_json()['id']
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'comp-{uuid.uuid4()}@example.com', pin_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    # Start the workers up front so spawn cost is reported on its own
+    started = time.perf_counter()
+    ticketing.get_bulk_pool().submit(ticketing.render_qr_chunk, []).result()
+    list(ticketing.get_bulk_pool().map(ticketing.render_qr_chunk, [[]] * args.processes))
+    report = {'tickets': args.tickets, 'processes': args.processes, 'pool_start_s': round(time.perf_counter() - started, 2)}
+
+    elapsed = per_ticket(instance_id, user_id, args.tickets)
+    report['per_ticket'] = {'s': round(elapsed, 2), 'tickets_per_sec': round(args.tickets / elapsed, 1)}
+    for name, processes in (('bulk_inline', 0), ('bulk_pool', args.processes)):
+        elapsed, data = bulk(admin, instance_id, args.tickets, processes)
+        report[name] = {'s': round(elapsed, 2), 'tickets_per_sec': round(args.tickets / elapsed, 1)}
+    download_url = data['download_url']
+
+    with ticketing.app.app_context():
+        issued = db.session.query(db.func.count(ticketing.Ticket.id)).join(ticketing.Payment).filter(
+            ticketing.Payment.external_reference == data['reference'],
+            ticketing.Ticket.qr_code_base64.isnot(None)).scalar()
+        sold = ticketing.Inventory.query.filter_by(ticket_instance_id=instance_id, tier='regular').one().sold
+        summary = ticketing.SalesSummary.query.filter_by(ticket_instance_id=instance_id, tier='regular').one()
+    report['batch_tickets_with_qr'] = issued
+    report['inventory_sold'] = sold
+    report['dashboard_tickets_sold'] = summary.tickets_sold
+
+    report['zip_inline'] = download(admin, download_url, 0, args.tickets)
+    report['zip_pool'] = download(admin, download_url, args.processes, args.tickets)
+
+    print(json.dumps(report, indent=2))
+    ok = issued == args.tickets and sold == summary.tickets_sold == 2 * args.tickets \
+        and report['zip_inline']['valid'] and report['zip_pool']['valid']
+    print('OK: comp batches issued and downloaded' if ok else 'FAIL: comp batch incomplete')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
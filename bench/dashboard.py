@@ -0,0 +1,172 @@
+"""Admin dashboard: incremental summaries versus ad-hoc COUNT queries, consistency and polling.
+
+Usage:
+    python bench/dashboard.py [--purchases 60] [--extra-tickets 50000] [--repeat 20]
+
+On a throwaway SQLite database (or DATABASE_URL) it drives purchases, success
+and failure callbacks, fulfillment, online and offline scans through the app,
+then checks the incrementally maintained summaries match a full rebuild from
+the source tables. It then bulk-loads --extra-tickets sold and scanned tickets
+and compares the latency of the old ad-hoc aggregate queries with
+dashboard_snapshot(), polls /admin/api/dashboard and checks a repeat poll
+with the returned ETag is answered 304 until the numbers change.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'dashboard.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+os.environ['PAYHERO_PUSH_MODE'] = 'sync'
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 2)
+
+
+def ad_hoc_dashboard():
+    # What the numbers cost without summary tables: aggregates over the full source tables
+    since = datetime.utcnow() - timedelta(minutes=ticketing.app.config['DASHBOARD_SCAN_MINUTES'])
+    sold = db.session.query(ticketing.Ticket.ticket_instance_id, ticketing.Ticket.tier, db.func.count(ticketing.Ticket.id)) \
+        .group_by(ticketing.Ticket.ticket_instance_id, ticketing.Ticket.tier).all()
+    revenue = db.session.query(db.func.sum(ticketing.Payment.amount)).filter(ticketing.Payment.status == 'success').scalar()
+    checked_in = db.session.query(ticketing.Ticket.ticket_instance_id, ticketing.Ticket.tier, db.func.count(ticketing.Ticket.id)) \
+        .filter(ticketing.Ticket.scanned_at.isnot(None)) \
+        .group_by(ticketing.Ticket.ticket_instance_id, ticketing.Ticket.tier).all()
+    scans = db.session.query(ticketing.ScanLog.scanned_at, ticketing.ScanLog.result) \
+        .filter(ticketing.ScanLog.scanned_at >= since).all()
+    return sold, revenue, checked_in, len(scans)
+
+
+def comparable(snapshot):
+    return {key: snapshot[key] for key in ('totals', 'instances', 'scans_per_minute')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--purchases', type=int, default=60)
+    parser.add_argument('--extra-tickets', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, 'DASHBOARD_CACHE_SECONDS': 0})
+
+    random.seed(7)
+    ticketing.payhero_client.stk_push = lambda payload: (201, {'success': True, 'reference': str(uuid.uuid4())})
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+    instance_ids = [admin.post('/admin/create-ticket-instance', json={
+        'name': f'Dashboard Night {i}', 'capacity': 1, 'regular_price': 500, 'vip_price': 1500
+    }).get_json()['id'] for i in range(3)]
+
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'dashboard-{uuid.uuid4()}@example.com', pin_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    buyer = ticketing.app.test_client()
+    with buyer.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+
+    callbacks = ticketing.app.test_client()
+    for _ in range(args.purchases):
+        cart = [{'instance_id': random.choice(instance_ids), 'tier': random.choice(['regular', 'vip']),
+                 'quantity': random.randint(1, 3)} for _ in range(random.randint(1, 2))]
+        reference = buyer.post('/purchase', json={'phoneNumber': '254700000000', 'cart': cart}).get_json()['reference']
+        succeeded = random.random() < 0.8
+        callbacks.post('/api/payhero/callback', json={'response': {
+            'ExternalReference': reference, 'CheckoutRequestID': str(uuid.uuid4()),
+            'ResultCode': 0 if succeeded else 1032, 'Status': 'Success' if succeeded else 'Cancelled'}})
+
+    with ticketing.app.app_context():
+        while ticketing.process_next_fulfillment_job():
+            pass
+        ticket_ids = [row.id for row in db.session.query(ticketing.Ticket.id)]
+
+    random.shuffle(ticket_ids)
+    online, offline = ticket_ids[:len(ticket_ids) // 2], ticket_ids[len(ticket_ids) // 2:len(ticket_ids) * 3 // 4]
+    for ticket_id in online + online[:10] + ['not-a-ticket']:
+        admin.post('/admin/verify-ticket', json={'ticket_id': ticket_id})
+    now = datetime.utcnow()
+    admin.post('/admin/scan-sync', json={'device_id': 'door-2', 'scans': [
+        {'ticket_id': ticket_id, 'scanned_at': (now - timedelta(minutes=random.randint(0, 20))).isoformat()}
+        for ticket_id in offline + online[:5]]})
+    ticketing.scan_log_writer.flush()
+
+    report = {}
+    with ticketing.app.app_context():
+        incremental = ticketing.dashboard_snapshot()
+        ticketing.rebuild_dashboard_summaries()
+        rebuilt = ticketing.dashboard_snapshot()
+        report['consistent_with_rebuild'] = comparable(incremental) == comparable(rebuilt)
+        report['totals'] = incremental['totals']
+
+        # Scale the event up without going through the app, then rebuild the summaries to match
+        instance_id = instance_ids[0]
+        batch = []
+        for i in range(args.extra_tickets):
+            batch.append({'id': str(uuid.uuid4()), 'client_id': user_id, 'ticket_instance_id': instance_id,
+                          'tier': 'regular', 'scanned_at': now if i % 2 else None})
+            if len(batch) == 5000 or i == args.extra_tickets - 1:
+                db.session.execute(db.insert(ticketing.Ticket), batch)
+                db.session.add(ticketing.Payment(
+                    client_id=user_id, external_reference=str(uuid.uuid4()), amount=500 * len(batch), status='success',
+                    payment_metadata=json.dumps([{'instance_id': instance_id, 'tier': 'regular',
+                                                  'quantity': len(batch), 'unit_price': 500}])))
+                batch = []
+        db.session.execute(db.insert(ticketing.ScanLog), [
+            {'ticket_id': None, 'result': 'valid', 'scanned_at': now - timedelta(seconds=i % 3600)}
+            for i in range(args.extra_tickets // 2)])
+        db.session.commit()
+        ticketing.rebuild_dashboard_summaries()
+
+        report['tickets_in_db'] = db.session.query(db.func.count(ticketing.Ticket.id)).scalar()
+        report['ad_hoc_queries_ms'] = timed(ad_hoc_dashboard, args.repeat)
+        report['summary_snapshot_ms'] = timed(ticketing.dashboard_snapshot, args.repeat)
+
+    started = time.perf_counter()
+    response = admin.get('/admin/api/dashboard')
+    report['poll_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    polled = response.get_json()
+    report['poll_ok'] = polled['totals']['tickets_sold'] == report['totals']['tickets_sold'] + args.extra_tickets
+
+    # A repeat poll with the ETag is a bodyless 304 until a sale or scan changes the snapshot
+    unchanged = admin.get('/admin/api/dashboard', headers={'If-None-Match': response.headers['ETag']})
+    with ticketing.app.app_context():
+        ticketing.record_check_in({'instance_id': instance_id, 'tier': 'regular'})
+        ticketing.db.session.commit()
+    changed = admin.get('/admin/api/dashboard', headers={'If-None-Match': response.headers['ETag']})
+    report['revalidation'] = {'unchanged': unchanged.status_code, 'changed': changed.status_code}
+
+    print(json.dumps(report, indent=2))
+    ok = report['consistent_with_rebuild'] and report['poll_ok'] \
+        and report['revalidation'] == {'unchanged': 304, 'changed': 200}
+    print('OK: summaries match a full rebuild' if ok else 'FAIL: summaries diverged from the source tables')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
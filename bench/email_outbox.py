@@ -0,0 +1,219 @@
+"""Email outbox: delivery through a flaky fake transport, send-rate ceiling, retries and PIN-reset latency.
+
+Usage:
+    python bench/email_outbox.py [--payments 40] [--resets 20] [--rate 10] [--fail-rate 0.3] [--latency 0.2]
+                                 [--processes 2]
+
+On a throwaway SQLite database (or DATABASE_URL) it issues tickets for
+--payments paid carts and queues --resets PIN resets, then runs two delivery
+threads in each of --processes processes against FakeMailTransport, which
+rejects --fail-rate of sends and writes each message to a shared directory.
+Ticket emails are split one ticket per part, so a retry must resume after the
+parts already sent, and EMAIL_LOCK_TIMEOUT is shorter than a claimed batch
+takes to send, so claims must be renewed as each message goes out. Every
+outbox row must end 'sent' with a provider id per message, every part and
+every ticket must be delivered exactly once, and no one-second window across
+all processes may exceed the configured rate plus its burst. /forgot-pin latency is compared with a send made inline in the request,
+as before the outbox, and a final phase checks SendGridTransport builds one
+API client for every send.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'email_outbox.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+
+
+def wait_for(predicate, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def outbox_counts():
+    with ticketing.app.app_context():
+        return dict(db.session.query(ticketing.EmailOutbox.status, db.func.count(ticketing.EmailOutbox.id))
+                    .group_by(ticketing.EmailOutbox.status).all())
+
+
+def deliver(config, directory, fail_rate, stop):
+    # Another process with its own delivery threads and transport, like a second gunicorn worker
+    ticketing.create_app(config)
+    ticketing.mail_transport = ticketing.FakeMailTransport(directory, fail_rate=fail_rate)
+    workers = [ticketing.EmailDeliveryWorker(name=f'email-child-{os.getpid()}-{i}') for i in range(2)]
+    for worker in workers:
+        worker.start()
+    stop.wait()
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.join()
+
+
+def load_sent(directory):
+    sent = []
+    for folder in os.listdir(directory):
+        with open(os.path.join(directory, folder, 'message.json')) as handle:
+            sent.append(json.load(handle))
+    return sent
+
+
+def busiest_second(sent):
+    times = sorted(datetime.fromisoformat(record['sent_at']).timestamp() for record in sent)
+    busiest, start = 0, 0
+    for end, moment in enumerate(times):
+        while moment - times[start] >= 1:
+            start += 1
+        busiest = max(busiest, end - start + 1)
+    return busiest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--payments', type=int, default=40)
+    parser.add_argument('--resets', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=10)
+    parser.add_argument('--fail-rate', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--processes', type=int, default=2)
+    args = parser.parse_args()
+    # A batch of 20 at --rate takes longer than the lock timeout, so undelivered claims go stale mid-batch
+    config = {'EMAIL_SEND_RATE': args.rate, 'EMAIL_RETRY_SECONDS': 0.2, 'EMAIL_POLL_SECONDS': 0.05,
+              'EMAIL_MAX_ATTEMPTS': 15, 'EMAIL_BATCH_SIZE': 20, 'EMAIL_LOCK_TIMEOUT': 2,
+              'LOGIN_IP_BURST': 10 ** 6, 'TICKET_ATTACHMENT_MODE': 'separate', 'EMAIL_TICKETS_PER_PART': 1}
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, **config})
+
+    sent_dir = tempfile.mkdtemp()
+    ticketing.mail_transport = ticketing.FakeMailTransport(sent_dir, fail_rate=args.fail_rate)
+
+    with ticketing.app.app_context():
+        instance = ticketing.TicketInstance(name='Outbox Night', capacity=1, regular_price=100)
+        users = [ticketing.User(email=f'outbox-{uuid.uuid4()}@example.com', pin_hash='x')
+                 for _ in range(max(args.payments, args.resets))]
+        db.session.add_all([instance, *users])
+        db.session.flush()
+        for user in users[:args.payments]:
+            payment = ticketing.Payment(
+                client_id=user.id, external_reference=str(uuid.uuid4()), amount=100, status='success',
+                payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular', 'quantity': 2}]))
+            db.session.add(payment)
+            db.session.flush()
+            ticketing.enqueue_fulfillment(payment)
+        db.session.commit()
+        while ticketing.process_next_fulfillment_job():
+            pass
+        emails = [user.email for user in users]
+
+    # PIN resets: queued in the request versus the old inline send through a provider taking --latency seconds
+    client = ticketing.app.test_client()
+    queued = []
+    for email in emails[:args.resets]:
+        started = time.perf_counter()
+        assert client.post('/forgot-pin', json={'email': email}).status_code == 200
+        queued.append((time.perf_counter() - started) * 1000)
+    inline = []
+    slow = ticketing.FakeMailTransport(latency=args.latency)
+    for email in emails[:5]:
+        started = time.perf_counter()
+        slow.send(email, 'Your New PIN - Dark Order', '<p>PIN</p>', [])
+        inline.append((time.perf_counter() - started) * 1000)
+
+    queued_total = sum(outbox_counts().values())
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    children = [context.Process(target=deliver, daemon=True, args=(config, sent_dir, args.fail_rate, stop))
+                for _ in range(args.processes - 1)]
+    started = time.perf_counter()
+    for child in children:
+        child.start()
+    workers = [ticketing.EmailDeliveryWorker(name=f'email-bench-{i}') for i in range(2)]
+    for worker in workers:
+        worker.start()
+    delivered = wait_for(lambda: outbox_counts().get('sent', 0) == queued_total)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.join()
+    for child in children:
+        child.join()
+    sent = load_sent(sent_dir)
+
+    with ticketing.app.app_context():
+        issued = {(user.email, ticket.id) for ticket, user in db.session.query(ticketing.Ticket, ticketing.User)
+                  .join(ticketing.User, ticketing.Ticket.client_id == ticketing.User.id)}
+        attempts = [row.attempts for row in ticketing.EmailOutbox.query.all()]
+        message_ids = sum(len((row.provider_message_id or '').split()) for row in ticketing.EmailOutbox.query.all())
+        leftover_bodies = ticketing.EmailOutbox.query.filter(ticketing.EmailOutbox.body.isnot(None)).count()
+    per_part = {}
+    for record in sent:
+        per_part[(record['to'], record['subject'])] = per_part.get((record['to'], record['subject']), 0) + 1
+    # Parts hold the same tickets on every attempt, so a resumed email neither repeats nor skips one
+    delivered_tickets = [(record['to'], attachment['filename'][len('ticket_'):-len('.pdf')])
+                         for record in sent for attachment in record['attachments']]
+
+    report = {
+        'outbox_rows': queued_total,
+        'statuses': outbox_counts(),
+        'delivered_all': delivered,
+        'delivery_s': round(elapsed, 2),
+        'processes': args.processes,
+        'messages_sent': len(sent),
+        'max_attempts_per_row': max(attempts),
+        'duplicate_deliveries': sum(count - 1 for count in per_part.values()),
+        'tickets_delivered_once': len(delivered_tickets) == len(set(delivered_tickets)) and set(delivered_tickets) == issued,
+        'provider_ids_recorded': message_ids,
+        'configured_rate': args.rate,
+        'busiest_second': busiest_second(sent),
+        'bodies_left_after_send': leftover_bodies,
+        # The request now pays for the PIN hash only; the provider round trip moved to the delivery thread
+        'forgot_pin_p50_ms': round(statistics.median(queued), 1),
+        'provider_send_p50_ms_moved_off_request': round(statistics.median(inline), 1),
+    }
+
+    # SendGridTransport: one API client for every send (network stubbed out)
+    import sendgrid
+    clients = []
+    original_init = sendgrid.SendGridAPIClient.__init__
+
+    def counting_init(self, *init_args, **init_kwargs):
+        clients.append(self)
+        original_init(self, *init_args, **init_kwargs)
+
+    sendgrid.SendGridAPIClient.__init__ = counting_init
+    sendgrid.SendGridAPIClient.send = lambda self, message: None
+    sendgrid_transport = ticketing.SendGridTransport()
+    for email in emails[:10]:
+        sendgrid_transport.send(email, 'Client reuse', '<p>hi</p>', [('a.pdf', 'application/pdf', b'%PDF-1.4')])
+    report['sendgrid_clients_for_10_sends'] = len(clients)
+
+    print(json.dumps(report, indent=2))
+    ok = delivered and report['duplicate_deliveries'] == 0 and report['tickets_delivered_once'] and leftover_bodies == 0 \
+        and message_ids == len(sent) \
+        and report['busiest_second'] <= args.rate + max(1, args.rate) and len(clients) == 1
+    print('OK: every email delivered once within the send rate' if ok else 'FAIL: outbox delivery incorrect')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Admin exports: peak memory of the streamed CSV/NDJSON export as the ticket table grows, and filter correctness.
+
+Usage:
+    python bench/exports.py [--sizes 10000,40000] [--qr-bytes 2500]
+
+Seeds tickets carrying --qr-bytes of inline base64 QR (as QR_STORAGE='inline'
+stores them), plus payments and scan logs, on a throwaway SQLite database (or
+DATABASE_URL). At each size it downloads /admin/export for tickets as CSV and
+NDJSON under tracemalloc, next to a naive export that loads every Ticket with
+.all(). The streamed peak must stay flat while the table grows. Filtered
+exports (instance, tier, date range) are checked against COUNT queries.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'exports.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+START = datetime(2025, 10, 1)
+
+
+def seed(count, offset, instance_ids, user_id, qr_bytes):
+    with ticketing.app.app_context():
+        for start in range(offset, offset + count, 5000):
+            payments = []
+            for i in range(start, min(start + 5000, offset + count), 50):
+                payments.append({'client_id': user_id, 'external_reference': str(uuid.uuid4()), 'amount': 500,
+                                 'status': 'success', 'created_at': START + timedelta(minutes=i)})
+            db.session.execute(db.insert(ticketing.Payment), payments)
+            references = [payment['external_reference'] for payment in payments]
+            payment_ids = dict(db.session.query(ticketing.Payment.external_reference, ticketing.Payment.id)
+                               .filter(ticketing.Payment.external_reference.in_(references)))
+            rows = []
+            for i in range(start, min(start + 5000, offset + count)):
+                rows.append({'id': str(uuid.uuid4()), 'client_id': user_id,
+                             'ticket_instance_id': instance_ids[i % len(instance_ids)],
+                             'tier': ('regular', 'vip')[i % 2], 'qr_code_base64': 'Q' * qr_bytes,
+                             'payment_id': payment_ids[references[(i - start) // 50]],
+                             'created_at': START + timedelta(minutes=i),
+                             'scanned_at': START + timedelta(minutes=i + 5) if i % 3 == 0 else None})
+            db.session.execute(db.insert(ticketing.Ticket), rows)
+            db.session.execute(db.insert(ticketing.ScanLog), [
+                {'ticket_id': row['id'], 'result': 'valid', 'scanned_at': row['scanned_at']}
+                for row in rows if row['scanned_at']])
+        db.session.commit()
+
+
+def streamed(admin, url):
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = admin.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+    lines, size = 0, 0
+    for chunk in response.response:
+        data = chunk.decode() if isinstance(chunk, bytes) else chunk
+        lines += data.count('\n')
+        size += len(data)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'rows': lines, 'mb': round(size / 1e6, 2), 'peak_mb': round(peak / 1e6, 2), 's': round(elapsed, 2)}
+
+
+def naive():
+    # The export without streaming: every full Ticket row (QR included) in memory before the first byte
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ticketing.app.app_context():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for ticket in ticketing.Ticket.query.all():
+            writer.writerow([ticket.id, ticket.ticket_instance_id, ticket.tier, ticket.user.email,
+                             ticket.created_at, ticket.scanned_at])
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'peak_mb': round(peak / 1e6, 2), 's': round(elapsed, 2)}
+
+
+def download(admin, url):
+    response = admin.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+    return response.get_data(as_text=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,40000')
+    parser.add_argument('--qr-bytes', type=int, default=2500)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+    instance_ids = [admin.post('/admin/create-ticket-instance', json={
+        'name': f'Export Night {i}', 'capacity': 1, 'regular_price': 500, 'vip_price': 1500
+    }).get_json()['id'] for i in range(4)]
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'export-{uuid.uuid4()}@example.com', pin_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    report, seeded = {}, 0
+    for size in sizes:
+        seed(size - seeded, seeded, instance_ids, user_id, args.qr_bytes)
+        seeded = size
+        report[size] = {
+            'csv': streamed(admin, '/admin/export?type=tickets&format=csv'),
+            'ndjson': streamed(admin, '/admin/export?type=tickets&format=ndjson'),
+            'naive_all': naive(),
+        }
+
+    # Filters against COUNT queries on the same data
+    instance_id, since, until = instance_ids[1], START + timedelta(days=2), START + timedelta(days=5)
+    query = f'instance={instance_id}&tier=vip&since={since.date()}&until={until.date()}'
+    with ticketing.app.app_context():
+        Ticket, Payment, ScanLog = ticketing.Ticket, ticketing.Payment, ticketing.ScanLog
+        expected = {
+            'tickets': Ticket.query.filter(Ticket.ticket_instance_id == instance_id, Ticket.tier == 'vip',
+                                           Ticket.created_at >= since, Ticket.created_at < until).count(),
+            'payments': Payment.query.filter(Payment.created_at >= since, Payment.created_at < until, Payment.id.in_(
+                db.session.query(Ticket.payment_id).filter(Ticket.ticket_instance_id == instance_id,
+                                                           Ticket.tier == 'vip'))).count(),
+            'scan-logs': ScanLog.query.join(Ticket, Ticket.id == ScanLog.ticket_id).filter(
+                Ticket.ticket_instance_id == instance_id, Ticket.tier == 'vip',
+                ScanLog.scanned_at >= since, ScanLog.scanned_at < until).count(),
+        }
+    filtered = {}
+    for kind, count in expected.items():
+        rows = list(csv.DictReader(StringIO(download(admin, f'/admin/export?type={kind}&format=csv&{query}'))))
+        records = [json.loads(line) for line in download(admin, f'/admin/export?type={kind}&format=ndjson&{query}').splitlines()]
+        filtered[kind] = {'expected': count, 'csv': len(rows), 'ndjson': len(records)}
+    report['filtered'] = filtered
+    report['bad_filter_status'] = admin.get('/admin/export?type=tickets&since=yesterday').status_code
+
+    print(json.dumps(report, indent=2))
+    first, last = report[sizes[0]], report[sizes[-1]]
+    flat = all(last[fmt]['peak_mb'] <= first[fmt]['peak_mb'] * 1.5 + 1 for fmt in ('csv', 'ndjson'))
+    complete = all(last[fmt]['rows'] == sizes[-1] + (1 if fmt == 'csv' else 0) for fmt in ('csv', 'ndjson'))
+    correct = all(entry['expected'] == entry['csv'] == entry['ndjson'] and entry['expected'] > 0
+                  for entry in filtered.values()) and report['bad_filter_status'] == 400
+    ok = flat and complete and correct
+    print('OK: exports stream in constant memory' if ok else
+          f'FAIL: flat memory {flat}, complete {complete}, filters correct {correct}')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
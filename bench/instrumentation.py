@@ -0,0 +1,169 @@
+"""Instrumentation: request throughput with metrics on and off, /metrics exposition and the slow-request log.
+
+Usage:
+    python bench/instrumentation.py [--tickets 50] [--rounds 5]
+
+On a throwaway SQLite database (or DATABASE_URL) it issues --tickets tickets
+through the fulfillment queue, then replays a buyer/scanner request mix
+(catalog, My Tickets, PDF download, payment status, scan) --rounds times with
+METRICS_ENABLED off and on, alternating, and reports the overhead. It checks
+that /metrics parses as Prometheus text with consistent histograms, counts
+every request and records the PDF span, that METRICS_TOKEN guards it, and
+that SLOW_REQUEST_MS logs a query breakdown.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'instrumentation.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+SAMPLE = re.compile(r'^([a-z_]+)(\{[^}]*\})? (-?[0-9.e+]+|\+Inf)$')
+
+
+class Captured(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def replay(buyer, admin, ticket_ids, reference):
+    requests = 0
+    for ticket_id in ticket_ids:
+        for response in (buyer.get('/api/instances'), buyer.get('/api/my-tickets?limit=10'),
+                         buyer.get(f'/download-ticket/{ticket_id}'), buyer.get(f'/api/payments/{reference}/status'),
+                         admin.post('/admin/verify-ticket', json={'ticket_id': ticket_id})):
+            assert response.status_code == 200, response.status_code
+            requests += 1
+    return requests
+
+
+def parse(text):
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE'):
+            _, _, name, kind = line.split()
+            types[name] = kind
+        elif not line.startswith('#'):
+            match = SAMPLE.match(line)
+            assert match, f'unparseable line: {line}'
+            samples[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return samples, types
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    # 'separate' emails render each ticket's PDF in the fulfillment job, which the PDF span check relies on
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, 'METRICS_TOKEN': None, 'TICKET_ATTACHMENT_MODE': 'separate'})
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+
+    with ticketing.app.app_context():
+        instance = ticketing.TicketInstance(name='Metrics Night', capacity=1, regular_price=100)
+        user = ticketing.User(email=f'metrics-{uuid.uuid4()}@example.com', pin_hash='x')
+        db.session.add_all([instance, user])
+        db.session.flush()
+        payment = ticketing.Payment(
+            client_id=user.id, external_reference=str(uuid.uuid4()), amount=100, status='success',
+            payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular', 'quantity': args.tickets}]))
+        db.session.add(payment)
+        db.session.flush()
+        ticketing.enqueue_fulfillment(payment)
+        db.session.commit()
+        while ticketing.process_next_fulfillment_job():
+            pass
+        ticket_ids = [row.id for row in db.session.query(ticketing.Ticket.id).filter_by(payment_id=payment.id)]
+        user_id, reference = user.id, payment.external_reference
+
+    buyer = ticketing.app.test_client()
+    with buyer.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+
+    # Warm caches, then alternate so drift on a shared machine hits both modes alike
+    ticketing.app.config['METRICS_ENABLED'] = False
+    replay(buyer, admin, ticket_ids, reference)
+    timings = {False: [], True: []}
+    counted = 0
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            ticketing.app.config['METRICS_ENABLED'] = enabled
+            started = time.perf_counter()
+            requests = replay(buyer, admin, ticket_ids, reference)
+            timings[enabled].append(requests / (time.perf_counter() - started))
+            counted += requests if enabled else 0
+    off, on = max(timings[False]), max(timings[True])
+    report = {'requests_per_round': requests, 'rounds': args.rounds,
+              'metrics_off_req_per_sec': round(off, 1), 'metrics_on_req_per_sec': round(on, 1),
+              'overhead_pct': round((off - on) / off * 100, 1)}
+
+    text = admin.get('/metrics').get_data(as_text=True)
+    samples, types = parse(text)
+    requests_total = sum(value for (name, _), value in samples.items() if name == 'ticketing_http_requests_total')
+    histograms_ok = True
+    for (name, labels), count in samples.items():
+        if not name.endswith('_count'):
+            continue
+        base = name[:-len('_count')]
+        buckets = [value for (sample, sample_labels), value in samples.items() if sample == base + '_bucket'
+                   and sample_labels.startswith(labels[:-1])
+                   and sample_labels.count('=') == labels.count('=') + 1]
+        histograms_ok &= bool(buckets) and max(buckets) == count
+    pdf_spans = samples.get(('ticketing_span_duration_seconds_count', '{span="generate_pdf_ticket"}'), 0)
+    report['metrics'] = {
+        'lines': len(text.splitlines()),
+        'types': sorted(set(types.values())),
+        'requests_counted': requests_total,
+        'requests_made_with_metrics_on': counted,
+        'generate_pdf_ticket_spans': pdf_spans,
+        'histograms_consistent': histograms_ok,
+    }
+
+    # Token instead of an admin session for scrapers
+    ticketing.app.config['METRICS_TOKEN'] = 'scrape-token'
+    anonymous = ticketing.app.test_client()
+    report['auth'] = {
+        'no_token': anonymous.get('/metrics').status_code,
+        'wrong_token': anonymous.get('/metrics', headers={'Authorization': 'Bearer nope'}).status_code,
+        'token': anonymous.get('/metrics', headers={'Authorization': 'Bearer scrape-token'}).status_code,
+    }
+
+    captured = Captured()
+    ticketing.logger.addHandler(captured)
+    ticketing.app.config['SLOW_REQUEST_MS'] = 0
+    buyer.get('/api/my-tickets?limit=10')
+    ticketing.logger.removeHandler(captured)
+    slow = [message for message in captured.messages if message.startswith('Slow request')]
+    report['slow_log'] = slow[0][:300] if slow else None
+
+    print(json.dumps(report, indent=2))
+    # The counter includes the requests made since metrics were switched on, plus the /metrics scrape itself
+    ok = requests_total >= counted and histograms_ok and pdf_spans >= args.tickets \
+        and report['auth'] == {'no_token': 401, 'wrong_token': 401, 'token': 200} \
+        and bool(slow) and 'queries' in slow[0] and 'SELECT' in slow[0] and report['overhead_pct'] < 25
+    print('OK: metrics exposed with low overhead' if ok else 'FAIL: instrumentation incorrect or too slow')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
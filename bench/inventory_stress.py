@@ -0,0 +1,143 @@
+"""Stress the checkout inventory: many buyers racing for one ticket instance must never oversell.
+
+Usage:
+    python bench/inventory_stress.py [--stock 100] [--buyers 40] [--attempts 5]
+
+Each buyer thread signs in and repeatedly POSTs /purchase for 1-3 tickets
+against a throwaway SQLite database (or DATABASE_URL), with the PayHero STK
+push replaced by an immediate 201. Payments are then settled with a mix of
+success callbacks, failure callbacks and expired holds, and the inventory
+counters are checked against the reservation ledger and the issued tickets.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'inventory_stress.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+os.environ['PAYHERO_PUSH_MODE'] = 'sync'
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+
+import app as ticketing  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stock', type=int, default=100)
+    parser.add_argument('--buyers', type=int, default=40)
+    parser.add_argument('--attempts', type=int, default=5)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    ticketing.payhero_client.stk_push = lambda payload: (201, {'success': True, 'status': 'QUEUED'})
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+    instance_id = admin.post('/admin/create-ticket-instance', json={
+        'name': 'Stress Night', 'capacity': 1, 'regular_price': 100, 'regular_stock': args.stock
+    }).get_json()['id']
+
+    with ticketing.app.app_context():
+        users = [ticketing.User(email=f'buyer-{uuid.uuid4()}@example.com', pin_hash='x') for _ in range(args.buyers)]
+        ticketing.db.session.add_all(users)
+        ticketing.db.session.commit()
+        user_ids = [user.id for user in users]
+
+    outcomes = {'reserved': 0, 'sold_out': 0, 'errors': 0}
+    references = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.buyers)
+
+    def buyer(user_id):
+        client = ticketing.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        barrier.wait()
+        for _ in range(args.attempts):
+            quantity = random.randint(1, 3)
+            response = client.post('/purchase', json={
+                'phoneNumber': '254700000000',
+                'cart': [{'instance_id': instance_id, 'tier': 'regular', 'quantity': quantity}]
+            })
+            with lock:
+                if response.status_code == 200:
+                    outcomes['reserved'] += 1
+                    references.append(response.get_json()['reference'])
+                elif response.status_code == 409:
+                    outcomes['sold_out'] += 1
+                else:
+                    outcomes['errors'] += 1
+
+    threads = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with ticketing.app.app_context():
+        peak = ticketing.Inventory.query.filter_by(ticket_instance_id=instance_id, tier='regular').one().reserved
+    assert peak <= args.stock, f'held {peak} tickets against stock {args.stock}'
+
+    # Settle: most pay, some decline, the rest never answer and their holds expire
+    random.shuffle(references)
+    callback = ticketing.app.test_client()
+    for index, reference in enumerate(references):
+        roll = index % 10
+        if roll < 7:
+            body = {'ResultCode': 0, 'Status': 'Success'}
+        elif roll < 9:
+            body = {'ResultCode': 1032, 'Status': 'Cancelled'}
+        else:
+            continue
+        callback.post('/api/payhero/callback', json={'response': {
+            'CheckoutRequestID': f'ws_CO_{reference}', 'ExternalReference': reference, **body
+        }})
+
+    with ticketing.app.app_context():
+        ticketing.Reservation.query.filter_by(status='held').update(
+            {'expires_at': datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+        ticketing.db.session.commit()
+        ticketing.release_expired_reservations()
+        while ticketing.process_next_fulfillment_job():
+            pass
+
+        row = ticketing.Inventory.query.filter_by(ticket_instance_id=instance_id, tier='regular').one()
+        confirmed = ticketing.db.session.query(ticketing.db.func.coalesce(ticketing.db.func.sum(ticketing.Reservation.quantity), 0)) \
+            .filter_by(ticket_instance_id=instance_id, status='confirmed').scalar()
+        held = ticketing.db.session.query(ticketing.db.func.coalesce(ticketing.db.func.sum(ticketing.Reservation.quantity), 0)) \
+            .filter_by(ticket_instance_id=instance_id, status='held').scalar()
+        tickets = ticketing.Ticket.query.filter_by(ticket_instance_id=instance_id).count()
+
+    report = {
+        'stock': args.stock,
+        'purchase_attempts': args.buyers * args.attempts,
+        **outcomes,
+        'held_at_peak': peak,
+        'sold': row.sold,
+        'reserved_after_settle': row.reserved,
+        'confirmed_in_ledger': confirmed,
+        'held_in_ledger': held,
+        'tickets_issued': tickets,
+    }
+    print(json.dumps(report, indent=2))
+
+    assert row.sold <= args.stock, 'oversold'
+    assert row.sold == confirmed == tickets, 'sold counter disagrees with ledger or tickets'
+    assert row.reserved == held == 0, 'holds leaked'
+    print('OK: no oversell')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""Sale-night load test: buyers and door scanners against the app over HTTP, with PayHero and SendGrid stubbed.
+
+Usage:
+    python bench/load_test.py [--buyers 10] [--scanners 2] [--duration 30] [--payhero-latency 0.8]
+                              [--sendgrid-latency 0.1] [--think 0.5] [--output baseline.json]
+                              [--baseline baseline.json] [--tolerance 0.25]
+
+Runs the app on a local threaded server against a throwaway SQLite database
+(or DATABASE_URL, e.g. a local Postgres), with bench/payhero_stub.py and
+bench/sendgrid_stub.py standing in for the providers. Fulfillment and email
+delivery threads run as configured (FULFILLMENT_WORKERS, default 2).
+
+Each buyer signs in once, then loops for --duration seconds: ticket page,
+catalog, /purchase, status polling until the stub's callback has been
+fulfilled, /api/my-tickets and /download-ticket. Each scanner signs in as
+admin and verifies the tickets buyers received, rescanning some and trying
+unknown IDs. The report has throughput, p50/p95/p99 latency and SQL queries
+per request for every route, purchase-to-ticket times and stub counters.
+
+--output writes the report as a baseline; --baseline compares against one and
+exits non-zero when a route's p95 grows by more than --tolerance (and 20ms)
+or it issues more queries per request.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load_test.db')
+os.environ.setdefault('FULFILLMENT_WORKERS', '2')
+os.environ['ARTIFACT_DIR'] = tempfile.mkdtemp()
+os.environ['EMAIL_TRANSPORT'] = 'sendgrid'
+os.environ['SENDGRID_API_KEY'] = 'SG.stub'
+os.environ.setdefault('EMAIL_ADDRESS', 'tickets@example.com')
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+os.environ['ADMIN_PASSWORD'] = ADMIN_PIN = '9876'
+
+import requests  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import app as ticketing  # noqa: E402
+from payhero_stub import PayHeroStub  # noqa: E402
+from sendgrid_stub import SendGridStub  # noqa: E402
+
+db = ticketing.db
+PIN = '2468'
+
+
+class RouteStats:
+    """Client-side latencies and server-side SQL counts, keyed by 'METHOD /rule'."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.queries = {}
+        self.local = threading.local()
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def install(self, flask_app, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            if getattr(self.local, 'queries', None) is not None:
+                self.local.queries += 1
+
+        @flask_app.before_request
+        def start_counting():
+            self.local.queries = 0
+
+        @flask_app.teardown_request
+        def stop_counting(exc):
+            from flask import request
+            count, self.local.queries = self.local.queries, None
+            if count is None or request.url_rule is None:
+                return
+            with self.lock:
+                self.queries.setdefault(f'{request.method} {request.url_rule.rule}', []).append(count)
+
+    def report(self, wall):
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            queries = self.queries.get(route, [])
+            routes[route] = {
+                'requests': len(values),
+                'errors': self.errors.get(route, 0),
+                'per_sec': round(len(values) / wall, 2),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+                'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+                'queries_max': max(queries) if queries else None,
+            }
+        return routes
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class VirtualUser:
+    def __init__(self, base_url, stats, address):
+        self.base_url = base_url
+        self.stats = stats
+        self.http = requests.Session()
+        self.http.headers['X-Forwarded-For'] = address
+
+    def call(self, method, rule, path, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        response = self.http.request(method, self.base_url + path, timeout=60, **kwargs)
+        self.stats.record(f'{method} {rule}', time.perf_counter() - started, response.status_code in expect)
+        return response
+
+
+def buyer(user, email, instance_ids, stop, think, issued, flows):
+    user.call('POST', '/signin', '/signin', json={'email': email, 'pin': PIN})
+    while not stop.is_set():
+        user.call('GET', '/tickets', '/tickets')
+        user.call('GET', '/api/instances', '/api/instances')
+        quantity = random.randint(1, 2)
+        started = time.perf_counter()
+        response = user.call('POST', '/purchase', '/purchase', json={
+            'phoneNumber': '254700000000',
+            'cart': [{'instance_id': random.choice(instance_ids), 'tier': random.choice(['regular', 'vip']),
+                      'quantity': quantity}]})
+        data = response.json()
+        if not data.get('success'):
+            flows.put(('failed', None))
+            continue
+
+        status = {}
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            status = user.call('GET', '/api/payments/<reference>/status',
+                               f"/api/payments/{data['reference']}/status").json()
+            if status.get('payment_status') == 'failed' or status.get('tickets_issued') == quantity:
+                break
+            time.sleep(0.25)
+        if status.get('tickets_issued') != quantity:
+            flows.put(('failed', None))
+            continue
+        flows.put(('completed', time.perf_counter() - started))
+
+        tickets = user.call('GET', '/api/my-tickets', '/api/my-tickets?limit=10').json()['tickets']
+        for ticket in tickets[:quantity]:
+            user.call('GET', '/download-ticket/<ticket_id>', f"/download-ticket/{ticket['id']}")
+            issued.put(ticket['id'])
+        stop.wait(think)
+
+
+def scanner(user, stop, issued, scans):
+    user.call('POST', '/admin/login', '/admin/login', json={'pin': ADMIN_PIN})
+    scanned = []
+    while not stop.is_set():
+        roll = random.random()
+        if roll < 0.1 and scanned:
+            ticket_id = random.choice(scanned)
+        elif roll < 0.15:
+            ticket_id = str(uuid.uuid4())
+        else:
+            try:
+                ticket_id = issued.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            scanned.append(ticket_id)
+        result = user.call('POST', '/admin/verify-ticket', '/admin/verify-ticket', json={'ticket_id': ticket_id}).json()
+        scans.put(result.get('status'))
+
+
+def drain(items):
+    values = []
+    while True:
+        try:
+            values.append(items.get_nowait())
+        except queue.Empty:
+            return values
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for route, before in baseline.get('routes', {}).items():
+        after = report['routes'].get(route)
+        if not after:
+            continue
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance) and after['p95_ms'] - before['p95_ms'] > 20:
+            regressions.append(f"{route}: p95 {before['p95_ms']}ms -> {after['p95_ms']}ms")
+        if before['queries_mean'] is not None and after['queries_mean'] is not None \
+                and after['queries_mean'] > before['queries_mean'] + 0.5:
+            regressions.append(f"{route}: queries {before['queries_mean']} -> {after['queries_mean']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=10)
+    parser.add_argument('--scanners', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--payhero-latency', type=float, default=0.8)
+    parser.add_argument('--sendgrid-latency', type=float, default=0.1)
+    parser.add_argument('--think', type=float, default=0.5)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    stats = RouteStats()
+    with ticketing.app.app_context():
+        stats.install(ticketing.app, db.engine)
+
+    server = make_server('127.0.0.1', 0, ticketing.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    os.environ['REPLIT_DEV_DOMAIN'] = base_url
+    payhero = PayHeroStub(('127.0.0.1', 0), latency=args.payhero_latency, callback_delay=0.5).start()
+    sendgrid = SendGridStub(('127.0.0.1', 0), latency=args.sendgrid_latency).start()
+    ticketing.app.config['PAYHERO_BASE_URL'] = payhero.base_url
+    ticketing.app.config['SENDGRID_API_HOST'] = sendgrid.base_url
+
+    admin = VirtualUser(base_url, RouteStats(), '10.9.0.1')
+    admin.call('POST', '/admin/login', '/admin/login', json={'pin': ADMIN_PIN})
+    instance_ids = [admin.call('POST', '/admin/create-ticket-instance', '/admin/create-ticket-instance', json={
+        'name': f'Sale Night {i}', 'capacity': 1, 'regular_price': 1000, 'vip_price': 2500
+    }).json()['id'] for i in range(3)]
+    pin_hash = generate_password_hash(PIN, ticketing.app.config['PIN_HASH_METHOD'])
+    with ticketing.app.app_context():
+        buyers = [ticketing.User(email=f'buyer-{uuid.uuid4()}@example.com', pin_hash=pin_hash)
+                  for _ in range(args.buyers)]
+        db.session.add_all(buyers)
+        db.session.commit()
+        emails = [user.email for user in buyers]
+
+    stop = threading.Event()
+    issued, flows, scans = queue.Queue(), queue.Queue(), queue.Queue()
+    threads = [threading.Thread(target=buyer, args=(VirtualUser(base_url, stats, f'10.1.{i // 250}.{i % 250 + 1}'),
+                                                   email, instance_ids, stop, args.think, issued, flows))
+               for i, email in enumerate(emails)]
+    threads += [threading.Thread(target=scanner, args=(VirtualUser(base_url, stats, f'10.2.0.{i + 1}'),
+                                                      stop, issued, scans))
+                for i in range(args.scanners)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    outcomes = drain(flows)
+    completed = sorted(seconds for outcome, seconds in outcomes if outcome == 'completed')
+    scan_results = {}
+    for status in drain(scans):
+        scan_results[status] = scan_results.get(status, 0) + 1
+    with ticketing.app.app_context():
+        emails_queued = ticketing.EmailOutbox.query.filter_by(kind='tickets').count()
+        dialect = db.engine.dialect.name
+    ticketing.stop_fulfillment_workers()
+    server.shutdown()
+
+    report = {
+        'config': {
+            'database': dialect,
+            'buyers': args.buyers, 'scanners': args.scanners, 'duration_s': args.duration,
+            'payhero_latency_s': args.payhero_latency, 'sendgrid_latency_s': args.sendgrid_latency,
+            'push_mode': ticketing.app.config['PAYHERO_PUSH_MODE'],
+            'fulfillment_workers': ticketing.app.config['FULFILLMENT_WORKERS'],
+        },
+        'wall_s': round(wall, 2),
+        'routes': stats.report(wall),
+        'purchases': {
+            'completed': len(completed),
+            'failed': len(outcomes) - len(completed),
+            'per_sec': round(len(completed) / wall, 2),
+            'to_tickets_p50_ms': round(percentile(completed, 0.50) * 1000, 1) if completed else None,
+            'to_tickets_p95_ms': round(percentile(completed, 0.95) * 1000, 1) if completed else None,
+        },
+        'scans': scan_results,
+        'payhero_stub': payhero.stats,
+        'sendgrid_stub': {**sendgrid.stats, 'ticket_emails_queued': emails_queued},
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(report, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+    errors = sum(route['errors'] for route in report['routes'].values())
+    ok = completed and not regressions and errors == 0 and report['purchases']['failed'] == 0
+    print('OK: load test completed' if ok else
+          f'FAIL: {errors} request errors, {report["purchases"]["failed"]} failed purchases, '
+          f'{len(regressions)} regressions')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
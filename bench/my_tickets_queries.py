@@ -0,0 +1,125 @@
+"""SQL statements and latency for My Tickets as a buyer's ticket count grows.
+
+Usage:
+    python bench/my_tickets_queries.py [--counts 1,25,500] [--instances 25]
+
+Seeds one buyer per count on a throwaway SQLite database (or DATABASE_URL),
+with tickets spread over --instances events and inline QR images stored as in
+QR_STORAGE='inline'. Each buyer's first page of /my-tickets and
+/api/my-tickets, and the last page reached by following the cursor, must run
+the same number of statements whatever the ticket count. The legacy listing
+(every Ticket row, instance loaded lazily per row) is timed for comparison.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'my_tickets.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+from flask import render_template_string  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+statements = threading.local()
+
+
+def count_statement(*args):
+    statements.count = getattr(statements, 'count', 0) + 1
+
+
+def measure(send):
+    statements.count = 0
+    started = time.perf_counter()
+    response = send()
+    assert response.status_code == 200, response.status_code
+    return response, statements.count, round((time.perf_counter() - started) * 1000, 2)
+
+
+def legacy_my_tickets(client_id):
+    # The listing as it was before pagination: every full row, instance loaded lazily in the template
+    tickets = ticketing.Ticket.query.filter_by(client_id=client_id).order_by(ticketing.Ticket.created_at.desc()).all()
+    return render_template_string(
+        '{% for ticket in tickets %}{{ ticket.ticket_instance.name }} {{ ticket.ticket_instance.capacity }} '
+        '{{ ticket.tier }} {{ ticket.id }}\n{% endfor %}', tickets=tickets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', default='1,25,500')
+    parser.add_argument('--instances', type=int, default=25)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+    counts = [int(count) for count in args.counts.split(',')]
+
+    with ticketing.app.app_context():
+        instances = [ticketing.TicketInstance(name=f'Night {i}', capacity=1, regular_price=100)
+                     for i in range(args.instances)]
+        ticketing.db.session.add_all(instances)
+        ticketing.db.session.flush()
+        buyers = {}
+        for count in counts:
+            user = ticketing.User(email=f'buyer-{uuid.uuid4()}@example.com', pin_hash='x')
+            ticketing.db.session.add(user)
+            ticketing.db.session.flush()
+            for i in range(count):
+                instance = instances[i % len(instances)]
+                ticket_id = str(uuid.uuid4())
+                qr_base64, qr_url = ticketing.generate_qr_code(ticket_id, instance.id, 'regular')
+                ticketing.db.session.add(ticketing.Ticket(
+                    id=ticket_id, client_id=user.id, ticket_instance_id=instance.id, tier='regular',
+                    qr_code_url=qr_url, qr_code_base64=qr_base64
+                ))
+            buyers[count] = user.id
+        ticketing.db.session.commit()
+        event.listen(ticketing.db.engine, 'before_cursor_execute', count_statement)
+
+    report = {}
+    for count, user_id in buyers.items():
+        client = ticketing.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+
+        _, page_statements, page_ms = measure(lambda: client.get('/my-tickets'))
+        response, api_statements, api_ms = measure(lambda: client.get('/api/my-tickets'))
+        cursor, pages, last_statements = response.get_json()['next'], 1, api_statements
+        seen = len(response.get_json()['tickets'])
+        while cursor:
+            response, last_statements, _ = measure(lambda: client.get(f'/api/my-tickets?before={cursor}'))
+            cursor, pages = response.get_json()['next'], pages + 1
+            seen += len(response.get_json()['tickets'])
+        assert seen == count, (seen, count)
+
+        with ticketing.app.test_request_context():
+            ticketing.db.session.expunge_all()
+            statements.count = 0
+            started = time.perf_counter()
+            legacy_my_tickets(user_id)
+            legacy = {'statements': statements.count, 'ms': round((time.perf_counter() - started) * 1000, 2)}
+
+        report[count] = {
+            'page': {'statements': page_statements, 'ms': page_ms},
+            'api': {'statements': api_statements, 'ms': api_ms},
+            'api_last_page_statements': last_statements,
+            'pages': pages,
+            'legacy_all_rows': legacy
+        }
+
+    print(json.dumps(report, indent=2))
+    distinct = {(entry['page']['statements'], entry['api']['statements'], entry['api_last_page_statements'])
+                for entry in report.values()}
+    print('OK: constant query count' if len(distinct) == 1 else f'FAIL: query count varies {sorted(distinct)}')
+    sys.exit(0 if len(distinct) == 1 else 1)
+
+
+if __name__ == '__main__':
+    main()
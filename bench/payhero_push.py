@@ -0,0 +1,163 @@
+"""/purchase latency with the STK push inline versus queued, and callback-less reconciliation.
+
+Usage:
+    python bench/payhero_push.py [--buyers 20] [--purchases 5] [--latency 0.8]
+
+Runs the app against bench/payhero_stub.py on a throwaway SQLite database
+(or DATABASE_URL). Buyers POST /purchase concurrently in PAYHERO_PUSH_MODE
+'sync' and then 'async'; the stub answers after --latency seconds and sends
+success callbacks back to the app. A final phase drops every callback and
+settles the pending payments through reconcile_pending_payments() instead.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'payhero_push.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+
+from werkzeug.serving import make_server  # noqa: E402
+
+import app as ticketing  # noqa: E402
+from payhero_stub import PayHeroStub  # noqa: E402
+
+
+def wait_for(predicate, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def payment_counts(references):
+    with ticketing.app.app_context():
+        payments = ticketing.Payment.query.filter(ticketing.Payment.external_reference.in_(references)).all()
+        counts = {}
+        for payment in payments:
+            counts[payment.status] = counts.get(payment.status, 0) + 1
+        return counts
+
+
+def pushed(references):
+    with ticketing.app.app_context():
+        return ticketing.Payment.query.filter(
+            ticketing.Payment.external_reference.in_(references),
+            ticketing.Payment.provider_reference.isnot(None)
+        ).count()
+
+
+def run_phase(mode, user_ids, instance_id, purchases):
+    ticketing.app.config['PAYHERO_PUSH_MODE'] = mode
+    latencies = []
+    references = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(user_ids))
+
+    def buyer(user_id):
+        client = ticketing.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        barrier.wait()
+        for _ in range(purchases):
+            started = time.perf_counter()
+            response = client.post('/purchase', json={
+                'phoneNumber': '254700000000',
+                'cart': [{'instance_id': instance_id, 'tier': 'regular', 'quantity': 1}]
+            })
+            elapsed = time.perf_counter() - started
+            data = response.get_json()
+            with lock:
+                latencies.append(elapsed)
+                if data.get('success'):
+                    references.append(data['reference'])
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return references, {
+        'purchases': len(latencies),
+        'accepted': len(references),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        'purchases_per_sec': round(len(latencies) / wall, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=20)
+    parser.add_argument('--purchases', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.8)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+
+    server = make_server('127.0.0.1', 0, ticketing.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['REPLIT_DEV_DOMAIN'] = f'http://127.0.0.1:{server.server_port}'
+
+    stub = PayHeroStub(('127.0.0.1', 0), latency=args.latency, callback_delay=0.2).start()
+    ticketing.app.config['PAYHERO_BASE_URL'] = stub.base_url
+
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+    instance_id = admin.post('/admin/create-ticket-instance', json={
+        'name': 'Push Night', 'capacity': 1, 'regular_price': 100
+    }).get_json()['id']
+
+    with ticketing.app.app_context():
+        users = [ticketing.User(email=f'buyer-{uuid.uuid4()}@example.com', pin_hash='x') for _ in range(args.buyers)]
+        ticketing.db.session.add_all(users)
+        ticketing.db.session.commit()
+        user_ids = [user.id for user in users]
+
+    report = {'stub_latency_ms': args.latency * 1000}
+    for mode in ('sync', 'async'):
+        references, report[mode] = run_phase(mode, user_ids, instance_id, args.purchases)
+        settled = wait_for(lambda: payment_counts(references).get('success', 0) == len(references))
+        report[mode]['settled_by_callback'] = settled
+
+    # No callbacks at all: the reconciliation sweep has to settle every payment
+    stub.callback_delay = None
+    references, report['reconcile'] = run_phase('async', user_ids, instance_id, 1)
+    wait_for(lambda: pushed(references) == len(references))
+    ticketing.app.config['PAYHERO_RECONCILE_AFTER'] = 0
+    with ticketing.app.app_context():
+        started = time.perf_counter()
+        report['reconcile']['reconciled'] = ticketing.reconcile_pending_payments()
+        report['reconcile']['reconcile_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    report['reconcile']['statuses'] = payment_counts(references)
+    report['stub'] = stub.stats
+
+    server.shutdown()
+    stub.shutdown()
+    print(json.dumps(report, indent=2))
+
+    ok = all(report[mode]['settled_by_callback'] for mode in ('sync', 'async')) \
+        and report['reconcile']['statuses'] == {'success': len(references)}
+    print('OK: every payment settled' if ok else 'FAIL: unsettled payments')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Local stand-in for the PayHero API, for benchmarks and load tests.
+
+Usage:
+    python bench/payhero_stub.py [--port 8099] [--latency 0.8] [--fail-rate 0]
+                                 [--callback-delay 1] [--drop-callbacks 0]
+
+POST /api/v2/payments answers 201 with a PayHero-style reference after
+--latency seconds (or 500 for --fail-rate of requests) and, unless the
+callback is dropped, POSTs a success callback to the payload's callback_url
+--callback-delay seconds later. GET /api/v2/transaction-status?reference=
+reports SUCCESS for every reference the stub has accepted.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class PayHeroStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0, callback_delay=None, drop_callbacks=0.0):
+        super().__init__(address, PayHeroHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.callback_delay = callback_delay
+        self.drop_callbacks = drop_callbacks
+        self.accepted = {}
+        self.lock = threading.Lock()
+        self.stats = {'pushes': 0, 'failed_pushes': 0, 'callbacks': 0, 'status_checks': 0}
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def send_callback(self, payload, reference):
+        time.sleep(self.callback_delay)
+        body = json.dumps({'response': {
+            'ExternalReference': payload['external_reference'],
+            'CheckoutRequestID': reference,
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'Status': 'Success',
+            'Amount': payload['amount']
+        }}).encode()
+        request = urllib.request.Request(payload['callback_url'], data=body,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request, timeout=10).read()
+            with self.lock:
+                self.stats['callbacks'] += 1
+        except Exception:
+            pass
+
+
+class PayHeroHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if urlparse(self.path).path != '/api/v2/payments':
+            return self.reply(404, {'error': 'not found'})
+        time.sleep(server.latency)
+        if random.random() < server.fail_rate:
+            with server.lock:
+                server.stats['failed_pushes'] += 1
+            return self.reply(500, {'success': False, 'message': 'Upstream M-Pesa error'})
+
+        reference = f'stub-{uuid.uuid4()}'
+        with server.lock:
+            server.stats['pushes'] += 1
+            server.accepted[reference] = payload
+        if server.callback_delay is not None and random.random() >= server.drop_callbacks:
+            threading.Thread(target=server.send_callback, args=(payload, reference), daemon=True).start()
+        self.reply(201, {'success': True, 'status': 'QUEUED', 'reference': reference,
+                         'CheckoutRequestID': reference})
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path != '/api/v2/transaction-status':
+            return self.reply(404, {'error': 'not found'})
+        reference = parse_qs(url.query).get('reference', [''])[0]
+        with server.lock:
+            server.stats['status_checks'] += 1
+            known = reference in server.accepted
+        if not known:
+            return self.reply(404, {'success': False, 'status': 'NOT_FOUND'})
+        self.reply(200, {'success': True, 'status': 'SUCCESS', 'reference': reference})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.8)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--callback-delay', type=float, default=None)
+    parser.add_argument('--drop-callbacks', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = PayHeroStub((args.host, args.port), args.latency, args.fail_rate,
+                       args.callback_delay, args.drop_callbacks)
+    print(f'PayHero stub listening on {stub.base_url}')
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Benchmark PDF ticket rendering: the original per-ticket renderer versus the template renderer.
+
+Usage:
+    python bench/pdf_render.py [--tickets 100]
+
+Runs against a throwaway SQLite database and reports tickets/sec for:
+  legacy          original generate_pdf_ticket (full redraw, QR regenerated every time)
+  template_cold   generate_pdf_ticket with the QR cache cleared before each ticket
+  template_warm   generate_pdf_ticket reusing cached QR images
+  template_batch  every ticket as a page of one document sharing a single form XObject
+
+It also reports the time spent drawing the instance background into a fresh
+document. Every single-ticket PDF pays this, since a form XObject cannot be
+shared across documents, so only batch renders gain from sharing it. Rates
+vary from run to run and machine to machine, so compare within one run.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'pdf_render.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+import qrcode  # noqa: E402
+from reportlab.lib.pagesizes import letter  # noqa: E402
+from reportlab.lib.units import inch  # noqa: E402
+from reportlab.lib.utils import ImageReader  # noqa: E402
+from reportlab.pdfgen import canvas  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+
+def legacy_generate_pdf_ticket(ticket, user_email):
+    # Copy of the renderer before template caching, kept as the benchmark baseline
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    width, height = letter
+    c.setFillColorRGB(0.1, 0, 0)
+    c.rect(0, 0, width, height, fill=True)
+    c.setFillColorRGB(0.8, 0, 0)
+    c.rect(0.5*inch, height - 2*inch, width - 1*inch, 1.5*inch, fill=True)
+    c.setFillColorRGB(1, 1, 1)
+    c.setFont("Helvetica-Bold", 36)
+    c.drawCentredString(width/2, height - 1.2*inch, "THE DARK ORDER")
+    c.setFont("Helvetica-Bold", 24)
+    c.drawCentredString(width/2, height - 1.6*inch, "HALLOWEEN PLAY & PARTY")
+    c.setFillColorRGB(0.9, 0.9, 0.9)
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(1*inch, height - 3*inch, f"Ticket Instance: {ticket.ticket_instance.name}")
+    c.drawString(1*inch, height - 3.5*inch, f"Tier: {ticket.tier.upper()}")
+    capacity_text = f"Covers: {ticket.ticket_instance.capacity} {'person' if ticket.ticket_instance.capacity == 1 else 'people'}"
+    c.drawString(1*inch, height - 4*inch, capacity_text)
+    c.drawString(1*inch, height - 4.5*inch, f"Ticket ID: {ticket.id}")
+    c.drawString(1*inch, height - 5*inch, f"Email: {user_email}")
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(ticketing.ticket_verify_url(ticket.id, ticket.ticket_instance_id, ticket.tier))
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    qr_buffer = BytesIO()
+    img.save(qr_buffer, format='PNG')
+    qr_data = base64.b64encode(qr_buffer.getvalue()).decode()
+    qr_image = ImageReader(BytesIO(base64.b64decode(qr_data)))
+    c.drawImage(qr_image, width/2 - 1.5*inch, height - 8.5*inch, width=3*inch, height=3*inch)
+    c.setFillColorRGB(0.8, 0, 0)
+    c.setFont("Helvetica-Bold", 14)
+    c.drawCentredString(width/2, height - 9*inch, "SCAN QR CODE AT ENTRANCE")
+    c.setFillColorRGB(0.6, 0.6, 0.6)
+    c.setFont("Helvetica", 10)
+    c.drawCentredString(width/2, 1*inch, f"Generated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+
+def rate(count, seconds):
+    return round(count / seconds, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=100)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+    email = 'bench@example.com'
+
+    with ticketing.app.app_context():
+        user = ticketing.User(email=email, pin_hash='x')
+        instance = ticketing.TicketInstance(name='Bench Night', capacity=2, regular_price=100)
+        ticketing.db.session.add_all([user, instance])
+        ticketing.db.session.commit()
+        for _ in range(args.tickets):
+            ticketing.db.session.add(ticketing.Ticket(
+                id=str(uuid.uuid4()), client_id=user.id, ticket_instance_id=instance.id, tier='vip'
+            ))
+        ticketing.db.session.commit()
+        tickets = ticketing.Ticket.query.all()
+        for ticket in tickets:
+            ticket.ticket_instance
+
+        results = {'tickets': args.tickets}
+
+        started = time.perf_counter()
+        for ticket in tickets:
+            legacy_generate_pdf_ticket(ticket, email).getvalue()
+        results['legacy_tickets_per_sec'] = rate(args.tickets, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for ticket in tickets:
+            ticketing.qr_matrix.cache_clear()
+            ticketing.generate_pdf_ticket(ticket, email).getvalue()
+        results['template_cold_tickets_per_sec'] = rate(args.tickets, time.perf_counter() - started)
+
+        for ticket in tickets:
+            ticketing.ticket_qr_matrix(ticket)
+        started = time.perf_counter()
+        for ticket in tickets:
+            ticketing.generate_pdf_ticket(ticket, email).getvalue()
+        results['template_warm_tickets_per_sec'] = rate(args.tickets, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        buffer = BytesIO()
+        c = canvas.Canvas(buffer, pagesize=letter)
+        templates = set()
+        for ticket in tickets:
+            ticketing.draw_ticket_page(c, ticket, email, templates, 'bench')
+        c.save()
+        results['template_batch_tickets_per_sec'] = rate(args.tickets, time.perf_counter() - started)
+
+        # What a single-ticket PDF spends on the shared background, against its whole render
+        started = time.perf_counter()
+        for ticket in tickets:
+            ticketing.draw_ticket_template(canvas.Canvas(BytesIO(), pagesize=letter), ticket.ticket_instance)
+        background = time.perf_counter() - started
+        results['background_ms_per_document'] = round(background / args.tickets * 1000, 2)
+        results['background_share_of_single_ticket'] = round(
+            background / args.tickets * results['template_warm_tickets_per_sec'], 3)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
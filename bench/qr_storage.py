@@ -0,0 +1,87 @@
+"""Compare ticket row size and /my-tickets page size for the two QR storage modes.
+
+Usage:
+    python bench/qr_storage.py [--tickets 50]
+
+Issues the same cart under QR_STORAGE=inline and QR_STORAGE=on_demand against a
+throwaway SQLite database and reports stored bytes per ticket and the
+/my-tickets HTML size, alongside what the page weighed when it inlined every QR
+as a base64 data URI.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'qr_storage.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+import app as ticketing  # noqa: E402
+
+
+def measure(mode, quantity):
+    ticketing.app.config['QR_STORAGE'] = mode
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'qr-{mode}@example.com', pin_hash='x')
+        instance = ticketing.TicketInstance(name=f'QR {mode}', capacity=1, regular_price=100)
+        ticketing.db.session.add_all([user, instance])
+        ticketing.db.session.commit()
+        payment = ticketing.Payment(
+            client_id=user.id,
+            external_reference=f'qr-{mode}',
+            amount=100 * quantity,
+            status='success',
+            payment_metadata=json.dumps([{'instance_id': instance.id, 'tier': 'regular', 'quantity': quantity}])
+        )
+        ticketing.db.session.add(payment)
+        ticketing.db.session.commit()
+
+        ticketing.render_qr_png.cache_clear()
+        started = time.perf_counter()
+        ticketing.issue_tickets_for_payment(payment)
+        ticketing.db.session.commit()
+        issue_seconds = time.perf_counter() - started
+
+        row_bytes = ticketing.db.session.query(ticketing.db.func.avg(
+            ticketing.db.func.length(ticketing.Ticket.id) +
+            ticketing.db.func.coalesce(ticketing.db.func.length(ticketing.Ticket.qr_code_url), 0) +
+            ticketing.db.func.coalesce(ticketing.db.func.length(ticketing.Ticket.qr_code_base64), 0) +
+            ticketing.db.func.length(ticketing.Ticket.tier)
+        )).filter(ticketing.Ticket.payment_id == payment.id).scalar()
+        # What the old template added to the page by inlining each QR as a data URI
+        legacy_inline_bytes = sum(
+            len('data:image/png;base64,') + len(ticketing.generate_qr_code(ticket.id, ticket.ticket_instance_id, ticket.tier)[0])
+            for ticket in ticketing.Ticket.query.filter_by(payment_id=payment.id)
+        )
+        user_id = user.id
+
+    client = ticketing.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+    page = client.get('/my-tickets')
+    return {
+        'mode': mode,
+        'tickets': quantity,
+        'avg_row_text_bytes': round(row_bytes or 0),
+        'my_tickets_html_bytes': len(page.data),
+        'legacy_inline_html_bytes': len(page.data) + legacy_inline_bytes,
+        'issue_tickets_per_sec': round(quantity / issue_seconds, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=50)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    results = [measure('inline', args.tickets), measure('on_demand', args.tickets)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
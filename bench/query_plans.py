@@ -0,0 +1,232 @@
+"""Check that every query the hot routes and workers run is served by an index.
+
+Usage:
+    python bench/query_plans.py [--tickets 2000] [--without-indexes] [--verbose]
+
+Seeds a throwaway SQLite database (or DATABASE_URL; on Postgres sequential
+scans are disabled so a small table cannot hide a missing index), drives each
+route and background job through the app while recording its SQL, and runs
+EXPLAIN on every SELECT/UPDATE/DELETE. Any full table scan outside the reads
+that are meant to load whole tables fails the check. --without-indexes drops
+the lookup indexes first to show what they cover.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+# Reads that load a whole table on purpose (catalog, admin listing, scanner index)
+FULL_TABLE_READS = {
+    ('GET /tickets', 'ticket_instances'),
+    ('GET /admin/manage-instances', 'ticket_instances'),
+    ('GET /admin/manage-instances', 'inventory'),
+    ('GET /admin/scan-manifest', 'tickets'),
+    ('GET /admin/scan-manifest', 'ticket_instances'),
+    ('GET /admin/scan-manifest', 'users'),
+}
+
+recording = threading.local()
+
+
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    captured = getattr(recording, 'statements', None)
+    if captured is not None and not executemany and statement.lstrip().split()[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+        captured.append((statement, parameters))
+
+
+def capture(label, action, results):
+    recording.statements = []
+    try:
+        action()
+    finally:
+        results.append((label, recording.statements))
+        recording.statements = None
+
+
+def sqlite_scans(conn, statement, parameters):
+    plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    details = [row[-1] for row in plan]
+    scans = [detail.split()[1] for detail in details if detail.startswith('SCAN ')]
+    return scans, details
+
+
+def postgres_scans(conn, statement, parameters):
+    plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+    scans, details = [], []
+
+    def walk(node):
+        details.append(f"{node['Node Type']} {node.get('Relation Name', '')} {node.get('Index Name', '')}".strip())
+        if node['Node Type'] == 'Seq Scan':
+            scans.append(node['Relation Name'])
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return scans, details
+
+
+def seed(ticket_count):
+    with ticketing.app.app_context():
+        instance = ticketing.TicketInstance(name='Plan Night', capacity=1, regular_price=100)
+        buyer = ticketing.User(email=f'plans-{uuid.uuid4()}@example.com', pin_hash='x')
+        others = [ticketing.User(email=f'other-{uuid.uuid4()}@example.com', pin_hash='x') for _ in range(20)]
+        ticketing.db.session.add_all([instance, buyer, *others])
+        ticketing.db.session.flush()
+        owners = [buyer, *others]
+        now = datetime.utcnow()
+
+        payments = []
+        for i, owner in enumerate(owners * 5):
+            payments.append(ticketing.Payment(
+                client_id=owner.id, external_reference=str(uuid.uuid4()), amount=100,
+                status=('success', 'failed', 'pending')[i % 3], created_at=now - timedelta(minutes=i)
+            ))
+        ticketing.db.session.add_all(payments)
+        ticketing.db.session.flush()
+
+        rows = []
+        for i in range(ticket_count):
+            owner = owners[i % len(owners)]
+            rows.append({'id': str(uuid.uuid4()), 'client_id': owner.id, 'ticket_instance_id': instance.id,
+                         'tier': 'regular', 'payment_id': payments[i % len(payments)].id,
+                         'created_at': now - timedelta(seconds=i)})
+        ticketing.db.session.execute(ticketing.db.insert(ticketing.Ticket), rows)
+        ticketing.db.session.execute(ticketing.db.insert(ticketing.ScanLog), [
+            {'ticket_id': row['id'], 'result': 'valid', 'scanned_at': now} for row in rows[:500]])
+        for payment in payments[:30]:
+            ticketing.db.session.add(ticketing.Reservation(
+                payment_id=payment.id, ticket_instance_id=instance.id, tier='regular', quantity=1,
+                status='held', expires_at=now + timedelta(minutes=10)))
+            ticketing.db.session.add(ticketing.FulfillmentJob(payment_id=payment.id, status='done', stage='done'))
+            ticketing.db.session.add(ticketing.EmailOutbox(kind='tickets', payment_id=payment.id, to_email='plans@example.com',
+                                                           subject='Tickets', status='sent'))
+        ticketing.db.session.commit()
+
+        buyer_payment = next(payment for payment in payments if payment.client_id == buyer.id)
+        return {
+            'buyer_id': buyer.id,
+            'instance_id': instance.id,
+            'ticket_id': next(row['id'] for row in rows if row['client_id'] == buyer.id),
+            'payment_reference': buyer_payment.external_reference,
+            'pending_reference': next(p.external_reference for p in payments if p.status == 'pending'),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=2000)
+    parser.add_argument('--without-indexes', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    ticketing.send_email_with_tickets = lambda to_email, tickets, user, *parts: True
+    ticketing.payhero_client.transaction_status = lambda reference: {'status': 'QUEUED'}
+    ticketing.app.config['PAYHERO_RECONCILE_AFTER'] = 0
+    data = seed(args.tickets)
+
+    with ticketing.app.app_context():
+        if args.without_indexes:
+            for table in ticketing.db.metadata.sorted_tables:
+                for index in table.indexes:
+                    if index.name.startswith('ix_'):
+                        ticketing.db.session.execute(ticketing.db.text(f'DROP INDEX IF EXISTS {index.name}'))
+            ticketing.db.session.commit()
+        event.listen(ticketing.db.engine, 'before_cursor_execute', record_statement)
+
+    buyer = ticketing.app.test_client()
+    with buyer.session_transaction() as flask_session:
+        flask_session['user_id'] = data['buyer_id']
+    admin = ticketing.app.test_client()
+    with admin.session_transaction() as flask_session:
+        flask_session['admin'] = True
+
+    def get(client, url, status=200):
+        def send():
+            response = client.get(url)
+            assert response.status_code == status, (url, response.status_code)
+            return response
+        return send
+
+    def second_page():
+        cursor = buyer.get('/api/my-tickets').get_json()['next']
+        recording.statements.clear()
+        assert buyer.get(f'/api/my-tickets?before={cursor}').status_code == 200
+
+    def verify():
+        # A ticket the scanner index has not loaded yet takes the single-row fallback
+        ticketing.scan_index.entries.pop(data['ticket_id'], None)
+        response = admin.post('/admin/verify-ticket', json={'ticket_id': data['ticket_id']})
+        assert response.status_code == 200
+
+    def callback():
+        response = ticketing.app.test_client().post('/api/payhero/callback', json={'response': {
+            'ExternalReference': data['pending_reference'], 'CheckoutRequestID': str(uuid.uuid4()),
+            'ResultCode': 1032, 'Status': 'Cancelled', 'ResultDesc': 'Cancelled by user'}})
+        assert response.status_code == 200
+
+    def in_app_context(fn):
+        def run():
+            with ticketing.app.app_context():
+                fn()
+        return run
+
+    results = []
+    capture('GET /tickets', get(buyer, '/tickets'), results)
+    capture('GET /my-tickets', get(buyer, '/my-tickets'), results)
+    capture('GET /api/my-tickets (page 2)', second_page, results)
+    capture('GET /api/payments/<reference>/status', get(buyer, f"/api/payments/{data['payment_reference']}/status"), results)
+    capture('GET /download-tickets?payment=', get(buyer, f"/download-tickets?payment={data['payment_reference']}"), results)
+    capture('GET /ticket/<id>/qr.png', get(buyer, f"/ticket/{data['ticket_id']}/qr.png"), results)
+    capture('POST /api/payhero/callback', callback, results)
+    capture('GET /admin/manage-instances', get(admin, '/admin/manage-instances'), results)
+    capture('GET /admin/scan-manifest', get(admin, '/admin/scan-manifest'), results)
+    capture('POST /admin/verify-ticket (index miss)', verify, results)
+    capture('worker: claim_fulfillment_job', in_app_context(ticketing.claim_fulfillment_job), results)
+    capture('worker: release_expired_reservations', in_app_context(ticketing.release_expired_reservations), results)
+    capture('worker: reconcile_pending_payments', in_app_context(ticketing.reconcile_pending_payments), results)
+    capture('worker: scan log flush', in_app_context(ticketing.scan_log_writer.flush), results)
+    capture('worker: claim_outbox_batch', in_app_context(ticketing.claim_outbox_batch), results)
+
+    with ticketing.app.app_context():
+        engine = ticketing.db.engine
+    explain = postgres_scans if engine.dialect.name == 'postgresql' else sqlite_scans
+    report, failures = {}, []
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.exec_driver_sql('SET enable_seqscan = off')
+        for label, captured in results:
+            entries = []
+            for statement, parameters in captured:
+                scans, details = explain(conn, statement, parameters)
+                unexpected = [table for table in scans if (label, table) not in FULL_TABLE_READS]
+                if unexpected:
+                    failures.append({'route': label, 'full_scans': unexpected, 'sql': ' '.join(statement.split())[:200]})
+                entries.append({'sql': ' '.join(statement.split())[:120], 'plan': details} if args.verbose else
+                               {'full_scans': scans} if scans else 'indexed')
+            report[label] = {'statements': len(captured), 'unexpected_full_scans': sum(
+                1 for failure in failures if failure['route'] == label)}
+            if args.verbose:
+                report[label]['queries'] = entries
+
+    print(json.dumps({'routes': report, 'failures': failures}, indent=2))
+    print('OK: every query uses an index' if not failures else f'FAIL: {len(failures)} queries scan a table')
+    sys.exit(0 if not failures else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Load test for the entrance scanner: p50/p99 latency and SQL statements per scan.
+
+Usage:
+    python bench/scan_load.py [--tickets 500] [--scans 200] [--rate 300] [--doors 4]
+
+Seeds tickets in a throwaway SQLite database (or DATABASE_URL), then replays a
+mix of first scans, repeat scans and invalid codes through /admin/verify-ticket
+from several concurrent "doors" at --rate scans per minute (0 = as fast as
+possible). The same mix is replayed through the original ORM verification path
+for comparison. A last batch with a row the database refuses checks that only
+that row is dropped.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'scan_load.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+statements = threading.local()
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.count = getattr(statements, 'count', 0) + 1
+
+
+def legacy_verify(ticket_id):
+    # The verification path before the scan index, kept as the comparison baseline
+    db, Ticket, ScanLog = ticketing.db, ticketing.Ticket, ticketing.ScanLog
+    ticket = db.session.get(Ticket, ticket_id)
+    if not ticket:
+        db.session.add(ScanLog(ticket_id=ticket_id, result='invalid', details='Ticket not found in database'))
+        db.session.commit()
+        return 'invalid'
+    if ticket.scanned_at:
+        db.session.add(ScanLog(ticket_id=ticket_id, result='already_scanned', details=f'Already scanned at {ticket.scanned_at}'))
+        db.session.commit()
+        return 'already_scanned'
+    ticket.scanned_at = datetime.utcnow()
+    db.session.add(ScanLog(ticket_id=ticket_id, result='valid', details=f'Ticket: {ticket.ticket_instance.name}, Tier: {ticket.tier}'))
+    db.session.commit()
+    ticket.user.email
+    return 'valid'
+
+
+def seed(count, label):
+    with ticketing.app.app_context():
+        user = ticketing.User(email=f'{label}-{uuid.uuid4()}@example.com', pin_hash='x')
+        instance = ticketing.TicketInstance(name=f'{label} Night', capacity=2, regular_price=100)
+        ticketing.db.session.add_all([user, instance])
+        ticketing.db.session.commit()
+        ids = [str(uuid.uuid4()) for _ in range(count)]
+        ticketing.db.session.add_all([
+            ticketing.Ticket(id=ticket_id, client_id=user.id, ticket_instance_id=instance.id, tier='regular')
+            for ticket_id in ids
+        ])
+        ticketing.db.session.commit()
+    return ids
+
+
+def scan_mix(ids, scans):
+    # Mostly first scans, plus re-presented tickets and unknown codes
+    fresh = list(ids)
+    random.shuffle(fresh)
+    used = []
+    mix = []
+    for _ in range(scans):
+        roll = random.random()
+        if roll < 0.1 or not fresh:
+            mix.append(str(uuid.uuid4()))
+        elif roll < 0.2 and used:
+            mix.append(random.choice(used))
+        else:
+            used.append(fresh.pop())
+            mix.append(used[-1])
+    return mix
+
+
+def replay(mix, doors, rate, scan):
+    interval = 60.0 / rate if rate else 0
+    queue = list(enumerate(mix))
+    queue_lock = threading.Lock()
+    samples = []
+    started = time.perf_counter()
+
+    def door():
+        while True:
+            with queue_lock:
+                if not queue:
+                    return
+                index, ticket_id = queue.pop(0)
+            due = started + index * interval
+            if due > time.perf_counter():
+                time.sleep(due - time.perf_counter())
+            statements.count = 0
+            began = time.perf_counter()
+            result = scan(ticket_id)
+            samples.append((result, (time.perf_counter() - began) * 1000, statements.count))
+
+    threads = [threading.Thread(target=door) for _ in range(doors)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for _, latency, _ in samples)
+    by_result = {}
+    for result, _, count in samples:
+        by_result.setdefault(result, []).append(count)
+    return {
+        'scans': len(samples),
+        'scans_per_minute': round(len(samples) / elapsed * 60),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p99_ms': round(latencies[max(0, int(len(latencies) * 0.99) - 1)], 2),
+        'statements_per_scan': {result: round(statistics.mean(counts), 1) for result, counts in by_result.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=500)
+    parser.add_argument('--scans', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=300, help='scans per minute, 0 for unpaced')
+    parser.add_argument('--doors', type=int, default=4)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+
+    with ticketing.app.app_context():
+        event.listen(ticketing.db.engine, 'before_cursor_execute', count_statement)
+
+    ticketing.app.add_url_rule(
+        '/bench/legacy-verify', 'bench_legacy_verify', methods=['POST'],
+        view_func=lambda: {'status': legacy_verify(ticketing.request.json.get('ticket_id'))}
+    )
+
+    def scanner(path):
+        def scan(ticket_id):
+            client = ticketing.app.test_client()
+            with client.session_transaction() as flask_session:
+                flask_session['admin'] = True
+            statements.count = 0
+            return client.post(path, json={'ticket_id': ticket_id}).get_json()['status']
+        return scan
+
+    results = {}
+    fast_mix = scan_mix(seed(args.tickets, 'fast'), args.scans)
+    with ticketing.app.app_context():
+        ticketing.scan_index.load()
+    results['indexed'] = summarize(*replay(fast_mix, args.doors, args.rate, scanner('/admin/verify-ticket')))
+    ticketing.scan_log_writer.flush()
+    results['indexed']['scan_log_writer'] = ticketing.scan_log_writer.snapshot()
+
+    # A row the database refuses is dropped on its own rather than failing every later flush
+    writer, before = ticketing.scan_log_writer, ticketing.scan_log_writer.snapshot()
+    writer.append('x' * 80, 'invalid', 'Oversized code')
+    writer.append(str(uuid.uuid4()), None, 'Refused by NOT NULL')
+    writer.append(str(uuid.uuid4()), 'invalid', 'Queued behind the refused row')
+    writer.flush()
+    after = writer.snapshot()
+    results['refused_row'] = {key: after[key] - before[key] for key in ('flushed', 'rejected')}
+    results['refused_row']['buffered'] = after['buffered']
+
+    legacy_mix = scan_mix(seed(args.tickets, 'legacy'), args.scans)
+    results['legacy'] = summarize(*replay(legacy_mix, args.doors, args.rate, scanner('/bench/legacy-verify')))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Local stand-in for the SendGrid v3 mail API, for benchmarks and load tests.
+
+Usage:
+    python bench/sendgrid_stub.py [--port 8098] [--latency 0.1] [--fail-rate 0]
+
+Run the app with SENDGRID_API_HOST pointing here. POST /v3/mail/send answers
+202 with an X-Message-Id header after --latency seconds (or 500 for
+--fail-rate of requests), counting messages, recipients and attachment bytes.
+Nothing is delivered.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class SendGridStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0):
+        super().__init__(address, SendGridHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.recipients = {}
+        self.stats = {'messages': 0, 'failed': 0, 'attachments': 0, 'attachment_bytes': 0}
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class SendGridHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data=None, headers=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if urlparse(self.path).path != '/v3/mail/send':
+            return self.reply(404, {'errors': [{'message': 'not found'}]})
+        time.sleep(server.latency)
+        if random.random() < server.fail_rate:
+            with server.lock:
+                server.stats['failed'] += 1
+            return self.reply(500, {'errors': [{'message': 'Stub rejected the message'}]})
+
+        attachments = payload.get('attachments') or []
+        with server.lock:
+            server.stats['messages'] += 1
+            server.stats['attachments'] += len(attachments)
+            server.stats['attachment_bytes'] += sum(len(base64.b64decode(item['content'])) for item in attachments)
+            for personalization in payload.get('personalizations', []):
+                for recipient in personalization.get('to', []):
+                    server.recipients[recipient['email']] = server.recipients.get(recipient['email'], 0) + 1
+        self.reply(202, headers={'X-Message-Id': uuid.uuid4().hex})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8098)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = SendGridStub((args.host, args.port), args.latency, args.fail_rate)
+    print(f'SendGrid stub listening on {stub.base_url}')
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
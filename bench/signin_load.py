@@ -0,0 +1,149 @@
+"""Sign-in under a guessing flood: legitimate p50/p99 with and without login throttling and the PIN hash pool.
+
+Usage:
+    python bench/signin_load.py [--users 5] [--attackers 8] [--duration 10] [--attack-pause 0.02]
+
+On a throwaway SQLite database (or DATABASE_URL) --users accounts sign in
+once a second, each from its own X-Forwarded-For address, while --attackers
+threads post wrong PINs for one victim from a single address as fast as they
+can (pausing --attack-pause after each 429: the attackers' own client loop
+shares this process and CPU, which a remote attacker's would not). Two phases run for --duration seconds each:
+  unthrottled  throttle limits out of reach and PIN_HASH_WORKERS=0, as before
+  throttled    the configured limits with hashing on the PIN_HASH_WORKERS pool
+Every attacker request that is refused with 429 is a PIN hash never computed.
+A last phase replays the attack against LOGIN_THROTTLE_BACKEND='database' and
+checks that a hash from an older PIN_HASH_METHOD is upgraded on sign-in.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'signin_load.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+import app as ticketing  # noqa: E402
+
+db = ticketing.db
+PIN = '4821'
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+
+def phase(emails, victim, attackers, duration, attack_pause):
+    ticketing.throttle_store = None
+    stop = threading.Event()
+    latencies, statuses, lock = [], {}, threading.Lock()
+
+    def legitimate(index, email):
+        client = ticketing.app.test_client()
+        headers = {'X-Forwarded-For': f'10.1.0.{index + 1}'}
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.post('/signin', json={'email': email, 'pin': PIN}, headers=headers)
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[f'user_{response.status_code}'] = statuses.get(f'user_{response.status_code}', 0) + 1
+            stop.wait(1)
+
+    def attacker():
+        client = ticketing.app.test_client()
+        headers = {'X-Forwarded-For': '203.0.113.7'}
+        while not stop.is_set():
+            response = client.post('/signin', json={'email': victim, 'pin': '0000'}, headers=headers)
+            with lock:
+                statuses[f'attack_{response.status_code}'] = statuses.get(f'attack_{response.status_code}', 0) + 1
+            if response.status_code == 429:
+                assert response.headers.get('Retry-After'), '429 without Retry-After'
+                time.sleep(attack_pause)
+
+    threads = [threading.Thread(target=legitimate, args=(i, email)) for i, email in enumerate(emails)]
+    threads += [threading.Thread(target=attacker) for _ in range(attackers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    attacks = sum(count for key, count in statuses.items() if key.startswith('attack_'))
+    return {
+        'signins': len(latencies),
+        'p50_ms': round(statistics.median(latencies), 1),
+        'p99_ms': round(percentile(latencies, 0.99), 1),
+        'statuses': dict(sorted(statuses.items())),
+        'attack_requests': attacks,
+        'attack_hashes_avoided': statuses.get('attack_429', 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--attackers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--attack-pause', type=float, default=0.02)
+    args = parser.parse_args()
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})
+    limits = {key: ticketing.app.config[key] for key in
+              ('LOGIN_EMAIL_BURST', 'LOGIN_EMAIL_PER_MINUTE', 'LOGIN_IP_BURST', 'LOGIN_IP_PER_MINUTE', 'PIN_HASH_WORKERS')}
+
+    pin_hash = generate_password_hash(PIN, ticketing.app.config['PIN_HASH_METHOD'])
+    with ticketing.app.app_context():
+        users = [ticketing.User(email=f'signin-{uuid.uuid4()}@example.com', pin_hash=pin_hash)
+                 for _ in range(args.users + 1)]
+        db.session.add_all(users)
+        db.session.commit()
+        emails = [user.email for user in users]
+    victim, emails = emails[0], emails[1:]
+
+    report = {'users': args.users, 'attackers': args.attackers, 'duration_s': args.duration, 'limits': limits}
+    ticketing.app.config.update({'LOGIN_EMAIL_BURST': 10 ** 9, 'LOGIN_IP_BURST': 10 ** 9, 'PIN_HASH_WORKERS': 0})
+    report['unthrottled'] = phase(emails, victim, args.attackers, args.duration, args.attack_pause)
+    ticketing.app.config.update(limits)
+    report['throttled'] = phase(emails, victim, args.attackers, args.duration, args.attack_pause)
+
+    # The same flood against the shared database buckets
+    ticketing.app.config['LOGIN_THROTTLE_BACKEND'] = 'database'
+    report['database_backend'] = phase(emails[:5], victim, 2, min(args.duration, 5), args.attack_pause)
+    with ticketing.app.app_context():
+        report['database_backend']['bucket_rows'] = ticketing.LoginThrottle.query.count()
+
+    # An account hashed under an older method is upgraded by its next good sign-in
+    with ticketing.app.app_context():
+        legacy = ticketing.User(email=f'legacy-{uuid.uuid4()}@example.com',
+                                pin_hash=generate_password_hash(PIN, 'pbkdf2:sha256:600000'))
+        db.session.add(legacy)
+        db.session.commit()
+        legacy_email = legacy.email
+    status = ticketing.app.test_client().post('/signin', json={'email': legacy_email, 'pin': PIN},
+                                              headers={'X-Forwarded-For': '10.2.0.1'}).status_code
+    with ticketing.app.app_context():
+        upgraded = ticketing.User.query.filter_by(email=legacy_email).one().pin_hash
+    report['legacy_rehash'] = {'status': status, 'method': upgraded.split('$')[0]}
+
+    print(json.dumps(report, indent=2))
+    before, after, shared = report['unthrottled'], report['throttled'], report['database_backend']
+    ok = after['p99_ms'] < before['p99_ms'] and after['attack_hashes_avoided'] > 0 \
+        and after['statuses'].get('user_429', 0) == 0 and after['statuses'].get('user_200', 0) == after['signins'] \
+        and shared['attack_hashes_avoided'] > 0 and shared['statuses'].get('user_429', 0) == 0 \
+        and report['legacy_rehash'] == {'status': 200, 'method': ticketing.app.config['PIN_HASH_METHOD']}
+    print('OK: guessing flood throttled without slowing legitimate sign-ins' if ok else
+          'FAIL: throttling did not protect legitimate sign-ins')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Cold-start cost: import time, first-request latency and gunicorn boot with and without preload.
+
+Usage:
+    python bench/startup.py [--runs 5] [--gunicorn-workers 4] [--skip-gunicorn]
+
+Each run is a fresh interpreter against a throwaway SQLite database (or
+DATABASE_URL) whose schema is created beforehand, as `flask schema upgrade`
+would on deploy. It reports how long `import app` takes, which heavy modules
+that import pulled in, and the latency of the first plain page, the first
+ticket PDF (which loads reportlab and qrcode) and the first PIN-reset email
+(which loads sendgrid, with the network call stubbed out). When gunicorn is
+installed, it also times gunicorn.conf.py from spawn until every worker has
+served a request, with GUNICORN_PRELOAD on and off.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY_MODULES = ('reportlab.pdfgen.canvas', 'qrcode', 'PIL.Image', 'sendgrid')
+
+PROBE = r'''
+import json, sys, time
+started = time.perf_counter()
+import app as ticketing
+imported = time.perf_counter()
+loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+ticketing.create_app()
+
+client = ticketing.app.test_client()
+timings = {'import_ms': (imported - started) * 1000, 'heavy_modules_at_import': loaded}
+
+def timed(name, send):
+    begin = time.perf_counter()
+    response = send()
+    assert response.status_code == 200, (name, response.status_code)
+    timings[name] = (time.perf_counter() - begin) * 1000
+
+timed('first_request_ms', lambda: client.get('/signin'))
+with client.session_transaction() as flask_session:
+    flask_session['user_id'] = USER_ID
+timed('first_pdf_ms', lambda: client.get('/download-ticket/' + TICKET_ID))
+import sendgrid
+sendgrid.SendGridAPIClient.send = lambda self, message: None
+def reset_and_deliver():
+    response = client.post('/forgot-pin', json={'email': EMAIL})
+    with ticketing.app.app_context():
+        ticketing.deliver_pending_emails()
+    return response
+
+timed('first_email_ms', reset_and_deliver)
+print(json.dumps(timings))
+'''
+
+
+def seed(env):
+    code = (
+        "import json, app as ticketing\n"
+        "ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True})\n"
+        "with ticketing.app.app_context():\n"
+        "    db = ticketing.db\n"
+        "    instance = ticketing.TicketInstance(name='Startup Night', capacity=1, regular_price=100)\n"
+        "    user = ticketing.User(email='startup@example.com', pin_hash='x')\n"
+        "    db.session.add_all([instance, user]); db.session.flush()\n"
+        "    ticket = ticketing.Ticket(client_id=user.id, ticket_instance_id=instance.id, tier='regular')\n"
+        "    db.session.add(ticket); db.session.commit()\n"
+        "    print(json.dumps({'user_id': user.id, 'ticket_id': ticket.id, 'email': user.email}))\n"
+    )
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def gunicorn_boot(env, workers, preload):
+    # The repo's gunicorn.conf.py plus a hook that records when each worker has the app loaded
+    workdir = tempfile.mkdtemp()
+    marks = os.path.join(workdir, 'ready')
+    config = os.path.join(workdir, 'gunicorn.conf.py')
+    with open(config, 'w') as handle:
+        handle.write(f"exec(open({os.path.join(ROOT, 'gunicorn.conf.py')!r}).read())\n"
+                     "import time\n"
+                     "def post_worker_init(worker):\n"
+                     f"    with open({marks!r}, 'a') as marks_file:\n"
+                     "        marks_file.write(f'{time.time()}\\n')\n")
+
+    port = free_port()
+    env = dict(env, GUNICORN_BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS='1', GUNICORN_PRELOAD='1' if preload else '0')
+    spawned = time.time()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', config], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = None
+        while first is None and time.time() - spawned < 60:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/signin', timeout=5) as response:
+                    response.read()
+                    first = time.time() - spawned
+            except OSError:
+                time.sleep(0.01)
+        ready = []
+        while len(ready) < workers and time.time() - spawned < 60:
+            time.sleep(0.05)
+            if os.path.exists(marks):
+                ready = [float(line) for line in open(marks).read().split()]
+        return {'first_response_ms': round(first * 1000, 1) if first else None,
+                'all_workers_ready_ms': round((max(ready) - spawned) * 1000, 1) if len(ready) >= workers else None}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--gunicorn-workers', type=int, default=4)
+    parser.add_argument('--skip-gunicorn', action='store_true')
+    args = parser.parse_args()
+
+    env = dict(os.environ, FULFILLMENT_WORKERS='0', PYTHONPATH=ROOT)
+    if not env.get('DATABASE_URL'):
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+    data = seed(env)
+
+    probe = (f"HEAVY_MODULES = {HEAVY_MODULES!r}\nUSER_ID = {data['user_id']}\n"
+             f"TICKET_ID = {data['ticket_id']!r}\nEMAIL = {data['email']!r}\n" + PROBE)
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, env=env, capture_output=True, text=True)
+        if output.returncode:
+            sys.exit(output.stderr)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    report = {'runs': args.runs, 'heavy_modules_at_import': runs[0]['heavy_modules_at_import']}
+    for key in ('import_ms', 'first_request_ms', 'first_pdf_ms', 'first_email_ms'):
+        values = sorted(run[key] for run in runs)
+        report[key] = {'median': round(statistics.median(values), 1), 'max': round(values[-1], 1)}
+
+    if not args.skip_gunicorn:
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            report['gunicorn'] = 'not installed'
+        else:
+            report['gunicorn'] = {
+                f'preload_{"on" if preload else "off"}': gunicorn_boot(env, args.gunicorn_workers, preload)
+                for preload in (True, False)
+            }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
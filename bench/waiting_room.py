@@ -0,0 +1,356 @@
+"""Waiting room: checkout latency and goodput with offered load far above capacity, with and without admission control.
+
+Usage:
+    python bench/waiting_room.py [--buyers 80] [--duration 20] [--server-threads 4] [--latency 0.5]
+                                 [--concurrency 3] [--active 6] [--timeout 10] [--processes 2]
+
+Serves the app from --server-threads request threads (like one gunicorn worker)
+on a throwaway SQLite database (or DATABASE_URL), with PAYHERO_PUSH_MODE='sync'
+so every /purchase blocks on bench/payhero_stub.py for --latency seconds.
+--buyers buyers then check out back to back for --duration seconds, with a
+--timeout second client timeout:
+  open          WAITING_ROOM_ENABLED off: everyone posts /purchase at once
+  waiting_room  buyers join the queue, poll /api/waiting-room/status and post
+                /purchase with their admission token; at most --active unspent
+                admissions and --concurrency purchases run at once
+A probe fetches /api/instances throughout to show whether the rest of the site
+stays responsive. The waiting-room phase must keep checkout p99 low with no
+timeouts, admit in join order and query the database only on the poll that admits.
+  processes     the waiting room served by --processes server processes on the
+                same database, like gunicorn workers, with every buyer's requests
+                alternating between them: admissions must stay in join order,
+                slots must never exceed --active and must be freed by a purchase
+                on either process, and an admission token buys one checkout
+A last phase checks a full queue sheds with 503 and Retry-After.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'waiting_room.db')
+os.environ['FULFILLMENT_WORKERS'] = '0'
+os.environ.setdefault('PAYHERO_CHANNEL_ID', '1')
+
+import requests  # noqa: E402
+from werkzeug.serving import BaseWSGIServer  # noqa: E402
+
+import app as ticketing  # noqa: E402
+from payhero_stub import PayHeroStub  # noqa: E402
+
+db = ticketing.db
+
+
+class PooledServer(BaseWSGIServer):
+    # A fixed number of request threads, like gunicorn's gthread worker; extra connections wait in the backlog
+    def __init__(self, host, port, wsgi_app, threads):
+        super().__init__(host, port, wsgi_app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 1) if values else None
+
+
+def session_cookie(user_id):
+    return ticketing.app.session_interface.get_signing_serializer(ticketing.app).dumps({'user_id': user_id})
+
+
+def serve(ports, threads, config):
+    # A server process of its own, like a gunicorn worker
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    ticketing.create_app(config)
+    server = PooledServer('127.0.0.1', 0, ticketing.app, threads)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def run_phase(base_urls, user_ids, instance_id, duration, timeout, queued):
+    stop = threading.Event()
+    lock = threading.Lock()
+    result = {'checkout': [], 'end_to_end': [], 'completed': 0, 'timeouts': 0, 'errors': {},
+              'shed_retries': 0, 'polls': 0, 'admissions': [], 'probe': [], 'spent': None}
+
+    def count_error(key):
+        with lock:
+            result['errors'][key] = result['errors'].get(key, 0) + 1
+
+    def buyer(user_id):
+        http = requests.Session()
+        http.cookies.set(ticketing.app.config['SESSION_COOKIE_NAME'], session_cookie(user_id))
+        calls = [user_id]
+
+        def base_url():
+            # Round robin, as a load balancer in front of several workers would
+            calls[0] += 1
+            return base_urls[calls[0] % len(base_urls)]
+
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                headers = {}
+                if queued:
+                    joined_at = time.time()
+                    data = http.post(f'{base_url()}/api/waiting-room/join', timeout=timeout).json()
+                    if not data['admitted']:
+                        # The queue orders by the join time the server signed, not when the request left here
+                        joined_at = float(data['token'].rsplit('.', 1)[0].split('.', 3)[3])
+                    while not data['admitted'] and not stop.is_set():
+                        time.sleep(data['poll_after'])
+                        data = http.get(f'{base_url()}/api/waiting-room/status', params={'token': data['token']},
+                                        timeout=timeout).json()
+                        with lock:
+                            result['polls'] += 1
+                    if not data['admitted']:
+                        return
+                    with lock:
+                        result['admissions'].append((joined_at, time.time()))
+                    headers['X-Admission-Token'] = data['token']
+                while True:
+                    checkout_started = time.perf_counter()
+                    url = base_url()
+                    response = http.post(f'{url}/purchase', headers=headers, timeout=timeout, json={
+                        'phoneNumber': '254700000000',
+                        'cart': [{'instance_id': instance_id, 'tier': 'regular', 'quantity': 1}]})
+                    if response.status_code != 503:
+                        break
+                    with lock:
+                        result['shed_retries'] += 1
+                    time.sleep(int(response.headers['Retry-After']))
+                with lock:
+                    result['checkout'].append(time.perf_counter() - checkout_started)
+                if response.status_code == 200:
+                    with lock:
+                        result['completed'] += 1
+                        result['end_to_end'].append(time.perf_counter() - started)
+                        if queued and result['spent'] is None:
+                            result['spent'] = (user_id, headers['X-Admission-Token'], url)
+                else:
+                    count_error(str(response.status_code))
+            except requests.Timeout:
+                with lock:
+                    result['timeouts'] += 1
+            except requests.RequestException as e:
+                count_error(type(e).__name__)
+
+    def probe():
+        http = requests.Session()
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                http.get(f'{base_urls[0]}/api/instances', timeout=timeout)
+                elapsed = time.perf_counter() - started
+            except requests.Timeout:
+                elapsed = timeout
+            with lock:
+                result['probe'].append(elapsed)
+            stop.wait(0.5)
+
+    threads = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+    threads.append(threading.Thread(target=probe))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    # Admitted in join order: a buyer who joined earlier should not wait behind a later one by more than a poll
+    admissions = sorted(result['admissions'])
+    poll = ticketing.app.config['WAITING_ROOM_POLL_SECONDS']
+    overtaken = sum(1 for i in range(1, len(admissions))
+                    if min(admitted for _, admitted in admissions[i:]) < admissions[i - 1][1] - 2 * poll)
+    return {
+        'purchases_completed': result['completed'],
+        'purchases_per_sec': round(result['completed'] / wall, 2),
+        'timeouts': result['timeouts'],
+        'errors': result['errors'],
+        'checkout_p50_ms': percentile(result['checkout'], 0.50),
+        'checkout_p99_ms': percentile(result['checkout'], 0.99),
+        'buyer_end_to_end_p50_ms': percentile(result['end_to_end'], 0.50),
+        'buyer_end_to_end_p99_ms': percentile(result['end_to_end'], 0.99),
+        'shed_and_retried': result['shed_retries'],
+        'status_polls': result['polls'],
+        'admitted_out_of_order': overtaken if queued else None,
+        'probe_p99_ms': percentile(result['probe'], 0.99),
+        'spent_admission': result['spent'],
+    }
+
+
+def settle(stub, latency):
+    # Requests the clients gave up on still run on the server; wait for them so phases do not overlap
+    while True:
+        pushes = stub.stats['pushes']
+        time.sleep(latency * 4)
+        if stub.stats['pushes'] == pushes:
+            return
+
+
+def status_poll_queries():
+    # From the built-in per-request SQL histogram: (requests, requests that issued SQL) for the status route
+    for (name, labels), series in ticketing.metrics.series.items():
+        if name == 'ticketing_db_queries_per_request' and ('route', '/api/waiting-room/status') in labels:
+            return series[-1], series[-1] - series[0]
+    return 0, 0
+
+
+def reset_room():
+    with ticketing.app.app_context():
+        ticketing.WaitingRoomEntry.query.delete()
+        ticketing.Admission.query.delete()
+        ticketing.WaitingRoomState.query.update({'active': 0})
+        db.session.commit()
+        ticketing.waiting_room.refresh()
+
+
+def room_counts():
+    with ticketing.app.app_context():
+        counts = dict(db.session.query(ticketing.Admission.status, db.func.count()).group_by(ticketing.Admission.status))
+        return counts, db.session.query(ticketing.WaitingRoomState.active).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=80)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--server-threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--concurrency', type=int, default=3)
+    parser.add_argument('--active', type=int, default=6)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--processes', type=int, default=2)
+    args = parser.parse_args()
+    config = {'PAYHERO_PUSH_MODE': 'sync', 'SECRET_KEY': 'bench', 'CHECKOUT_CONCURRENCY': args.concurrency,
+              'WAITING_ROOM_ACTIVE': args.active, 'WAITING_ROOM_POLL_SECONDS': 1}
+    ticketing.create_app({'SCHEMA_AUTO_UPGRADE': True, **config})
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = PooledServer('127.0.0.1', 0, ticketing.app, args.server_threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    os.environ['REPLIT_DEV_DOMAIN'] = base_url
+    stub = PayHeroStub(('127.0.0.1', 0), latency=args.latency).start()
+    ticketing.app.config['PAYHERO_BASE_URL'] = stub.base_url
+
+    with ticketing.app.app_context():
+        instance = ticketing.TicketInstance(name='Rush Night', capacity=1, regular_price=1000)
+        users = [ticketing.User(email=f'rush-{uuid.uuid4()}@example.com', pin_hash='x') for _ in range(args.buyers)]
+        db.session.add_all([instance, *users])
+        db.session.flush()
+        db.session.add(ticketing.Inventory(ticket_instance_id=instance.id, tier='regular', stock=None, sold=0, reserved=0))
+        db.session.commit()
+        instance_id, user_ids = instance.id, [user.id for user in users]
+
+    report = {'buyers': args.buyers, 'server_threads': args.server_threads, 'payhero_latency_s': args.latency,
+              'capacity_purchases_per_sec': round(args.server_threads / args.latency, 1)}
+    ticketing.app.config['WAITING_ROOM_ENABLED'] = False
+    report['open'] = run_phase([base_url], user_ids, instance_id, args.duration, args.timeout, queued=False)
+    settle(stub, args.latency)
+    ticketing.app.config['WAITING_ROOM_ENABLED'] = True
+    report['waiting_room'] = run_phase([base_url], user_ids, instance_id, args.duration, args.timeout, queued=True)
+    polls, polls_with_sql = status_poll_queries()
+    report['waiting_room']['status_polls_with_sql'] = polls_with_sql
+    report['waiting_room']['admissions'] = room_counts()[0]
+
+    # The same room behind several server processes sharing the database
+    settle(stub, args.latency)
+    ticketing.app.config['WAITING_ROOM_ENABLED'] = False
+    reset_room()
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    children = [context.Process(target=serve, daemon=True, args=(ports, args.server_threads, {
+        **config, 'WAITING_ROOM_ENABLED': True, 'PAYHERO_BASE_URL': stub.base_url})) for _ in range(args.processes)]
+    for child in children:
+        child.start()
+    base_urls = [f'http://127.0.0.1:{ports.get(timeout=60)}' for _ in children]
+    peak, sampling = [0], threading.Event()
+
+    def sample_slots():
+        while not sampling.wait(0.1):
+            peak[0] = max(peak[0], room_counts()[1] or 0)
+
+    sampler = threading.Thread(target=sample_slots)
+    sampler.start()
+    shared = report['processes'] = run_phase(base_urls, user_ids, instance_id, args.duration, args.timeout, queued=True)
+    settle(stub, args.latency)
+    sampling.set()
+    sampler.join()
+    counts, active = room_counts()
+    shared.update({'processes': args.processes, 'admissions': counts, 'peak_slots_held': peak[0],
+                   'slot_count_matches': active == counts.get('admitted', 0) + counts.get('checkout', 0)})
+    if shared['spent_admission']:
+        # The token that bought a checkout on one process is refused by the next
+        user_id, token, url = shared['spent_admission']
+        other = base_urls[(base_urls.index(url) + 1) % len(base_urls)]
+        shared['spent_token_elsewhere'] = requests.post(
+            f'{other}/purchase', headers={'X-Admission-Token': token},
+            cookies={ticketing.app.config['SESSION_COOKIE_NAME']: session_cookie(user_id)},
+            json={'phoneNumber': '254700000000', 'cart': [{'instance_id': instance_id, 'tier': 'regular', 'quantity': 1}]},
+            timeout=args.timeout).status_code
+    for child in children:
+        child.terminate()
+
+    # Admission errors and shedding, in process, on an empty room
+    ticketing.app.config['WAITING_ROOM_ENABLED'] = True
+    reset_room()
+    client = ticketing.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_ids[0]
+    ticketing.app.config.update({'WAITING_ROOM_ACTIVE': 0, 'WAITING_ROOM_MAX': 3})
+    joins = [client.post('/api/waiting-room/join') for _ in range(4)]
+    checks = {
+        'queued_then_full': [response.status_code for response in joins],
+        'full_retry_after': joins[-1].headers.get('Retry-After'),
+        'bad_queue_token': client.get('/api/waiting-room/status?token=q.1.x.1.sig').status_code,
+        'purchase_without_admission': client.post('/purchase', json={'phoneNumber': '254700000000', 'cart': []}).status_code,
+        'forged_admission': client.post('/purchase', headers={'X-Admission-Token': 'a.1.x.9999999999.000000.sig'},
+                                        json={}).status_code,
+    }
+    report['checks'] = checks
+    server.shutdown()
+
+    print(json.dumps(report, indent=2))
+    before, after = report['open'], report['waiting_room']
+    ok = after['timeouts'] == 0 and not after['errors'] and after['purchases_completed'] > 0 \
+        and after['checkout_p99_ms'] < before['checkout_p99_ms'] \
+        and after['checkout_p99_ms'] < (args.latency * 2 + ticketing.app.config['CHECKOUT_WAIT']) * 1000 \
+        and after['purchases_per_sec'] >= before['purchases_per_sec'] * 0.8 \
+        and after['admitted_out_of_order'] == 0 and polls > 0 \
+        and polls_with_sql <= sum(after['admissions'].values()) + 1 \
+        and shared['timeouts'] == 0 and not shared['errors'] and shared['purchases_completed'] > 3 * args.active \
+        and shared['admitted_out_of_order'] == 0 \
+        and shared['admissions'].get('spent', 0) == shared['purchases_completed'] \
+        and shared['peak_slots_held'] <= args.active and shared['slot_count_matches'] \
+        and shared.get('spent_token_elsewhere') == 403 \
+        and checks == {'queued_then_full': [200, 200, 200, 503], 'full_retry_after': '30', 'bad_queue_token': 400,
+                       'purchase_without_admission': 403, 'forged_admission': 403}
+    print('OK: checkout latency held steady under overload' if ok else 'FAIL: admission control did not hold')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
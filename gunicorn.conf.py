@@ -0,0 +1,22 @@
+import os
+
+# gunicorn -c gunicorn.conf.py
+# With preload the app is imported once in the master and forked, so workers start (and recycle) without
+# re-importing it; set SCHEMA_AUTO_UPGRADE=1 to also migrate once there instead of per worker.
+wsgi_app = 'app:create_app()'
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    # Pooled connections opened in the master must not be shared across processes
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
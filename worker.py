@@ -0,0 +1,21 @@
+import signal
+import threading
+from app import app, logger, start_fulfillment_workers, stop_fulfillment_workers
+
+# Standalone ticket fulfillment and email delivery worker. Run alongside the web
+# server with FULFILLMENT_WORKERS=0 set for the web processes:  python worker.py
+
+if __name__ == '__main__':
+    start_fulfillment_workers(int(app.config['FULFILLMENT_WORKERS']) or 2)
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while not stopping.wait(1):
+        pass
+    # Lets each thread finish the job or email batch it holds before exiting
+    logger.info("Stopping fulfillment workers")
+    stop_fulfillment_workers()